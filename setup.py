@@ -42,5 +42,8 @@ setup(name='taca-ngi-pipeline',
           ]
       },
       install_requires=install_requires,
+      extras_require={
+          'fast_hash': ['xxhash', 'blake3'],
+      },
       dependency_links=dependency_links
       )
@@ -2,12 +2,18 @@
 """
 import click
 import logging
+import os
+
+from contextlib import contextmanager
 
 from taca.utils.misc import send_mail
-from taca.utils.config import load_yaml_config
+from taca.utils.config import CONFIG, load_yaml_config
 from taca_ngi_pipeline.deliver import deliver as _deliver
 from taca_ngi_pipeline.deliver import deliver_grus as _deliver_grus
 from taca_ngi_pipeline.deliver import deliver_dds as _deliver_dds
+from taca_ngi_pipeline.utils import filesystem as _fs
+from taca_ngi_pipeline.utils import rsync as _rsync
+from taca_ngi_pipeline.utils.checksum_index import ChecksumIndex, ChecksumIndexError
 
 logger = logging.getLogger(__name__)
 
@@ -33,12 +39,45 @@ logger = logging.getLogger(__name__)
               help="Specify to which cluster one wants to deliver")
 @click.option('--generate_xml_and_manifest_files_only', is_flag=True,  default=False,
               help="Explicitly generate xml amd manifest files for ENA submission on a staged project")
+@click.option('--hash-workers', type=click.IntRange(1), default=None,
+              help="Number of worker processes to use for computing checksums when staging")
+@click.option('--workers', type=click.IntRange(1), default=None,
+              help="Number of samples to stage or deliver concurrently when delivering a project")
+@click.option('--incremental-staging', is_flag=True, default=False,
+              help="Only restage the files that have changed since the previous staging")
+@click.option('--atomic-staging', is_flag=True, default=False,
+              help="Stage into a separate folder and publish it when staging is done, "
+                   "an interrupted staging is resumed by the next run")
+@click.option('--batch-reports', is_flag=True, default=False,
+              help="Create the reports for all samples of a project at once when delivering a project")
+@click.option('--async-reports', is_flag=True, default=False,
+              help="Create the sample reports in the background while staging")
+@click.option('--rsync-streams', type=click.IntRange(1), default=None,
+              help="Number of concurrent rsync processes to deliver each sample with")
+@click.option('--rsync-progress-interval', type=click.FLOAT, default=None,
+              help="Report the progress of rsync deliveries at this interval, in seconds")
+@click.option('--resumable-delivery', is_flag=True, default=False,
+              help="Keep a journal of the transferred files so that a failed delivery can be resumed")
+@click.option('--ssh-multiplex', is_flag=True, default=False,
+              help="Share a single ssh connection to the remote host between all rsync deliveries of a project")
+@click.option('--skip-delivered', is_flag=True, default=False,
+              help="Do not transfer files that have already been delivered with the same checksum")
+@click.option('--verify-delivery', is_flag=True, default=False,
+              help="Verify the checksums of the delivered files before marking a sample as delivered")
+@click.option('--verify-workers', type=click.IntRange(1), default=None,
+              help="Number of workers to verify the delivered files with [default: --hash-workers]")
+@click.option('--verify-staged-copies', is_flag=True, default=False,
+              help="Re-read the hard staged copies and verify them against the fast checksums")
 
 
 def deliver(ctx, deliverypath, stagingpath, 
             uppnexid, operator, stage_only, 
             force, cluster, ignore_analysis_status,
-            generate_xml_and_manifest_files_only):
+            generate_xml_and_manifest_files_only, hash_workers, workers,
+            incremental_staging, atomic_staging, batch_reports, async_reports,
+            rsync_streams, rsync_progress_interval, resumable_delivery,
+            ssh_multiplex, skip_delivered, verify_delivery, verify_workers,
+            verify_staged_copies):
     """ Deliver methods entry point
     """
     if deliverypath is None:
@@ -49,6 +88,34 @@ def deliver(ctx, deliverypath, stagingpath,
         del ctx.params['uppnexid']
     if operator is None or len(operator) == 0:
         del ctx.params['operator']
+    if hash_workers is None:
+        del ctx.params['hash_workers']
+    if workers is None:
+        del ctx.params['workers']
+    if not incremental_staging:
+        del ctx.params['incremental_staging']
+    if not atomic_staging:
+        del ctx.params['atomic_staging']
+    if not batch_reports:
+        del ctx.params['batch_reports']
+    if not async_reports:
+        del ctx.params['async_reports']
+    if rsync_streams is None:
+        del ctx.params['rsync_streams']
+    if rsync_progress_interval is None:
+        del ctx.params['rsync_progress_interval']
+    if not resumable_delivery:
+        del ctx.params['resumable_delivery']
+    if not ssh_multiplex:
+        del ctx.params['ssh_multiplex']
+    if not skip_delivered:
+        del ctx.params['skip_delivered']
+    if not verify_delivery:
+        del ctx.params['verify_delivery']
+    if verify_workers is None:
+        del ctx.params['verify_workers']
+    if not verify_staged_copies:
+        del ctx.params['verify_staged_copies']
 
 
 # deliver subcommands
@@ -106,52 +173,53 @@ def project(ctx, projectid,
             project_desc=None, ignore_orderportal_members=False):
     """ Deliver the specified projects to the specified destination
     """
-    for pid in projectid:
-        if ctx.parent.params['cluster']:
-            if statusdb_config == None:
-                logger.error("--statusdb-config or env variable $STATUS_DB_CONFIG"
-                             " need to be set to perform {} delivery".format(ctx.parent.params['cluster']))
-                return 1
-            load_yaml_config(statusdb_config.name)
-            if order_portal == None:
-                logger.error("--order-portal or env variable $ORDER_PORTAL"
-                             " need to be set to perform {} delivery".format(ctx.parent.params['cluster']))
-                return 1
-            load_yaml_config(order_portal.name)
-        if not ctx.parent.params['cluster']: # Soft stage case
-            d = _deliver.ProjectDeliverer(
-                pid,
-                **ctx.parent.params)
-        elif ctx.parent.params['cluster'] == 'grus': # Hard stage and deliver to GRUS
-            if snic_api_credentials == None:
-                logger.error("--snic-api-credentials or env variable $SNIC_API_STOCKHOLM need to be set to perform GRUS delivery")
-                return 1
-            load_yaml_config(snic_api_credentials.name)
-            d = _deliver_grus.GrusProjectDeliverer(
-                projectid=pid,
-                pi_email=pi_email,
-                sensitive=sensitive,
-                hard_stage_only=hard_stage_only,
-                add_user=list(set(add_user)),
-                fcid=fc_delivery,
-                **ctx.parent.params)
-        elif ctx.parent.params['cluster'] == 'dds': # Hard stage and deliver using DDS
-            d = _deliver_dds.DDSProjectDeliverer(
-                projectid=pid,
-                pi_email=pi_email,
-                sensitive=sensitive,
-                add_user=list(set(add_user)),
-                fcid=fc_delivery,
-                do_release=False,
-                project_description=project_desc,
-                ignore_orderportal_members=ignore_orderportal_members,
-                **ctx.parent.params)
+    with _shared_ssh_connection(ctx.parent.params):
+        for pid in projectid:
+            if ctx.parent.params['cluster']:
+                if statusdb_config == None:
+                    logger.error("--statusdb-config or env variable $STATUS_DB_CONFIG"
+                                 " need to be set to perform {} delivery".format(ctx.parent.params['cluster']))
+                    return 1
+                load_yaml_config(statusdb_config.name)
+                if order_portal == None:
+                    logger.error("--order-portal or env variable $ORDER_PORTAL"
+                                 " need to be set to perform {} delivery".format(ctx.parent.params['cluster']))
+                    return 1
+                load_yaml_config(order_portal.name)
+            if not ctx.parent.params['cluster']: # Soft stage case
+                d = _deliver.ProjectDeliverer(
+                    pid,
+                    **ctx.parent.params)
+            elif ctx.parent.params['cluster'] == 'grus': # Hard stage and deliver to GRUS
+                if snic_api_credentials == None:
+                    logger.error("--snic-api-credentials or env variable $SNIC_API_STOCKHOLM need to be set to perform GRUS delivery")
+                    return 1
+                load_yaml_config(snic_api_credentials.name)
+                d = _deliver_grus.GrusProjectDeliverer(
+                    projectid=pid,
+                    pi_email=pi_email,
+                    sensitive=sensitive,
+                    hard_stage_only=hard_stage_only,
+                    add_user=list(set(add_user)),
+                    fcid=fc_delivery,
+                    **ctx.parent.params)
+            elif ctx.parent.params['cluster'] == 'dds': # Hard stage and deliver using DDS
+                d = _deliver_dds.DDSProjectDeliverer(
+                    projectid=pid,
+                    pi_email=pi_email,
+                    sensitive=sensitive,
+                    add_user=list(set(add_user)),
+                    fcid=fc_delivery,
+                    do_release=False,
+                    project_description=project_desc,
+                    ignore_orderportal_members=ignore_orderportal_members,
+                    **ctx.parent.params)
             
 
-        if fc_delivery:
-            _exec_fn(d, d.deliver_run_folder)
-        else:
-            _exec_fn(d, d.deliver_project)
+            if fc_delivery:
+                _exec_fn(d, d.deliver_run_folder)
+            else:
+                _exec_fn(d, d.deliver_project)
 
 # sample delivery
 #TODO: not used? remove?
@@ -176,6 +244,40 @@ def sample(ctx, projectid, sampleid):
             return 1
         _exec_fn(d, d.deliver_sample)
 
+# verify delivered samples
+@deliver.command()
+@click.pass_context
+@click.argument('projectid', type=click.STRING, nargs=1)
+@click.argument('sampleid', type=click.STRING, nargs=-1, required=True)
+def verify(ctx, projectid, sampleid):
+    """ Verify the checksums of the delivered files of the specified samples
+    """
+    with _shared_ssh_connection(ctx.parent.params):
+        for sid in sampleid:
+            d = _deliver.SampleDeliverer(projectid, sid, **ctx.parent.params)
+            _exec_fn(d, d.verify_delivered_files)
+
+# helper function to share an ssh connection between the deliveries
+@contextmanager
+def _shared_ssh_connection(params):
+    config = CONFIG.get('deliver', {})
+    remote_host = params.get('remote_host', config.get('remote_host'))
+    if not params.get('ssh_multiplex', config.get('ssh_multiplex')) or remote_host is None \
+            or params.get('stage_only'):
+        yield None
+        return
+    with _rsync.SshMaster(
+            remote_host,
+            remote_user=params.get('remote_user', config.get('remote_user'))) as master:
+        if master.control_path is not None:
+            params['ssh_control_path'] = master.control_path
+        try:
+            yield master
+        finally:
+            # the deliverers copy their options into the configuration
+            params.pop('ssh_control_path', None)
+            config.pop('ssh_control_path', None)
+
 # helper function to handle error reporting
 def _exec_fn(obj, fn):
     try:
@@ -262,4 +364,96 @@ def release_dds_project(ctx, projectid, dds_project, dds_deadline, no_dds_mail):
         projectid,
         do_release=True,
         **ctx.parent.params)
-    d.release_DDS_delivery_project(dds_project, no_dds_mail, dds_deadline)
\ No newline at end of file
+    d.release_DDS_delivery_project(dds_project, no_dds_mail, dds_deadline)
+
+# maintenance of the persistent checksum index
+@deliver.command('checksum-index')
+@click.pass_context
+@click.option('--index',
+              default=None,
+              type=click.Path(dir_okay=False),
+              help='Path to the checksum index [default: the checksum_index config option]')
+@click.option('--max-entries',
+              default=None,
+              type=click.IntRange(0),
+              help='Keep only this many of the most recently used entries')
+@click.option('--max-age',
+              default=None,
+              type=click.FloatRange(0),
+              help='Remove entries that have not been used for this many days')
+@click.option('--prune-missing',
+              is_flag=True,
+              default=False,
+              help='Remove entries for files that no longer exist or have been modified')
+@click.option('--vacuum',
+              is_flag=True,
+              default=False,
+              help='Reclaim unused disk space in the index file')
+
+def checksum_index(ctx, index, max_entries, max_age, prune_missing, vacuum):
+    """ Apply the eviction policy to the checksum index and report its size
+    """
+    index = index or CONFIG.get('deliver', {}).get('checksum_index')
+    if not index:
+        logger.error("--index or the checksum_index config option need to be set")
+        return 1
+    try:
+        with ChecksumIndex(index) as cidx:
+            removed = cidx.evict(
+                max_entries=max_entries,
+                max_age_days=max_age,
+                prune_missing=prune_missing)
+            logger.info("removed {} entries from checksum index {}".format(removed, index))
+            if vacuum:
+                cidx.vacuum()
+            stats = cidx.stats()
+    except ChecksumIndexError as e:
+        logger.error(e)
+        return 1
+    for algorithm, entries in sorted(stats['entries'].items()):
+        logger.info("{} entries for {}".format(entries, algorithm))
+    logger.info("{} files with checkpointed checksums".format(stats['checkpoints']))
+    logger.info("checksum index {} is {} bytes".format(index, stats['size_in_bytes']))
+
+# measure the throughput of the hashing backends
+@deliver.command('benchmark-hash')
+@click.pass_context
+@click.argument('path', type=click.Path(exists=True))
+@click.option('--backend',
+              multiple=True,
+              type=click.Choice(_fs.HashBackend.METHODS),
+              help='Hashing backend to measure. Multiple backends can be specified [default: all]')
+@click.option('--chunk-size',
+              multiple=True,
+              type=click.IntRange(1),
+              help='Chunk size in bytes for the buffered and mmap backends. '
+                   'Multiple chunk sizes can be specified [default: {}]'.format(_fs.HashBackend.DEFAULT_CHUNK_SIZE))
+@click.option('--hash-algorithm',
+              multiple=True,
+              default=['md5'],
+              help='Hash algorithm to compute. Multiple algorithms can be specified [default: md5]')
+@click.option('--drop-cache',
+              is_flag=True,
+              default=False,
+              help='Release hashed pages from the page cache, so that each run reads from storage')
+
+def benchmark_hash(ctx, path, backend, chunk_size, hash_algorithm, drop_cache):
+    """ Report the hashing throughput in MB/s for each backend and chunk size on the files under PATH
+    """
+    if os.path.isdir(path):
+        paths = [os.path.join(d, f) for d, _, files in os.walk(path) for f in files]
+    else:
+        paths = [path]
+    paths = [p for p in paths if os.path.isfile(p)]
+    backends = []
+    for method in backend or _fs.HashBackend.METHODS:
+        if method == 'hashfile':
+            backends.append(_fs.HashBackend(method, drop_cache=drop_cache))
+            continue
+        for size in chunk_size or [None]:
+            backends.append(_fs.HashBackend(method, chunk_size=size, drop_cache=drop_cache))
+    for result in _fs.benchmark_hash_backends(paths, backends, hash_algorithms=hash_algorithm):
+        # the throughput is not known if no time was measured, e.g. without any files
+        throughput = "{:.1f} MB/s".format(result['mb_per_s']) if result['mb_per_s'] is not None else "n/a"
+        logger.info("{backend} (chunk size {chunk_size}): {files} files, {bytes} bytes in "
+                    "{seconds:.2f} s, {throughput}".format(throughput=throughput, **result))
@@ -2,15 +2,21 @@
     Module for controlling deliveries of samples and projects
 """
 import datetime
+import filecmp
 import glob
 import json
 import logging
+import multiprocessing
 import os
 import re
 import signal
 import shutil
+import sys
 import yaml
 
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import ExitStack
+from functools import lru_cache
 from taca.utils.config import CONFIG
 from taca.utils.filesystem import create_folder, chdir
 from taca.utils.misc import call_external_command
@@ -19,7 +25,10 @@ from taca.utils import transfer
 from ..utils import database as db
 from ..utils import filesystem as fs
 from ..utils import nbis_xml_generator as xmlgen
+from ..utils import rsync
+from ..utils.checksum_index import ChecksumIndex, ChecksumIndexError
 from io import open
+from six import string_types
 from six.moves import map
 
 logger = logging.getLogger(__name__)
@@ -46,6 +55,64 @@ def _signal_handler(sgnal, frame):
         "interrupt signal {} received while delivering".format(sgnal))
 
 
+def _deliver_sample(projectid, sampleid, **kwargs):
+    """ Deliver a sample in a worker process of ProjectDeliverer.deliver_samples
+        :returns: the result of SampleDeliverer.deliver_sample
+    """
+    return SampleDeliverer(projectid, sampleid).deliver_sample(**kwargs)
+
+
+def _relpath(path, start):
+    """ Same as os.path.relpath, but without normalizing the paths when path
+        is already a normalized path below start
+    """
+    prefix = os.path.join(start, '')
+    if path.startswith(prefix):
+        relpath = path[len(prefix):]
+        if relpath and os.path.normpath(relpath) == relpath:
+            return relpath
+    return os.path.relpath(path, start)
+
+
+class PathTemplate(object):
+    """ A path with placeholders on the form '<[A-Z]+>', split up once so that
+        it can be expanded repeatedly without searching the path again, see
+        Deliverer.expand_path
+    """
+
+    PLACEHOLDER = re.compile(r'<([A-Z]+)>')
+
+    def __init__(self, path):
+        self.path = path
+        parts = self.PLACEHOLDER.split(path)
+        # the literal parts of the path are separated by the placeholder names
+        self.literals = parts[0::2]
+        self.attributes = [name.lower() for name in parts[1::2]]
+
+    @classmethod
+    @lru_cache(maxsize=1024)
+    def compile(cls, path):
+        """
+            :param string path: the path to compile
+            :returns: a, possibly cached, PathTemplate for the path
+        """
+        return cls(path)
+
+    def expand(self, resolve):
+        """
+            :param resolve: a function returning the replacement for a
+                placeholder, given its lowercase name
+            :returns: the path with all placeholders replaced
+        """
+        if not self.attributes:
+            return self.path
+        parts = [self.literals[0]]
+        for attribute, literal in zip(self.attributes, self.literals[1:]):
+            parts.append(resolve(attribute))
+            parts.append(literal)
+        return "".join(parts)
+
+
 def _timestamp(days=None):
     """Current date and time (UTC) in ISO format, with millisecond precision.
     Add the specified offset in days, if given.
@@ -70,6 +137,69 @@ class Deliverer(object):
             :param bool no_checksum: if True, skip the checksum computation
             :param string hash_algorithm: algorithm to use for calculating
                 file checksums, defaults to sha1
+            :param list extra_hash_algorithms: additional algorithms to
+                calculate file checksums with in the same pass, each written
+                to its own digest file
+            :param int hash_workers: number of worker processes to use for
+                calculating file checksums, defaults to 1
+            :param string checksum_index: path to a persistent index of
+                computed checksums to consult before hashing a file
+            :param string hash_backend: method for reading files when
+                calculating checksums, see
+                taca_ngi_pipeline.utils.filesystem.HashBackend
+            :param int hash_chunk_size: number of bytes to read at a time
+                when calculating checksums
+            :param bool hash_drop_cache: release the pages of hashed files
+                from the page cache
+            :param int hash_checkpoint_interval: number of bytes to hash
+                between checkpoints of the hash state, which are saved to the
+                checksum_index so that an interrupted checksum computation of
+                a large file can be resumed
+            :param string fast_hash_algorithm: if set, also compute checksums
+                with this fast algorithm when staging, or with the fastest
+                available if set to 'auto', see
+                taca_ngi_pipeline.utils.filesystem.FAST_HASH_ALGORITHMS. These
+                are only used to verify copies within our own infrastructure
+                and are written to a manifest in the log path rather than
+                being delivered. Install the fast_hash extra for the fastest
+                algorithms
+            :param bool verify_staged_copies: re-read the copies made of the
+                staged files, e.g. when hard staging, and verify them against
+                the fast_hash_algorithm checksums, see verify_staged_copy
+            :param int workers: number of samples to stage or deliver
+                concurrently when delivering a project, defaults to 1
+            :param bool incremental_staging: only restage the files that have
+                changed since the previous staging, see stage_delivery
+            :param bool atomic_staging: stage into a separate folder that is
+                published to the staging path when staging is done, see
+                stage_delivery
+            :param bool batch_reports: when delivering a project, create the
+                reports for all samples at once instead of one sample at a
+                time, see ProjectDeliverer.create_sample_reports
+            :param bool async_reports: create the sample reports in the
+                background while staging, see
+                SampleDeliverer.create_report_async
+            :param int rsync_streams: number of concurrent rsync processes to
+                deliver the staged files with, defaults to 1
+            :param float rsync_progress_interval: if set, report the progress
+                of deliveries at this interval in seconds, see
+                transfer_progress
+            :param bool resumable_delivery: keep a journal of the transferred
+                files, so that a failed delivery can be resumed, see
+                do_delivery
+            :param string ssh_control_path: the control socket of a shared
+                ssh connection to the remote host, which the rsync transfers
+                will multiplex their sessions over, see
+                taca_ngi_pipeline.utils.rsync.SshMaster
+            :param bool skip_delivered: do not transfer files that have
+                already been delivered with the same checksum, see
+                do_delivery
+            :param bool verify_delivery: verify the delivered files against
+                their checksums before a sample is marked as delivered,
+                instead of rsync validating the transfer, see
+                verify_delivered_files
+            :param int verify_workers: number of workers to verify the
+                delivered files with, defaults to hash_workers
         """
         # override configuration options with options given on the command line
         self.config = CONFIG.get('deliver', {})
@@ -80,7 +210,31 @@ class Deliverer(object):
         self.projectid = projectid
         self.sampleid = sampleid
         self.hash_algorithm = getattr(self, 'hash_algorithm', 'sha1')
+        self.extra_hash_algorithms = getattr(self, 'extra_hash_algorithms', None) or []
         self.no_checksum = getattr(self, 'no_checksum', False)
+        self.hash_workers = int(getattr(self, 'hash_workers', 1))
+        self.checksum_index = getattr(self, 'checksum_index', None)
+        self.hash_backend = getattr(self, 'hash_backend', 'hashfile')
+        self.hash_chunk_size = getattr(self, 'hash_chunk_size', None)
+        self.hash_drop_cache = getattr(self, 'hash_drop_cache', False)
+        self.hash_checkpoint_interval = getattr(self, 'hash_checkpoint_interval', None)
+        self.fast_hash_algorithm = getattr(self, 'fast_hash_algorithm', None)
+        if self.fast_hash_algorithm:
+            self.fast_hash_algorithm = fs.fast_hash_algorithm(
+                None if self.fast_hash_algorithm == 'auto' else self.fast_hash_algorithm)
+        self.verify_staged_copies = getattr(self, 'verify_staged_copies', False)
+        self.workers = int(getattr(self, 'workers', 1))
+        self.incremental_staging = getattr(self, 'incremental_staging', False)
+        self.atomic_staging = getattr(self, 'atomic_staging', False)
+        self.batch_reports = getattr(self, 'batch_reports', False)
+        self.async_reports = getattr(self, 'async_reports', False)
+        self.rsync_streams = int(getattr(self, 'rsync_streams', 1))
+        self.rsync_progress_interval = getattr(self, 'rsync_progress_interval', None)
+        self.resumable_delivery = getattr(self, 'resumable_delivery', False)
+        self.ssh_control_path = getattr(self, 'ssh_control_path', None)
+        self.skip_delivered = getattr(self, 'skip_delivered', False)
+        self.verify_delivery = getattr(self, 'verify_delivery', False)
+        self.verify_workers = int(getattr(self, 'verify_workers', self.hash_workers))
         self.files_to_deliver = getattr(self, 'files_to_deliver', None)
         self.deliverystatuspath = getattr(self, 'deliverystatuspath', None)
         self.stagingpath = getattr(self, 'stagingpath', None)
@@ -166,7 +320,32 @@ class Deliverer(object):
         dbentry = dbentry or self.db_entry()
         return dbentry.get('delivery_status', 'NOT_DELIVERED')
 
-    def gather_files(self):
+    def reason_not_to_deliver(self, dbentry=None):
+        """ Check the statuses of a sample to decide whether it should be
+            staged or delivered, taking force and ignore_analysis_status into
+            account. This does not update any statuses.
+
+            :params dbentry: a database sample entry to use instead of
+                fetching from db
+            :returns: None if the sample should be delivered, otherwise the
+                reason it should not: 'NOT_ANALYZED', 'DELIVERED',
+                'IN_PROGRESS', 'ABORTED' or 'FRESH'
+        """
+        if self.get_analysis_status(dbentry) != 'ANALYZED' \
+                and not self.force and not self.ignore_analysis_status:
+            return 'NOT_ANALYZED'
+        if not self.force:
+            delivery_status = self.get_delivery_status(dbentry)
+            if delivery_status in ('DELIVERED', 'IN_PROGRESS'):
+                return delivery_status
+        sample_status = self.get_sample_status(dbentry)
+        if sample_status == 'ABORTED':
+            return sample_status
+        if sample_status == 'FRESH' and not self.force:
+            return sample_status
+        return None
+
+    def gather_files(self, known_digests=None):
         """ This method will locate files matching the patterns specified in
             the config and compute the checksum and construct the staging path
             according to the config.
@@ -177,74 +356,662 @@ class Deliverer(object):
             folder or file. File globs will be expanded and folders will be
             traversed to include everything beneath.
 
+            If the reports are being created in the background, see
+            create_report_async, the files matching the report patterns are
+            gathered last, once the reports have been created.
+
+            :param dict known_digests: checksums of files that have not been
+                modified since, see taca_ngi_pipeline.utils.filesystem.gather_files
             :returns: A generator of tuples with source path,
                 destination path and the checksum of the source file
                 (or None if source is a folder)
         """
-        return fs.gather_files([list(map(self.expand_path, file_pattern)) for file_pattern in self.files_to_deliver],
+        patterns = [list(map(self.expand_path, file_pattern)) for file_pattern in self.files_to_deliver]
+        if getattr(self, 'report_process', None) is None:
+            return self._gather_files(patterns, known_digests)
+        report_patterns = [pattern for pattern in patterns if self.is_report_pattern(pattern)]
+        return self._gather_files_after_report(
+            [pattern for pattern in patterns if pattern not in report_patterns], report_patterns, known_digests)
+
+    def _gather_files(self, patterns, known_digests):
+        hash_algorithms = self.hash_algorithms()
+        # checksums and checkpoints are stored through the same connection
+        checksum_index = self.open_checksum_index()
+        return fs.gather_files(patterns,
                                no_checksum=self.no_checksum,
-                               hash_algorithm=self.hash_algorithm)
+                               hash_algorithm=hash_algorithms if len(hash_algorithms) > 1 else self.hash_algorithm,
+                               hash_workers=self.hash_workers,
+                               checksum_index=checksum_index,
+                               hash_backend=self.create_hash_backend(checksum_index),
+                               fast_hash_algorithm=self.fast_hash_algorithm or None,
+                               known_digests=known_digests)
+
+    def _gather_files_after_report(self, patterns, report_patterns, known_digests):
+        for gathered in self._gather_files(patterns, known_digests):
+            yield gathered
+        self.wait_for_report()
+        if report_patterns:
+            for gathered in self._gather_files(report_patterns, known_digests):
+                yield gathered
+
+    def is_report_pattern(self, pattern):
+        """ Check if an expanded pattern from files_to_deliver matches files
+            created by the reports. A pattern is a report pattern if it has
+            the 'report' option set, or otherwise if its source path matches
+            the regular expression report_file_pattern. By default, that only
+            matches the reports created by report_sample and report_aggregate,
+            e.g. <SAMPLEID>_ign_sample_report.html, and not other reports such
+            as those from MultiQC, which would otherwise be gathered last for
+            no reason.
+
+            :param list pattern: an expanded pattern from files_to_deliver
+            :returns: True if the pattern is a report pattern
+        """
+        options = pattern[2] if len(pattern) > 2 else {}
+        if 'report' in options:
+            return bool(options['report'])
+        return re.search(getattr(self, 'report_file_pattern', r'_(ign_sample|aggregate)_report\.[^/]*$'),
+                         pattern[0], re.IGNORECASE) is not None
+
+    def create_hash_backend(self, checksum_index=None):
+        """
+            :param checksum_index: an open ChecksumIndex to save checkpoints
+                to, defaults to the index given by checksum_index
+            :returns: a taca_ngi_pipeline.utils.filesystem.HashBackend set up
+                according to the hash_ options
+        """
+        return fs.HashBackend(
+            self.hash_backend,
+            chunk_size=self.hash_chunk_size,
+            drop_cache=self.hash_drop_cache,
+            checkpoint_index=checksum_index or self.expand_path(self.checksum_index),
+            checkpoint_interval=self.hash_checkpoint_interval)
+
+    def hash_algorithms(self):
+        """
+            :returns: list of the algorithms to calculate file checksums with,
+                starting with hash_algorithm
+        """
+        hash_algorithms = [self.hash_algorithm]
+        for algorithm in self.extra_hash_algorithms:
+            if algorithm not in hash_algorithms:
+                hash_algorithms.append(algorithm)
+        return hash_algorithms
+
+    def open_checksum_index(self):
+        """ Open the persistent checksum index, if one has been configured.
+            The eviction policy is given by the 'checksum_index_max_entries'
+            and 'checksum_index_max_age' (in days) config options and is
+            applied when the index is closed, at most once per
+            ChecksumIndex.EVICTION_INTERVAL. The index has to be on a local
+            disk, see ChecksumIndex.
+
+            :returns: a ChecksumIndex instance or None if no index has been
+                configured or it could not be opened
+        """
+        if not self.checksum_index:
+            return None
+        try:
+            return ChecksumIndex(
+                self.expand_path(self.checksum_index),
+                max_entries=getattr(self, 'checksum_index_max_entries', None),
+                max_age_days=getattr(self, 'checksum_index_max_age', None))
+        except ChecksumIndexError as e:
+            logger.warning("checksum index will not be used - reason: {}".format(e))
+            return None
 
     def stage_delivery(self):
         """ Stage a delivery by symlinking source paths to destination paths
             according to the returned tuples from the gather_files function.
-            Checksums will be written to a digest file in the staging path.
+            Checksums will be written to a digest file per hash algorithm in
+            the staging path.
+            If a fast_hash_algorithm is set, those checksums are written to
+            the manifest given by staging_fast_manifest.
+            The files are walked and hashed ahead of the symlinking, see
+            taca_ngi_pipeline.utils.filesystem.gather_files, while the
+            symlinks, file list and digest files are written here in the
+            order the files were found.
             Failure to stage individual files will be logged as warnings but will
             not terminate the staging.
 
+            If incremental_staging is set, the source, size, modification time
+            and checksums of each staged file are recorded in the manifest
+            given by staging_manifest and the previous manifest is compared to
+            the gathered files: the checksums of unmodified files are reused,
+            only added and changed files are symlinked, files that are no
+            longer gathered are unstaged and the file list and digest files
+            are only replaced if their contents change.
+
+            If atomic_staging is set, the files are staged into the folder
+            given by staging_workdir, a sibling of the staging path, which is
+            merged into the staging path when staging is done. The file list
+            and digest files are published last. The staged files are
+            recorded in the journal given by staging_journal as they are
+            staged, so that an interrupted staging is resumed by the next run
+            instead of starting over. Publishing is only atomic as a whole if
+            the staging path does not exist yet, see publish_staging.
+
             :raises DelivererError: if an unexpected error occurred
         """
-        digestpath = self.staging_digestfile()
+        digestpaths = [(algorithm, self.staging_digestfile(algorithm)) for algorithm in self.hash_algorithms()]
         filelistpath = self.staging_filelist()
-        create_folder(os.path.dirname(digestpath))
+        stagingpath = self.expand_path(self.stagingpath)
+        previous = None
+        if self.incremental_staging:
+            previous = self.read_staging_manifest()
+            if previous is None:
+                logger.info("no previous staging of {} found, all files will be staged".format(str(self)))
+                previous = {}
+        workdir = journaled = None
+        if self.atomic_staging:
+            workdir = self.staging_workdir()
+            journaled = self.read_staging_journal()
+            if journaled is None:
+                # there is nothing to resume, anything left in the work folder is in an unknown state
+                shutil.rmtree(workdir, ignore_errors=True)
+                journaled = {}
+            else:
+                logger.info("resuming staging of {} from {}, {} files were already staged".format(
+                    str(self), workdir, len(journaled)))
+
+        def _workpath(path):
+            # the path to write to, which will be published to path
+            if workdir is None:
+                return path
+            relpath = _relpath(path, stagingpath)
+            if relpath.split(os.sep)[0] == os.pardir:
+                return path
+            return os.path.normpath(os.path.join(workdir, relpath))
+
+        changes = {'added': 0, 'changed': 0, 'unchanged': 0, 'removed': 0}
+        manifest = [] if self.incremental_staging else None
+        # the files are written next to their final path and put in place when staging is done
+        outputs = []
+        create_folder(os.path.dirname(_workpath(digestpaths[0][1])))
         try:
-            with open(digestpath, 'w') as dh, open(filelistpath, 'w') as fh:
+            with ExitStack() as stack:
+                def _open(path):
+                    outputs.append(path)
+                    return stack.enter_context(open("{}.tmp".format(_workpath(path)), 'w'))
+
+                fh = _open(filelistpath)
+                dhs = [(algorithm, _open(digestpath)) for algorithm, digestpath in digestpaths]
+                if self.fast_hash_algorithm:
+                    create_folder(os.path.dirname(self.staging_fast_manifest()))
+                    dhs.append((self.fast_hash_algorithm, _open(self.staging_fast_manifest())))
+                journal = None
+                if workdir is not None:
+                    create_folder(os.path.dirname(self.staging_journal()))
+                    journal = stack.enter_context(open(self.staging_journal(), 'a'))
                 agent = transfer.SymlinkAgent(None, None, relative=True)
-                for src, dst, digest in self.gather_files():
-                    agent.src_path = src
-                    agent.dest_path = dst
-                    try:
-                        agent.transfer()
-                    except (transfer.TransferError, transfer.SymlinkError) as e:
-                        logger.warning("failed to stage file '{}' when "
-                                       "delivering {} - reason: {}".format(src, str(self), e))
-
-                    fpath = os.path.relpath(dst, self.expand_path(self.stagingpath))
+                known_digests = dict(
+                    (entry['src'], (entry['size'], entry['mtime_ns'], entry['digests']))
+                    for entries in (previous, journaled) if entries
+                    for entry in entries.values() if entry['digests']) or None
+                for src, dst, digest in self.gather_files(known_digests=known_digests):
+                    fpath = _relpath(dst, stagingpath)
+                    if digest is not None and not isinstance(digest, dict):
+                        digest = {self.hash_algorithm: digest}
+                    st = None
+                    # the size and modification time are only needed to compare to earlier stagings
+                    if manifest is not None or journal is not None:
+                        try:
+                            st = os.stat(src)
+                        except OSError:
+                            pass
+                    entry = {'path': fpath,
+                             'src': src,
+                             'size': st.st_size if st else None,
+                             'mtime_ns': st.st_mtime_ns if st else None,
+                             'digests': digest}
+                    if manifest is not None:
+                        manifest.append(entry)
+                    if previous is not None:
+                        previous_entry = previous.pop(fpath, None)
+                        if previous_entry is not None and st is not None and \
+                                self._staged_unchanged(previous_entry, entry, dst):
+                            changes['unchanged'] += 1
+                        else:
+                            changes['added' if previous_entry is None else 'changed'] += 1
+                            previous_entry = None
+                    else:
+                        previous_entry = None
+                        changes['added'] += 1
+                    if previous_entry is None:
+                        workdst = _workpath(dst)
+                        journaled_entry = journaled.pop(fpath, None) if journaled else None
+                        if journaled_entry is None or st is None or \
+                                not self._staged_unchanged(journaled_entry, entry, workdst):
+                            agent.src_path = src
+                            agent.dest_path = workdst
+                            try:
+                                agent.transfer()
+                            except (transfer.TransferError, transfer.SymlinkError) as e:
+                                logger.warning("failed to stage file '{}' when "
+                                               "delivering {} - reason: {}".format(src, str(self), e))
+                            else:
+                                if journal is not None:
+                                    journal.write(u"{}\n".format(json.dumps(entry)))
+                                    journal.flush()
+
                     fh.write(u"{}\n".format(fpath))
                     if digest is not None:
-                        dh.write(u"{}  {}\n".format(digest, fpath))
-                # finally, include the digestfile in the list of files to deliver
-                fh.write(u"{}\n".format(os.path.basename(digestpath)))
-        except (IOError, fs.FileNotFoundException, fs.PatternNotMatchedException) as e:
+                        for algorithm, dh in dhs:
+                            if algorithm in digest:
+                                dh.write(u"{}  {}\n".format(digest[algorithm], fpath))
+                # finally, include the digestfiles in the list of files to deliver
+                for _, digestpath in digestpaths:
+                    fh.write(u"{}\n".format(os.path.basename(digestpath)))
+            for path in outputs:
+                tmppath = "{}.tmp".format(_workpath(path))
+                if previous is not None and os.path.exists(path) and filecmp.cmp(tmppath, path, shallow=False):
+                    os.unlink(tmppath)
+                else:
+                    os.rename(tmppath, _workpath(path))
+            if workdir is not None:
+                # files staged by an interrupted run that are no longer gathered
+                for fpath in (journaled or {}):
+                    self._unstage(fpath, workdir)
+                self.publish_staging(workdir, stagingpath, [_workpath(path) for path in outputs])
+            # remove the files that were staged previously but are no longer gathered
+            for fpath in (previous or {}):
+                self._unstage(fpath, stagingpath)
+                changes['removed'] += 1
+            if manifest is not None:
+                self.write_staging_manifest(manifest)
+            if workdir is not None:
+                os.unlink(self.staging_journal())
+        except (IOError, OSError, fs.FileNotFoundException, fs.PatternNotMatchedException) as e:
+            for path in outputs:
+                if os.path.exists("{}.tmp".format(_workpath(path))):
+                    os.unlink("{}.tmp".format(_workpath(path)))
             raise DelivererError(
                 "failed to stage delivery - reason: {}".format(e))
+        if previous is not None:
+            logger.info("staging of {} updated: {added} added, {changed} changed, {removed} removed and {unchanged} "
+                        "unchanged files".format(str(self), **changes))
         return True
 
+    def publish_staging(self, workdir, stagingpath, last=None):
+        """ Move the files staged in a work folder into the staging path.
+            Folders that do not exist in the staging path are moved with a
+            single rename, existing folders are merged and existing files
+            are replaced, so each file is published atomically. The work
+            folder is removed afterwards.
+
+            Only the publishing of a new staging path is atomic as a whole.
+            When the staging path exists, e.g. when restaging or when it is
+            shared by the samples of a project, a reader can see a mix of
+            old and new files until publishing is done, and a crash part way
+            through leaves the rest of the files in the work folder. The
+            staging path cannot be swapped as a whole, since it also holds
+            the files staged for other samples. The file list and digest
+            files are therefore passed as last, so that they are only
+            replaced once all the files they list are in place.
+
+            :param string workdir: the folder the files were staged in
+            :param string stagingpath: the staging path to publish to
+            :param list last: paths in the work folder to publish after
+                everything else, e.g. the file list
+        """
+        last = last or []
+        self._publish(workdir, stagingpath, set(last))
+        for path in last:
+            # unless the work folder was published as a whole
+            if os.path.lexists(path):
+                os.rename(path, os.path.join(stagingpath, os.path.relpath(path, workdir)))
+        # what is left are folders that were merged
+        shutil.rmtree(workdir, ignore_errors=True)
+        logger.debug("published staging of {} from {} to {}".format(str(self), workdir, stagingpath))
+
+    def _publish(self, src, dst, skip):
+        if not os.path.lexists(dst) and not any(path.startswith(src + os.sep) for path in skip):
+            create_folder(os.path.dirname(dst))
+            try:
+                os.rename(src, dst)
+                return
+            except OSError:
+                # the folder may have been published concurrently by another sample
+                if not os.path.isdir(dst):
+                    raise
+        create_folder(dst)
+        for name in os.listdir(src):
+            srcpath = os.path.join(src, name)
+            if srcpath in skip:
+                continue
+            if os.path.isdir(srcpath) and not os.path.islink(srcpath):
+                self._publish(srcpath, os.path.join(dst, name), skip)
+            else:
+                os.rename(srcpath, os.path.join(dst, name))
+
+    @staticmethod
+    def _staged_unchanged(previous_entry, entry, dst):
+        # the source is unmodified and the staged symlink still points to it
+        if any(previous_entry.get(key) != entry[key] for key in ('src', 'size', 'mtime_ns')):
+            return False
+        if entry['digests'] is not None and previous_entry.get('digests') != entry['digests']:
+            return False
+        try:
+            return os.readlink(dst) == os.path.relpath(entry['src'], os.path.dirname(dst))
+        except OSError:
+            return False
+
+    def _unstage(self, fpath, stagingpath):
+        # remove a staged symlink and any folders left empty by that
+        dst = os.path.join(stagingpath, fpath)
+        if not os.path.islink(dst):
+            return
+        logger.debug("unstaging {} from {}".format(fpath, str(self)))
+        os.unlink(dst)
+        parent = os.path.dirname(dst)
+        while os.path.abspath(parent) != os.path.abspath(stagingpath):
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+
+    def read_staging_manifest(self):
+        """
+            :returns: a dict with the entries of the manifest written by the
+                previous staging, keyed on the staged path, or None if there
+                is no readable manifest
+        """
+        manifestpath = self.staging_manifest()
+        try:
+            with open(manifestpath, 'r') as fh:
+                return dict((entry['path'], entry) for entry in json.load(fh)['files'])
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            if os.path.exists(manifestpath):
+                logger.warning("could not read staging manifest {}: {}".format(manifestpath, e))
+            return None
+
+    def read_staging_journal(self):
+        """
+            :returns: a dict with the files staged by an interrupted staging
+                that can be resumed, keyed on the staged path, or None if
+                there is nothing to resume
+        """
+        journalpath = self.staging_journal()
+        if not os.path.isdir(self.staging_workdir()) or not os.path.exists(journalpath):
+            return None
+        entries = {}
+        with open(journalpath, 'r') as fh:
+            for line in fh:
+                try:
+                    entry = json.loads(line)
+                    entries[entry['path']] = entry
+                except (ValueError, KeyError, TypeError):
+                    # the last line may be incomplete if the staging was interrupted
+                    continue
+        return entries
+
+    def write_staging_manifest(self, entries):
+        """ Write the manifest of staged files
+
+            :param list entries: a dict for each staged file with the staged
+                path, source path, size, modification time in ns and checksums
+        """
+        manifestpath = self.staging_manifest()
+        create_folder(os.path.dirname(manifestpath))
+        with open("{}.tmp".format(manifestpath), 'w') as fh:
+            json.dump({'stagingpath': self.expand_path(self.stagingpath), 'files': entries}, fh)
+        os.rename("{}.tmp".format(manifestpath), manifestpath)
+
     def do_delivery(self):
-        """ Deliver the staged delivery folder using rsync
+        """ Deliver the staged delivery folder using rsync. If rsync_streams
+            is larger than 1, the files are split into that many shards with
+            roughly the same number of bytes, which are transferred by
+            concurrent rsync processes, see do_sharded_delivery.
+
+            If resumable_delivery is set, each transferred file is recorded in
+            the journal given by transfer_journal and partially transferred
+            files are kept by rsync. If the delivery fails, the next attempt
+            will only send the files that have not been transferred, or have
+            been modified since. The journal is removed when the delivery has
+            succeeded.
+
+            If skip_delivered is set, the files that are listed with the same
+            checksum in the digest files of the staging and of the previous
+            delivery are not transferred again, see undelivered_files. After
+            a successful delivery to a remote host, a copy of the digest file
+            is kept for this, see record_delivered_digests.
+
+            If verify_delivery is set, the transfer is not validated here but
+            by verify_delivered_files when delivering a sample.
+
             :returns: True if delivery was successful, False if unsuccessful
             :raises DelivererRsyncError: if an exception occurred during
                 transfer
         """
-        agent = transfer.RsyncAgent(
+        transfer_log = self.transfer_log()
+        create_folder(os.path.dirname(transfer_log))
+        filelist = self.staging_filelist()
+        paths = None
+        journal = None
+        if self.skip_delivered:
+            paths = self.undelivered_files(rsync.read_file_list(filelist))
+        if self.resumable_delivery:
+            journal = rsync.TransferJournal(self.transfer_journal(), self.expand_path(self.stagingpath))
+            paths, skipped = journal.pending(
+                rsync.read_file_list(filelist) if paths is None else paths, transferred=self._is_delivered)
+            if skipped:
+                logger.info("resuming delivery of {}, skipping {} bytes that have already been transferred".format(
+                    str(self), skipped))
+        if paths is not None:
+            filelist = "{}.lst".format(transfer_log)
+            rsync.write_file_list(filelist, paths)
+        progress = self.transfer_progress(transfer_log, filelist=filelist)
+        try:
+            if self.rsync_streams > 1:
+                status = self.do_sharded_delivery(transfer_log, filelist=filelist, progress=progress, journal=journal)
+            else:
+                agent = self.rsync_agent(
+                    filelist, validate=not self.verify_delivery, progress=progress, journal=journal)
+                try:
+                    status = agent.transfer(transfer_log=transfer_log)
+                except transfer.TransferError as e:
+                    raise DelivererRsyncError(e)
+        except BaseException:
+            if progress is not None:
+                progress.finish('failed')
+            raise
+        finally:
+            if paths is not None:
+                os.unlink(filelist)
+        if progress is not None:
+            progress.finish('done' if status else 'failed validation')
+        if status and journal is not None:
+            journal.clear()
+        if status and not self.verify_delivery:
+            self.record_delivered_digests()
+        return status
+
+    def undelivered_files(self, paths):
+        """ Compare the checksums of the staged files with the digest file
+            of the previous delivery and leave out the files that have
+            already been delivered with the same checksum. A file is only left
+            out if it also exists at the destination with the size of the
+            staged file.
+
+            The destination can not be read when delivering to a remote host.
+            The checksums are then compared to the local copy of the digest
+            file kept from the previous successful delivery, see
+            record_delivered_digests, and files that have been removed from
+            the remote host since will not be noticed.
+
+            :param list paths: the paths to deliver, relative to the staging
+                path
+            :returns: a list of the paths that need to be transferred
+        """
+        if getattr(self, 'remote_host', None) is not None:
+            delivered_digestfile = self.delivered_digest_record()
+        else:
+            delivered_digestfile = self.delivered_digestfile()
+        try:
+            staged = fs.read_digest_file(self.staging_digestfile())
+            delivered = fs.read_digest_file(delivered_digestfile)
+        except (IOError, OSError):
+            logger.info("no previous delivery of {} found, all files will be transferred".format(str(self)))
+            return paths
+        stagingpath = self.expand_path(self.stagingpath)
+        pending = []
+        for fpath in paths:
+            digest = staged.get(fpath)
+            try:
+                if digest is not None and delivered.get(fpath) == digest and \
+                        self._is_delivered(fpath, os.path.getsize(os.path.join(stagingpath, fpath))):
+                    continue
+            except OSError:
+                pass
+            pending.append(fpath)
+        logger.info("skipping {} of {} files of {} that have already been delivered".format(
+            len(paths) - len(pending), len(paths), str(self)))
+        return pending
+
+    def record_delivered_digests(self):
+        """ Keep a copy of the staged digest file after a successful delivery
+            to a remote host, where the delivered digest file can not be
+            read, see undelivered_files. Nothing is recorded for a local
+            destination.
+
+            :returns: the path to the copy or None if nothing was recorded
+        """
+        if getattr(self, 'remote_host', None) is None:
+            return None
+        record = self.delivered_digest_record()
+        try:
+            create_folder(os.path.dirname(record))
+            shutil.copyfile(self.staging_digestfile(), "{}.tmp".format(record))
+            os.rename("{}.tmp".format(record), record)
+        except (IOError, OSError) as e:
+            logger.warning("could not record the delivered checksums of {}: {}".format(str(self), e))
+            return None
+        return record
+
+    def _is_delivered(self, fpath, size):
+        # the transferred files can only be checked on a local destination
+        if getattr(self, 'remote_host', None) is not None:
+            return True
+        try:
+            return os.path.getsize(os.path.join(self.expand_path(self.deliverypath), fpath)) == size
+        except OSError:
+            return False
+
+    def transfer_progress(self, transfer_log, filelist=None):
+        """ If rsync_progress_interval is set, the progress of the transfer
+            is logged at that interval, in seconds, and written to a JSON
+            status file next to the transfer log, see
+            taca_ngi_pipeline.utils.rsync.TransferProgress
+
+            :param string transfer_log: the prefix of the transfer log files
+            :param string filelist: path to the list of files to transfer,
+                defaults to staging_filelist
+            :returns: a TransferProgress for the delivery, or None if
+                rsync_progress_interval is not set
+        """
+        if not self.rsync_progress_interval:
+            return None
+        paths = rsync.read_file_list(filelist or self.staging_filelist())
+        return rsync.TransferProgress(
+            str(self),
+            statusfile="{}.progress.json".format(transfer_log),
+            interval=float(self.rsync_progress_interval),
+            total_bytes=sum(rsync.file_sizes(paths, self.expand_path(self.stagingpath))),
+            total_files=len(paths))
+
+    def rsync_agent(self, filelist, validate=True, progress=None, stream=0, journal=None):
+        """
+            :param string filelist: path to the list of files to transfer
+            :param bool validate: validate the transferred files against the
+                delivered digest file
+            :param progress: a taca_ngi_pipeline.utils.rsync.TransferProgress
+                to report the progress of the transfer to, if any
+            :param stream: identifies the transfer to the progress
+            :param journal: a taca_ngi_pipeline.utils.rsync.TransferJournal to
+                record the transferred files in, if any. Partially
+                transferred files will then be kept for the next attempt.
+            :returns: a taca.utils.transfer.RsyncAgent for transferring the
+                files in filelist from the staging path to the delivery path
+        """
+        opts = {
+            '--files-from': [filelist],
+            '--copy-links': None,
+            '--recursive': None,
+            '--perms': None,
+            '--chmod': 'ug+rwX,o-rwx',
+            '--verbose': None,
+            '--exclude': ["*rsync.out", "*rsync.err"]
+        }
+        kwargs = {}
+        agent_class = transfer.RsyncAgent
+        if progress is not None or journal is not None:
+            agent_class = rsync.ProgressRsyncAgent
+            kwargs = {'progress': progress, 'stream': stream, 'journal': journal}
+        if journal is not None:
+            opts['--partial-dir'] = rsync.PARTIAL_DIR
+        if self.ssh_control_path is not None and getattr(self, 'remote_host', None) is not None:
+            opts['--rsh'] = rsync.ssh_command(self.ssh_control_path)
+        return agent_class(
             self.expand_path(self.stagingpath),
             dest_path=self.expand_path(self.deliverypath),
             digestfile=self.delivered_digestfile(),
             remote_host=getattr(self, 'remote_host', None),
             remote_user=getattr(self, 'remote_user', None),
+            validate=validate,
             log=logger,
-            opts={
-                '--files-from': [self.staging_filelist()],
-                '--copy-links': None,
-                '--recursive': None,
-                '--perms': None,
-                '--chmod': 'ug+rwX,o-rwx',
-                '--verbose': None,
-                '--exclude': ["*rsync.out", "*rsync.err"]
-            })
-        create_folder(os.path.dirname(self.transfer_log()))
+            opts=opts,
+            **kwargs)
+
+    def do_sharded_delivery(self, transfer_log, filelist=None, progress=None, journal=None):
+        """ Deliver the staged files with rsync_streams concurrent rsync
+            processes, each transferring a shard of the file list. The logs
+            of the processes are merged into the transfer log and the
+            delivered files are validated once all shards have been
+            transferred, unless verify_delivery is set.
+
+            :param string transfer_log: the prefix of the transfer log files
+            :param string filelist: path to the list of files to transfer,
+                defaults to staging_filelist
+            :param progress: a taca_ngi_pipeline.utils.rsync.TransferProgress
+                to report the progress of the transfers to, if any
+            :param journal: a taca_ngi_pipeline.utils.rsync.TransferJournal to
+                record the transferred files in, if any
+            :returns: True if delivery was successful, False if unsuccessful
+            :raises DelivererRsyncError: if an exception occurred during
+                transfer of any of the shards
+        """
+        stagingpath = self.expand_path(self.stagingpath)
+        shards = rsync.shard_files(
+            rsync.read_file_list(filelist or self.staging_filelist()), stagingpath, self.rsync_streams)
+        logger.info("delivering {} in {} rsync streams of {} bytes".format(
+            str(self), len(shards), ", ".join(str(nbytes) for nbytes, _ in shards)))
+        prefixes = ["{}.shard{}".format(transfer_log, n) for n in range(len(shards))]
+        filelists = ["{}.lst".format(prefix) for prefix in prefixes]
         try:
-            return agent.transfer(transfer_log=self.transfer_log())
+            for shardlist, (_, paths) in zip(filelists, shards):
+                rsync.write_file_list(shardlist, paths)
+            with ThreadPoolExecutor(max_workers=len(shards)) as pool:
+                futures = [pool.submit(
+                    self.rsync_agent(shardlist, validate=False, progress=progress, stream=n, journal=journal).transfer,
+                    transfer_log=prefix) for n, (shardlist, prefix) in enumerate(zip(filelists, prefixes))]
+                wait(futures)
+        finally:
+            rsync.merge_logs(prefixes, transfer_log)
+            for shardlist in filelists:
+                if os.path.exists(shardlist):
+                    os.unlink(shardlist)
+        errors = [(n, future.exception()) for n, future in enumerate(futures) if future.exception() is not None]
+        for n, e in errors:
+            logger.error("rsync stream {} of {} failed: {}".format(n, str(self), e))
+        if errors:
+            raise DelivererRsyncError("{} of {} rsync streams failed, first error: {}".format(
+                len(errors), len(shards), errors[0][1]))
+        if self.verify_delivery:
+            return True
+        agent = self.rsync_agent(self.staging_filelist())
+        try:
+            return agent.validate_transfer()
         except transfer.TransferError as e:
             raise DelivererRsyncError(e)
 
@@ -257,14 +1024,144 @@ class Deliverer(object):
                 self.deliverypath,
                 os.path.basename(self.staging_digestfile())))
 
-    def staging_digestfile(self):
+    def delivered_digest_record(self):
+        """
+            :returns: path to the local copy of the digest file of the last
+                successful delivery to a remote host
+        """
+        return self.expand_path(os.path.join(
+            self.logpath, "{}.delivered".format(os.path.basename(self.staging_digestfile()))))
+
+    def staging_digestfile(self, hash_algorithm=None):
         """
+            :param string hash_algorithm: the algorithm of the checksums,
+                defaults to hash_algorithm
             :returns: path to the file with checksums after staging
         """
         return self.expand_path(
             os.path.join(
                 self.stagingpath,
-                "{}.{}".format(self.sampleid, self.hash_algorithm)))
+                "{}.{}".format(self.sampleid, hash_algorithm or self.hash_algorithm)))
+
+    def staging_manifest(self):
+        """
+            :returns: path to the manifest of the staged files
+        """
+        return self.expand_path(os.path.join(
+            self.logpath, "{}.staging_manifest.json".format(self.sampleid)))
+
+    def transfer_journal(self):
+        """
+            :returns: path to the journal of the files transferred when
+                resumable_delivery is set
+        """
+        return self.expand_path(os.path.join(self.logpath, "{}.transfer_journal".format(self.sampleid)))
+
+    def staging_workdir(self):
+        """
+            :returns: path to the folder to stage into when atomic_staging is
+                set, next to the staging path
+        """
+        stagingpath = os.path.normpath(self.expand_path(self.stagingpath))
+        return os.path.join(os.path.dirname(stagingpath), ".{}.{}.staging".format(
+            os.path.basename(stagingpath), self.sampleid))
+
+    def staging_journal(self):
+        """
+            :returns: path to the journal of the files staged into
+                staging_workdir
+        """
+        return self.expand_path(os.path.join(self.logpath, "{}.staging_journal".format(self.sampleid)))
+
+    def staging_fast_manifest(self):
+        """
+            :returns: path to the file with the fast_hash_algorithm checksums
+                of the staged files
+        """
+        return self.expand_path(os.path.join(
+            self.logpath, "{}.staged.{}".format(self.sampleid, self.fast_hash_algorithm)))
+
+    def verify_staged_copy(self, root_path, relpaths=None):
+        """ Verify a copy of the staged files against the fast checksums
+            recorded in the manifest when staging. This re-reads every file
+            in the copy, so it is only done if verify_staged_copies is set
+
+            :param string root_path: the path the copy was made to, which
+                corresponds to the staging path
+            :param list relpaths: only verify these paths relative to
+                root_path, e.g. the files that were copied rather than
+                linked, defaults to all files in the manifest
+            :returns: the number of files verified or None if the copy was
+                not verified
+            :raises DelivererError: if any file in the copy is missing or
+                differs from the staged file
+        """
+        if not self.verify_staged_copies:
+            return None
+        if not self.fast_hash_algorithm:
+            logger.warning("no fast_hash_algorithm is set for {}, the copy in {} will not be verified".format(
+                str(self), root_path))
+            return None
+        manifestpath = self.staging_fast_manifest()
+        if not os.path.exists(manifestpath):
+            logger.warning("no {} manifest found for {}, the copy in {} will not be verified".format(
+                self.fast_hash_algorithm, str(self), root_path))
+            return None
+        verified, failed = fs.verify_digest_file(
+            manifestpath, root_path, self.fast_hash_algorithm, hash_backend=self.create_hash_backend(),
+            relpaths=relpaths)
+        for relpath, reason in failed:
+            logger.error("{} in {} failed verification: {}".format(relpath, root_path, reason))
+        if failed:
+            raise DelivererError("{} of {} files failed verification in {}".format(
+                len(failed), len(failed) + verified, root_path))
+        logger.info("verified {} files of {} in {}".format(verified, str(self), root_path))
+        return verified
+
+    def verify_delivered_files(self):
+        """ Verify the delivered files against the delivered digest file by
+            computing their checksums at the destination, with verify_workers
+            concurrent workers. On a remote host, the checksums are computed
+            by commands run over ssh, see
+            taca_ngi_pipeline.utils.rsync.verify_remote_digest_file
+
+            :returns: the number of files verified or None if no checksums
+                were delivered
+            :raises DelivererError: if any delivered file is missing or
+                differs from the staged file
+        """
+        deliverypath = self.expand_path(self.deliverypath)
+        remote_host = getattr(self, 'remote_host', None)
+        # the delivered digest file is a copy of the staged one
+        digestfile = self.staging_digestfile() if remote_host is not None else self.delivered_digestfile()
+        if not os.path.exists(digestfile):
+            logger.warning("no checksums found for {}, the delivered files will not be verified".format(str(self)))
+            return None
+        logger.info("verifying the delivered files of {} using {} workers".format(str(self), self.verify_workers))
+        if remote_host is not None:
+            try:
+                verified, failed = rsync.verify_remote_digest_file(
+                    digestfile,
+                    remote_host,
+                    deliverypath,
+                    self.hash_algorithm,
+                    remote_user=getattr(self, 'remote_user', None),
+                    control_path=self.ssh_control_path,
+                    workers=self.verify_workers)
+            except transfer.TransferError as e:
+                raise DelivererError("the delivered files of {} could not be verified: {}".format(str(self), e))
+        else:
+            verified, failed = fs.verify_digest_file(
+                digestfile, deliverypath, self.hash_algorithm,
+                hash_backend=self.create_hash_backend(), workers=self.verify_workers)
+        for relpath, reason in failed:
+            logger.error("{} in {} failed verification: {}".format(relpath, deliverypath, reason))
+        if failed:
+            raise DelivererError("{} of {} files failed verification in {}".format(
+                len(failed), len(failed) + verified, deliverypath))
+        logger.info("verified {} delivered files of {}".format(verified, str(self)))
+        self.record_delivered_digests()
+        return verified
 
     def staging_filelist(self):
         """
@@ -301,27 +1198,42 @@ class Deliverer(object):
             If the supplied path does not contain any placeholders or is None,
             it will be returned unchanged.
 
+            The placeholders of a path are only looked up once, see
+            PathTemplate, and the expanded paths are cached together with
+            the expanded values of the attributes they were built from, so
+            changing an attribute gives a new expansion.
+
             :params string path: the path to expand
             :returns: the supplied path will all placeholders substituted with
                 the corresponding instance attributes
             :raises DelivererError: if a corresponding attribute for a
                 placeholder could not be found
         """
+        if not isinstance(path, string_types):
+            return path
+        template = PathTemplate.compile(path)
         try:
-            m = re.search(r'(<[A-Z]+>)', path)
+            values = tuple(
+                self.expand_path(getattr(self, attribute))
+                for attribute in template.attributes)
+        except AttributeError as e:
+            raise DelivererError(
+                "the path '{}' could not be expanded - reason: {}".format(
+                    path, e))
+        expanded_paths = self.__dict__.setdefault('_expanded_paths', {})
+        key = (path, values)
+        try:
+            return expanded_paths[key]
+        except KeyError:
+            pass
         except TypeError:
-            return path
-        else:
-            if m is None:
-                return path
-            try:
-                expr = m.group(0)
-                return self.expand_path(
-                    path.replace(expr, getattr(self, str(expr[1:-1]).lower())))
-            except AttributeError as e:
-                raise DelivererError(
-                    "the path '{}' could not be expanded - reason: {}".format(
-                        path, e))
+            # an unhashable attribute value, don't cache the expansion
+            key = None
+        expanded = template.expand(
+            dict(zip(template.attributes, values)).__getitem__)
+        if key is not None:
+            expanded_paths[key] = expanded
+        return expanded
 
     def aggregate_meta_info(self):
         """ A method to collect meta info about delivered files (like size, md5 value)
@@ -339,11 +1251,12 @@ class Deliverer(object):
             proj_obj = sdb.get_entry(self.projectname)
             meta_info_dict = proj_obj.get("staged_files", {})
             staging_path = self.expand_path(self.stagingpath)
-            hash_files = glob.glob(os.path.join(staging_path, "{}.{}".format(self.sampleid, self.hash_algorithm)))
             curr_time = datetime.datetime.now().__str__()
-            for hash_file in hash_files:
-                hash_dict = fs.parse_hash_file(hash_file, curr_time, hash_algorithm=self.hash_algorithm, root_path=staging_path, files_filter=['.fastq', '.bam'])
-                meta_info_dict = fs.merge_dicts(meta_info_dict, hash_dict)
+            for hash_algorithm in self.hash_algorithms():
+                hash_files = glob.glob(os.path.join(staging_path, "{}.{}".format(self.sampleid, hash_algorithm)))
+                for hash_file in hash_files:
+                    hash_dict = fs.parse_hash_file(hash_file, curr_time, hash_algorithm=hash_algorithm, root_path=staging_path, files_filter=['.fastq', '.bam'])
+                    meta_info_dict = fs.merge_dicts(meta_info_dict, hash_dict)
             proj_obj["staged_files"] = meta_info_dict
             sdb.save_db_doc(proj_obj)
             logger.info("Updated metainfo for sample {} in project {} with id {} in StatusDB".format(self.sampleid, self.projectid, proj_obj.get("_id")))
@@ -474,11 +1387,13 @@ class ProjectDeliverer(Deliverer):
                 return True
             # right now, don't catch any errors since we're assuming any thrown
             # errors needs to be handled by manual intervention
-            status = True
-            for sampleid in [sentry['sampleid'] for sentry in db.project_sample_entries(
-                    db.dbcon(), self.projectid).get('samples', [])]:
-                st = SampleDeliverer(self.projectid, sampleid).deliver_sample()
-                status = (status and st)
+            sampleentries = db.project_sample_entries(db.dbcon(), self.projectid).get('samples', [])
+            sampleids = [sentry['sampleid'] for sentry in sampleentries]
+            if self.batch_reports and getattr(self, 'report_sample', None) and getattr(self, 'report_aggregate', None):
+                self.create_sample_reports(sampleentries)
+                status = self.deliver_samples(sampleids, create_report=False)
+            else:
+                status = self.deliver_samples(sampleids)
             #If sthlm, generate xml files
             if self.stage_only and getattr(self, 'save_meta_info', False):
                 self.generate_xml_and_manifest_files()
@@ -519,6 +1434,102 @@ class ProjectDeliverer(Deliverer):
         except (db.DatabaseError, DelivererInterruptedError, Exception):
             raise
 
+    def create_sample_reports(self, sampleentries):
+        """ Create the sample reports for all samples that are ready to be
+            delivered with a single call to report_sample, followed by a
+            single aggregate report where the delivery of those samples is
+            estimated to 0.5 days ahead. This replaces the two system calls
+            per sample made by SampleDeliverer.create_report when batch_reports
+            is set.
+
+            An error with the reports will not abort the delivery, so it is
+            logged as a warning.
+
+            :param list sampleentries: the database entries of the samples
+            :returns: the ids of the samples that reports were created for
+        """
+        sampleids = [sentry['sampleid'] for sentry in sampleentries if self.sample_ready_for_delivery(sentry)]
+        if not sampleids:
+            return []
+        logprefix = os.path.abspath(
+            self.expand_path(os.path.join(self.logpath, self.projectid)))
+        try:
+            if not create_folder(os.path.dirname(logprefix)):
+                logprefix = None
+        except AttributeError:
+            logprefix = None
+        logger.info("creating sample reports for {} samples of {}".format(len(sampleids), str(self)))
+        try:
+            with chdir(self.expand_path(self.reportpath)):
+                cl = self.report_sample.split(' ')
+                cl.append("--samples")
+                cl.extend(sampleids)
+                call_external_command(
+                    cl,
+                    with_log_files=(logprefix is not None),
+                    prefix="{}_samples".format(logprefix))
+                expected = "{}(expected)".format(_timestamp(days=0.5))
+                cl = self.report_aggregate.split(' ')
+                cl.extend([
+                    "--samples_extra",
+                    json.dumps(dict((sampleid, {"delivered": expected}) for sampleid in sampleids))
+                ])
+                call_external_command(
+                    cl,
+                    with_log_files=(logprefix is not None),
+                    prefix="{}_aggregate".format(logprefix))
+        except Exception as e:
+            logger.warning(
+                "failed to create sample reports for {}, reason: {}".format(
+                    self, e))
+        return sampleids
+
+    def sample_ready_for_delivery(self, sampleentry):
+        """ Check a sample entry against the criteria SampleDeliverer.deliver_sample
+            uses to decide whether to deliver a sample, see reason_not_to_deliver
+
+            :param dict sampleentry: the database entry of the sample
+            :returns: True if the sample would be staged or delivered
+        """
+        return self.reason_not_to_deliver(sampleentry) is None
+
+    def deliver_samples(self, sampleids, **kwargs):
+        """ Deliver the samples in the project. If workers is larger than 1,
+            that many samples are staged or delivered concurrently, each in a
+            separate process so that they have their own signal handlers and
+            working directory. The processes are forked, so they inherit the
+            configuration of this process.
+
+            If a sample fails, the samples that have not been started yet are
+            left alone, like in a serial delivery, and the error of the first
+            failed sample is raised once the running samples have finished.
+
+            :param list sampleids: the ids of the samples to deliver
+            :param kwargs: passed on to SampleDeliverer.deliver_sample
+            :returns: True if all samples were delivered successfully, False
+                if any sample was not ready to be delivered
+        """
+        status = True
+        if self.workers <= 1 or len(sampleids) <= 1:
+            for sampleid in sampleids:
+                st = SampleDeliverer(self.projectid, sampleid).deliver_sample(**kwargs)
+                status = (status and st)
+            return status
+        logger.info("delivering {} samples of {} using {} workers".format(len(sampleids), str(self), self.workers))
+        pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('fork'))
+        try:
+            futures = [pool.submit(_deliver_sample, self.projectid, sampleid, **kwargs) for sampleid in sampleids]
+            wait(futures, return_when=FIRST_EXCEPTION)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+        for sampleid, future in zip(sampleids, futures):
+            if future.cancelled():
+                logger.warning("{}:{} was not delivered because of an earlier failure".format(self.projectid, sampleid))
+                continue
+            st = future.result()
+            status = (status and st)
+        return status
+
     def generate_xml_and_manifest_files(self):
         logger.info("Fetching information for xml generation")
         with open(os.getenv('STATUS_DB_CONFIG'), 'r') as db_cred_file:
@@ -557,11 +1568,14 @@ class ProjectMiscDeliverer(Deliverer):
             **kwargs)
         self.files_to_deliver = getattr(self, 'misc_files_to_deliver', None)
 
-    def staging_digestfile(self):
+    def staging_digestfile(self, hash_algorithm=None):
         """
+            :param string hash_algorithm: the algorithm of the checksums,
+                defaults to hash_algorithm
             :returns: path to the file with checksums for miscellaneous files after staging
         """
-        return self.expand_path(os.path.join(self.stagingpath, "miscellaneous.{}".format(self.hash_algorithm)))
+        return self.expand_path(os.path.join(
+            self.stagingpath, "miscellaneous.{}".format(hash_algorithm or self.hash_algorithm)))
 
     def staging_filelist(self):
         """
@@ -569,6 +1583,43 @@ class ProjectMiscDeliverer(Deliverer):
         """
         return self.expand_path(os.path.join(self.stagingpath, "miscellaneous.lst"))
 
+    def staging_manifest(self):
+        """
+            :returns: path to the manifest of the staged miscellaneous files
+        """
+        return self.expand_path(os.path.join(self.logpath, "miscellaneous.staging_manifest.json"))
+
+    def transfer_journal(self):
+        """
+            :returns: path to the journal of the miscellaneous files
+                transferred when resumable_delivery is set
+        """
+        return self.expand_path(os.path.join(self.logpath, "miscellaneous.transfer_journal"))
+
+    def staging_workdir(self):
+        """
+            :returns: path to the folder to stage miscellaneous files into
+                when atomic_staging is set, next to the staging path
+        """
+        stagingpath = os.path.normpath(self.expand_path(self.stagingpath))
+        return os.path.join(os.path.dirname(stagingpath), ".{}.miscellaneous.staging".format(
+            os.path.basename(stagingpath)))
+
+    def staging_journal(self):
+        """
+            :returns: path to the journal of the miscellaneous files staged
+                into staging_workdir
+        """
+        return self.expand_path(os.path.join(self.logpath, "miscellaneous.staging_journal"))
+
+    def staging_fast_manifest(self):
+        """
+            :returns: path to the file with the fast_hash_algorithm checksums
+                of the staged miscellaneous files
+        """
+        return self.expand_path(os.path.join(
+            self.logpath, "miscellaneous.staged.{}".format(self.fast_hash_algorithm)))
+
     def deliver_misc_data(self):
         if self.files_to_deliver == None:
             logger.info("No miscellaneous files to deliver for project {}".format(self.projectid))
@@ -625,6 +1676,65 @@ class SampleDeliverer(Deliverer):
                 with_log_files=(logprefix is not None),
                 prefix="{}_aggregate".format(logprefix))
 
+    def create_report_async(self):
+        """ Start creating the reports in a background process. The process is
+            forked, so that the reports are created in the report path
+            without changing the working directory of this process. The
+            files matching the report patterns are gathered after the process
+            has finished, see gather_files and wait_for_report.
+
+            The process is put in a process group of its own, so that the
+            report commands it runs can be terminated along with it.
+
+            :returns: the started multiprocessing.Process
+        """
+        self.report_process = multiprocessing.get_context('fork').Process(
+            target=self._create_report_in_background, name="report-{}".format(self.sampleid))
+        self.report_process.start()
+        try:
+            # also done by the process itself, whichever comes first
+            os.setpgid(self.report_process.pid, self.report_process.pid)
+        except OSError:
+            pass
+        return self.report_process
+
+    def _create_report_in_background(self):
+        os.setpgid(0, 0)
+        # the signals are sent to the process group when the reports are no longer needed
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            self.create_report()
+        except Exception as e:
+            logger.warning(
+                "failed to create reports for {}, reason: {}".format(
+                    self, e))
+            sys.exit(1)
+
+    def wait_for_report(self, terminate=False):
+        """ Wait for the reports being created in the background, if any
+
+            :param bool terminate: terminate the report process and the
+                report commands it runs instead of waiting for them to finish
+            :returns: True if the reports were created, False if the report
+                process failed or was terminated and None if no reports were
+                being created
+        """
+        process = getattr(self, 'report_process', None)
+        if process is None:
+            return None
+        self.report_process = None
+        if terminate and process.is_alive():
+            logger.info("terminating report creation for {}".format(str(self)))
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+            except OSError:
+                process.terminate()
+        elif process.is_alive():
+            logger.info("waiting for the reports for {} to be created".format(str(self)))
+        process.join()
+        return process.exitcode == 0
+
     def db_entry(self):
         """ Fetch a database entry representing the instance's project and sample
             :returns: a json-formatted database entry
@@ -633,7 +1743,7 @@ class SampleDeliverer(Deliverer):
         """
         return db.sample_entry(db.dbcon(), self.projectid, self.sampleid)
 
-    def deliver_sample(self, sampleentry=None):
+    def deliver_sample(self, sampleentry=None, create_report=True):
         """ Deliver a sample to the destination specified by the config.
             Will check if the sample has already been delivered and should not
             be delivered again or if the sample is not yet ready to be delivered.
@@ -641,6 +1751,9 @@ class SampleDeliverer(Deliverer):
             :params sampleentry: a database sample entry to use for delivery,
                 be very careful with caching the database entries though since
                 concurrent processes can update the database at any time
+            :params bool create_report: create the sample reports, set to False
+                if they have already been created, see
+                ProjectDeliverer.create_sample_reports
             :returns: True if sample was successfully delivered or was previously
                 delivered, False if sample was not yet ready to be delivered
             :raises taca_ngi_pipeline.utils.database.DatabaseError: if an entry corresponding to this
@@ -657,20 +1770,18 @@ class SampleDeliverer(Deliverer):
             else:
                 logger.info("Staging {}".format(str(self)))
             try:
-                if self.get_analysis_status(sampleentry) != 'ANALYZED':
-                    if not self.force and not self.ignore_analysis_status:
-                        logger.info("{} has not finished analysis and will not be delivered".format(str(self)))
-                        return False
-                if self.get_delivery_status(sampleentry) == 'DELIVERED' \
-                        and not self.force:
+                reason = self.reason_not_to_deliver(sampleentry)
+                if reason == 'NOT_ANALYZED':
+                    logger.info("{} has not finished analysis and will not be delivered".format(str(self)))
+                    return False
+                if reason == 'DELIVERED':
                     logger.info("{} has already been delivered. Sample will not be delivered again this time.".format(str(self)))
                     return True
-                if self.get_delivery_status(sampleentry) == 'IN_PROGRESS' \
-                        and not self.force:
+                if reason == 'IN_PROGRESS':
                     logger.info("delivery of {} is already in progress".format(
                         str(self)))
                     return False
-                if self.get_sample_status(sampleentry) == 'ABORTED':
+                if reason == 'ABORTED':
                     logger.info("{} has been marked as ABORTED and will not be delivered".format(str(self)))
                     #set it to delivered as ABORTED samples should not fail the status of a project
                     if  self.get_delivery_status(sampleentry):
@@ -678,8 +1789,7 @@ class SampleDeliverer(Deliverer):
                         self.update_delivery_status(status="NOT_DELIVERED")
                     #otherwhise leave it empty. Return True as an aborted sample should not fail a delivery
                     return True
-                if self.get_sample_status(sampleentry) == 'FRESH' \
-                        and not self.force:
+                if reason == 'FRESH':
                     logger.info("{} is marked as FRESH (new unprocessed data is available) and will not be delivered".format(str(self)))
                     return False
                 if self.get_delivery_status(sampleentry) == 'FAILED':
@@ -694,9 +1804,13 @@ class SampleDeliverer(Deliverer):
             self.update_delivery_status(status="IN_PROGRESS")
             # an error with the reports should not abort the delivery, so handle
             try:
-                if self.report_sample and self.report_aggregate:
-                    logger.info("creating sample reports")
-                    self.create_report()
+                if create_report and self.report_sample and self.report_aggregate:
+                    if self.async_reports:
+                        logger.info("creating sample reports in the background")
+                        self.create_report_async()
+                    else:
+                        logger.info("creating sample reports")
+                        self.create_report()
             except AttributeError:
                 pass
             except Exception as e:
@@ -704,13 +1818,19 @@ class SampleDeliverer(Deliverer):
                     "failed to create reports for {}, reason: {}".format(
                         self, e))
             # stage the delivery
-            if not self.stage_delivery():
-                raise DelivererError("sample was not properly staged")
+            try:
+                if not self.stage_delivery():
+                    raise DelivererError("sample was not properly staged")
+            finally:
+                # the reports are normally awaited when staging, unless staging failed before that
+                self.wait_for_report(terminate=True)
             logger.info("{} successfully staged".format(str(self)))
             if not self.stage_only:
                 # perform the delivery
                 if not self.do_delivery():
                     raise DelivererError("sample was not properly delivered")
+                if self.verify_delivery:
+                    self.verify_delivered_files()
                 logger.info("{} successfully delivered".format(str(self)))
                 # set the delivery status in database
                 self.update_delivery_status()
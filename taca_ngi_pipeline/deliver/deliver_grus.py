@@ -12,14 +12,17 @@ import subprocess
 import sys
 import re
 import shutil
+import multiprocessing
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, wait
 from dateutil.relativedelta import relativedelta
 
 from ngi_pipeline.database.classes import CharonSession
-from taca.utils.filesystem import do_copy, create_folder
+from taca.utils.filesystem import create_folder
 from taca.utils.config import CONFIG
 from taca.utils.statusdb import StatusdbSession, ProjectSummaryConnection
 
-from .deliver import ProjectDeliverer, SampleDeliverer, DelivererInterruptedError
+from .deliver import ProjectDeliverer, ProjectMiscDeliverer, SampleDeliverer, DelivererInterruptedError
+from ..utils import filesystem as fs
 from ..utils.database import DatabaseError
 from six.moves import input
 
@@ -52,6 +55,23 @@ def check_mover_version():
     return True #if I am here this is mover/1.0.0 so I am finr
 
 
+def _hard_stage_sample(projectid, sampleid):
+    """ Hard stage a sample in a worker process of GrusProjectDeliverer.hard_stage
+        :returns: the result of GrusSampleDeliverer.deliver_sample
+    """
+    return GrusSampleDeliverer(projectid, sampleid).deliver_sample()
+
+
+def _hard_stage_misc(src_misc, dst_misc):
+    """ Hard stage a miscellaneous file or folder in a worker process of
+        GrusProjectDeliverer.hard_stage
+    """
+    if os.path.isdir(src_misc):
+        shutil.copytree(src_misc, dst_misc)
+    else:
+        shutil.copy(src_misc, dst_misc)
+
+
 class GrusProjectDeliverer(ProjectDeliverer):
     """ This object takes care of delivering project samples to castor's wharf.
     """
@@ -80,6 +100,7 @@ class GrusProjectDeliverer(ProjectDeliverer):
         self.sensitive = sensitive
         self.hard_stage_only = hard_stage_only
         self.fcid = fcid
+        self.copy_threads = int(getattr(self, 'copy_threads', 1))
 
     def get_delivery_status(self, dbentry=None):
         """ Returns the delivery status for this sample. If a sampleentry
@@ -262,42 +283,22 @@ class GrusProjectDeliverer(ProjectDeliverer):
             logger.error("Aborting delivery for {}, remove unwanted files and try again".format(str(self)))
             return False
 
-        hard_staged_samples = []
-        for sample_id in samples_to_deliver:
-            try:
-                sample_deliverer = GrusSampleDeliverer(self.projectid, sample_id)
-                sample_deliverer.deliver_sample()
-            except Exception as e:
-                logger.error('Sample {} has not been hard staged. Error says: {}'.format(sample_id, e))
-                logger.exception(e)
-                raise e
-            else:
-                hard_staged_samples.append(sample_id)
+        hard_staged_samples, hard_staged_misc = self.hard_stage(
+            samples_to_deliver, misc_to_deliver, soft_stagepath, hard_stagepath)
         if len(samples_to_deliver) != len(hard_staged_samples):
             # Something unexpected happend, terminate
             logger.warning('Not all the samples have been hard staged. Terminating')
             raise AssertionError('len(samples_to_deliver) != len(hard_staged_samples): {} != {}'.format(len(samples_to_deliver),
                                                                                                         len(hard_staged_samples)))
 
-        hard_staged_misc = []
-        for itm in misc_to_deliver:
-            src_misc = os.path.join(soft_stagepath, itm)
-            dst_misc = os.path.join(hard_stagepath, itm)
-            try:
-                if os.path.isdir(src_misc):
-                    shutil.copytree(src_misc, dst_misc)
-                else:
-                    shutil.copy(src_misc, dst_misc)
-                hard_staged_misc.append(itm)
-            except Exception as e:
-                logger.error('Miscellaneous file {} has not been hard staged for project {}. Error says: {}'.format(itm, self.projectid, e))
-                logger.exception(e)
-                raise e
         if len(misc_to_deliver) != len(hard_staged_misc):
             # Something unexpected happend, terminate
             logger.warning('Not all the Miscellaneous files have been hard staged for project {}. Terminating'.format(self.projectid))
             raise AssertionError('len(misc_to_deliver) != len(hard_staged_misc): {} != {}'.format(len(misc_to_deliver),
                                                                                                   len(hard_staged_misc)))
+        # verify the hard staged miscellaneous files against the checksums computed when staging them
+        if self.verify_staged_copies and misc_to_deliver:
+            ProjectMiscDeliverer(self.projectid).verify_staged_copy(hard_stagepath)
 
         # create a delivery project id
         supr_name_of_delivery = ''
@@ -332,6 +333,92 @@ class GrusProjectDeliverer(ProjectDeliverer):
             status = False
         return status
 
+    def hard_stage(self, samples_to_deliver, misc_to_deliver, soft_stagepath, hard_stagepath):
+        """ Hard stage the samples and miscellaneous files of the project. If
+            workers is larger than 1, that many samples and miscellaneous
+            files are hard staged concurrently, each in a separate process.
+
+            If a sample or miscellaneous file fails, the ones that have not
+            been started yet are left alone, like when hard staging one at a
+            time, and the first error is raised once the running ones have
+            finished. The failed samples are set back to STAGED in Charon.
+
+            :param list samples_to_deliver: the ids of the samples
+            :param list misc_to_deliver: the miscellaneous files and folders
+                in the soft staging path
+            :param string soft_stagepath: the soft staging path
+            :param string hard_stagepath: the path to hard stage to
+            :returns: a tuple with the hard staged samples and the hard
+                staged miscellaneous files
+        """
+        if self.workers > 1 and len(samples_to_deliver) + len(misc_to_deliver) > 1:
+            return self._hard_stage_in_pool(samples_to_deliver, misc_to_deliver, soft_stagepath, hard_stagepath)
+        hard_staged_samples = []
+        for sample_id in samples_to_deliver:
+            try:
+                sample_deliverer = GrusSampleDeliverer(self.projectid, sample_id)
+                sample_deliverer.deliver_sample()
+            except Exception as e:
+                logger.error('Sample {} has not been hard staged. Error says: {}'.format(sample_id, e))
+                logger.exception(e)
+                raise e
+            else:
+                hard_staged_samples.append(sample_id)
+
+        hard_staged_misc = []
+        for itm in misc_to_deliver:
+            src_misc = os.path.join(soft_stagepath, itm)
+            dst_misc = os.path.join(hard_stagepath, itm)
+            try:
+                _hard_stage_misc(src_misc, dst_misc)
+                hard_staged_misc.append(itm)
+            except Exception as e:
+                logger.error('Miscellaneous file {} has not been hard staged for project {}. Error says: {}'.format(itm, self.projectid, e))
+                logger.exception(e)
+                raise e
+        return hard_staged_samples, hard_staged_misc
+
+    def _hard_stage_in_pool(self, samples_to_deliver, misc_to_deliver, soft_stagepath, hard_stagepath):
+        logger.info("hard staging {} samples and {} miscellaneous files of {} using {} workers".format(
+            len(samples_to_deliver), len(misc_to_deliver), str(self), self.workers))
+        pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('fork'))
+        try:
+            sample_futures = [pool.submit(_hard_stage_sample, self.projectid, sample_id)
+                              for sample_id in samples_to_deliver]
+            misc_futures = [pool.submit(_hard_stage_misc, os.path.join(soft_stagepath, itm),
+                                        os.path.join(hard_stagepath, itm)) for itm in misc_to_deliver]
+            wait(sample_futures + misc_futures, return_when=FIRST_EXCEPTION)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+        errors = []
+        hard_staged_samples = []
+        for sample_id, future in zip(samples_to_deliver, sample_futures):
+            if future.cancelled():
+                logger.warning('Sample {} has not been hard staged because of an earlier failure'.format(sample_id))
+            elif future.exception() is not None:
+                e = future.exception()
+                logger.error('Sample {} has not been hard staged. Error says: {}'.format(sample_id, e))
+                errors.append(e)
+                # the sample is normally set back to STAGED by the worker, unless the worker died
+                GrusSampleDeliverer(self.projectid, sample_id).update_delivery_status(status="STAGED")
+            else:
+                hard_staged_samples.append(sample_id)
+        hard_staged_misc = []
+        for itm, future in zip(misc_to_deliver, misc_futures):
+            if future.cancelled():
+                logger.warning('Miscellaneous file {} has not been hard staged for project {} because of an '
+                               'earlier failure'.format(itm, self.projectid))
+            elif future.exception() is not None:
+                e = future.exception()
+                logger.error('Miscellaneous file {} has not been hard staged for project {}. Error says: {}'.format(
+                    itm, self.projectid, e))
+                errors.append(e)
+            else:
+                hard_staged_misc.append(itm)
+        if errors:
+            raise errors[0]
+        return hard_staged_samples, hard_staged_misc
+
     def deliver_run_folder(self):
         '''Hard stages run folder and initiates delivery
         '''
@@ -354,9 +441,9 @@ class GrusProjectDeliverer(ProjectDeliverer):
 
         create_folder(dst)
         try:
-            shutil.copy(runfolder_archive, dst)
-            shutil.copy(runfolder_md5file, dst)
             logger.info("Copying files {} and {} to {}".format(runfolder_archive, runfolder_md5file, dst))
+            for fpath in (runfolder_archive, runfolder_md5file):
+                fs.copy_file(fpath, os.path.join(dst, os.path.basename(fpath)), threads=self.copy_threads)
         except IOError as e:
             logger.error("Unable to copy files to {}. Please check that the files exist and that the filenames match the flowcell ID.".format(dst))
 
@@ -599,10 +686,24 @@ class GrusSampleDeliverer(SampleDeliverer):
     """
 
     def __init__(self, projectid=None, sampleid=None, **kwargs):
+        """
+            :param list hard_stage_strategies: the ways to put the staged
+                files in place when hard staging, tried in order, see
+                taca_ngi_pipeline.utils.filesystem.link_or_copy. Defaults to
+                reflinking and then copying. 'hardlink' has to be added
+                explicitly, e.g. [reflink, hardlink, copy], since a hardlinked
+                file is the same file as the analysis data: the change of
+                group before the delivery, or any other chmod, chown or edit
+                of the hard staged file, also applies to the analysis data.
+            :param int copy_threads: number of threads to copy each large
+                file with, see taca_ngi_pipeline.utils.filesystem.copy_file
+        """
         super(GrusSampleDeliverer, self).__init__(
             projectid,
             sampleid,
             **kwargs)
+        self.hard_stage_strategies = getattr(self, 'hard_stage_strategies', fs.DEFAULT_LINK_STRATEGIES)
+        self.copy_threads = int(getattr(self, 'copy_threads', 1))
 
     def deliver_sample(self, sampleentry=None):
         """ Deliver a sample to the destination specified via command line of on Charon.
@@ -648,6 +749,39 @@ class GrusSampleDeliverer(SampleDeliverer):
             logger.exception(e)
             raise(e)
 
+    def hard_staging_report(self):
+        """
+            :returns: path to the report of how the files of the sample were
+                put in place when hard staging
+        """
+        return self.expand_path(os.path.join(self.logpath, "{}.hard_staging.json".format(self.sampleid)))
+
+    def write_hard_staging_report(self, placed):
+        """ Log how many files were put in place with each strategy and write
+            the strategy and number of bytes written for each file to
+            hard_staging_report
+
+            :param list placed: tuples with the path, strategy and bytes
+                written for each file, as returned by
+                taca_ngi_pipeline.utils.filesystem.link_or_copy_tree
+        """
+        summary = {}
+        for _, strategy, written in placed:
+            files, nbytes = summary.get(strategy, (0, 0))
+            summary[strategy] = (files + 1, nbytes + written)
+        logger.info("hard staged {} files of sample {}: {}, {} bytes written".format(
+            len(placed),
+            self.sampleid,
+            ", ".join("{} {}".format(files, strategy) for strategy, (files, _) in sorted(summary.items())),
+            sum(nbytes for _, nbytes in summary.values())))
+        reportpath = self.hard_staging_report()
+        create_folder(os.path.dirname(reportpath))
+        with open(reportpath, 'w') as fh:
+            json.dump({
+                'files': [{'path': fpath, 'strategy': strategy, 'bytes_written': written}
+                          for fpath, strategy, written in placed],
+                'bytes_written': sum(nbytes for _, nbytes in summary.values())}, fh, indent=2)
+
     def save_delivery_token_in_charon(self, delivery_token):
         '''Updates delivery_token in Charon at sample level
         '''
@@ -673,16 +807,29 @@ class GrusSampleDeliverer(SampleDeliverer):
             logger.exception(e)
 
     def do_delivery(self):
-        """ Creating a hard copy of staged data
+        """ Creating a hard copy of staged data. The files are reflinked or
+            hardlinked instead of copied when possible, see
+            hard_stage_strategies. The strategy used for each file is
+            written to the file given by hard_staging_report. If
+            verify_staged_copies is set, the copied files are verified, while
+            linked files are the same data as the staged files.
         """
         logger.info("Creating hard copy of sample {}".format(self.sampleid))
         # join stage dir with sample dir
         source_dir = os.path.join(self.expand_path(self.stagingpath), self.sampleid)
         destination_dir = os.path.join(self.expand_path(self.stagingpathhard), self.sampleid)
         # destination must NOT exist
-        do_copy(source_dir, destination_dir)
+        placed = fs.link_or_copy_tree(
+            source_dir, destination_dir, strategies=self.hard_stage_strategies, copy_threads=self.copy_threads)
+        placed = [(os.path.join(self.sampleid, relpath), strategy, written) for relpath, strategy, written in placed]
         #now copy md5 and other files
         for file in glob.glob("{}.*".format(source_dir)):
             shutil.copy(file, self.expand_path(self.stagingpathhard))
+            placed.append((os.path.basename(file), 'copy', os.path.getsize(file)))
+        self.write_hard_staging_report(placed)
+        # verify the copied files against the checksums computed when staging
+        self.verify_staged_copy(
+            self.expand_path(self.stagingpathhard),
+            relpaths=[relpath for relpath, strategy, _ in placed if strategy == 'copy'])
         logger.info("Sample {} has been hard staged to {}".format(self.sampleid, destination_dir))
         return
@@ -0,0 +1,386 @@
+""" A persistent index of file checksums, backed by SQLite
+"""
+import os
+import sqlite3
+import time
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+
+class ChecksumIndexError(Exception):
+    pass
+
+
+class ChecksumIndex(object):
+    """ Keeps track of computed file checksums between runs. An entry is keyed
+        on the device, inode, size and modification time (in ns) of the file
+        together with the hash algorithm, so a lookup only needs a stat call
+        and a checksum is never reused for a file that has been modified or
+        replaced.
+
+        Entries that have not been used for a while can be evicted, either by
+        age or by keeping only the most recently used entries.
+
+        The index also holds checkpoints of partially computed checksums,
+        keyed in the same way, so that hashing of a large file can resume
+        where an interrupted run stopped. A serialized hash state is only
+        valid for the implementation that wrote it, so each checkpoint is
+        saved with a description of that implementation and is ignored by
+        any other.
+
+        The index is shared by concurrent runs, so the database is opened in
+        WAL mode and every write is committed right away, in order not to
+        hold the write lock between calls. Lookups only read the database;
+        the time each entry was last used is written by flush. WAL mode
+        relies on shared memory between the processes using the database,
+        so the index has to be on a local disk: it does not work on a
+        network filesystem such as NFS, even for runs on a single host.
+
+        A failed write is rolled back and logged as a warning, since the
+        index is only a cache and should never fail a staging.
+    """
+
+    # write the last used times after this many lookups
+    COMMIT_INTERVAL = 500
+
+    # the least number of seconds between applying the eviction policy when
+    # closing, so that concurrent runs do not all scan the index
+    EVICTION_INTERVAL = 3600
+
+    def __init__(self, dbpath, max_entries=None, max_age_days=None, timeout=60):
+        """
+            :param string dbpath: path to the SQLite database file, it will be
+                created if it does not exist
+            :param int max_entries: if set, evict the least recently used
+                entries above this number when the index is closed, at most
+                once every EVICTION_INTERVAL seconds
+            :param float max_age_days: if set, evict entries that have not been
+                used for this many days when the index is closed, at most
+                once every EVICTION_INTERVAL seconds
+            :param float timeout: seconds to wait for a lock held by a
+                concurrent process
+            :raises ChecksumIndexError: if the database could not be opened
+        """
+        self.dbpath = dbpath
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self._used = {}
+        try:
+            dbdir = os.path.dirname(os.path.abspath(dbpath))
+            if not os.path.exists(dbdir):
+                os.makedirs(dbdir)
+            self.connection = sqlite3.connect(dbpath, timeout=timeout)
+            # readers and the writer do not block each other in WAL mode, and
+            # a commit does not need to sync the database file
+            journal_mode = self.connection.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+            if journal_mode.lower() != 'wal':
+                logger.warning("checksum index {} could not be opened in WAL mode, but in {} mode. Concurrent runs "
+                               "will block each other".format(dbpath, journal_mode))
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS checksums ("
+                "device INTEGER NOT NULL, "
+                "inode INTEGER NOT NULL, "
+                "size INTEGER NOT NULL, "
+                "mtime_ns INTEGER NOT NULL, "
+                "algorithm TEXT NOT NULL, "
+                "digest TEXT NOT NULL, "
+                "path TEXT, "
+                "last_used REAL NOT NULL, "
+                "PRIMARY KEY (device, inode, size, mtime_ns, algorithm))")
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS checksums_last_used ON checksums (last_used)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value REAL)")
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(checkpoints)")]
+            if columns and 'build' not in columns:
+                # checkpoints saved before the build was recorded can not be trusted
+                self.connection.execute("DROP TABLE checkpoints")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints ("
+                "device INTEGER NOT NULL, "
+                "inode INTEGER NOT NULL, "
+                "size INTEGER NOT NULL, "
+                "mtime_ns INTEGER NOT NULL, "
+                "algorithm TEXT NOT NULL, "
+                "offset INTEGER NOT NULL, "
+                "state BLOB NOT NULL, "
+                "build TEXT, "
+                "path TEXT, "
+                "last_used REAL NOT NULL, "
+                "PRIMARY KEY (device, inode, size, mtime_ns, algorithm))")
+            self.connection.commit()
+        except (OSError, sqlite3.Error) as e:
+            raise ChecksumIndexError(
+                "could not open checksum index {}: {}".format(dbpath, e))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def _key(st, algorithm):
+        return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, algorithm
+
+    def lookup(self, sourcepath, algorithm, st=None):
+        """ Look up the checksum for a file
+
+            :param string sourcepath: path to the file
+            :param string algorithm: the hash algorithm
+            :param st: the result of os.stat for the file, will be fetched if
+                not supplied
+            :returns: the checksum or None if the file is not in the index
+        """
+        st = st or os.stat(sourcepath)
+        key = self._key(st, algorithm)
+        try:
+            row = self.connection.execute(
+                "SELECT digest FROM checksums WHERE device=? AND inode=? AND size=? "
+                "AND mtime_ns=? AND algorithm=?", key).fetchone()
+            if row is None:
+                return None
+        except sqlite3.Error as e:
+            logger.warning("could not look up checksum for {} in index {}: {}".format(
+                sourcepath, self.dbpath, e))
+            return None
+        self._used[key] = time.time()
+        if len(self._used) >= self.COMMIT_INTERVAL:
+            self.flush()
+        return row[0]
+
+    def store(self, sourcepath, algorithm, digest, st=None):
+        """ Add or replace the checksum for a file
+
+            :param string sourcepath: path to the file
+            :param string algorithm: the hash algorithm
+            :param string digest: the checksum
+            :param st: the result of os.stat for the file, will be fetched if
+                not supplied
+        """
+        st = st or os.stat(sourcepath)
+        try:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO checksums (device, inode, size, mtime_ns, algorithm, "
+                "digest, path, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                self._key(st, algorithm) + (digest, os.path.abspath(sourcepath), time.time()))
+            self.connection.commit()
+        except sqlite3.Error as e:
+            self._rollback()
+            logger.warning("could not store checksum for {} in index {}: {}".format(
+                sourcepath, self.dbpath, e))
+
+    def load_checkpoint(self, sourcepath, hash_algorithms, st=None, build=None):
+        """ Look up a checkpoint of a partially computed checksum
+
+            :param string sourcepath: path to the file
+            :param list hash_algorithms: the hash algorithms being computed
+            :param st: the result of os.stat for the file, will be fetched if
+                not supplied
+            :param string build: the implementation that will resume from the
+                checkpoint, see save_checkpoint. Checkpoints saved by another
+                are ignored
+            :returns: a tuple with the offset to resume reading from and a dict
+                with the serialized hash state for each algorithm, or (0, {})
+                if there is no usable checkpoint covering all the algorithms
+        """
+        st = st or os.stat(sourcepath)
+        states = {}
+        offsets = set()
+        try:
+            for algorithm in hash_algorithms:
+                row = self.connection.execute(
+                    "SELECT offset, state, build FROM checkpoints WHERE device=? AND inode=? AND size=? "
+                    "AND mtime_ns=? AND algorithm=?", self._key(st, algorithm)).fetchone()
+                if row is None:
+                    return 0, {}
+                if row[2] != build:
+                    logger.info("ignoring checksum checkpoint for {} saved by {}, which differs from {}".format(
+                        sourcepath, row[2], build))
+                    return 0, {}
+                offsets.add(row[0])
+                states[algorithm] = bytes(row[1])
+        except sqlite3.Error as e:
+            logger.warning("could not look up checksum checkpoint for {} in index {}: {}".format(
+                sourcepath, self.dbpath, e))
+            return 0, {}
+        # the states must all have been saved at the same point in the file
+        if len(offsets) != 1:
+            return 0, {}
+        return offsets.pop(), states
+
+    def save_checkpoint(self, sourcepath, offset, states, st=None, build=None):
+        """ Save a checkpoint of a partially computed checksum. The checkpoint
+            is committed immediately, like all writes to the index.
+
+            :param string sourcepath: path to the file
+            :param int offset: the number of bytes of the file that have been hashed
+            :param dict states: the serialized hash state for each algorithm
+            :param st: the result of os.stat for the file, will be fetched if
+                not supplied
+            :param string build: a description of the implementation that
+                serialized the states, e.g. the library version and context
+                size, which has to match when the checkpoint is loaded
+        """
+        st = st or os.stat(sourcepath)
+        try:
+            now = time.time()
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO checkpoints (device, inode, size, mtime_ns, algorithm, "
+                "offset, state, build, path, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [self._key(st, algorithm) + (offset, sqlite3.Binary(state), build, os.path.abspath(sourcepath), now)
+                 for algorithm, state in states.items()])
+            self.connection.commit()
+        except sqlite3.Error as e:
+            self._rollback()
+            logger.warning("could not save checksum checkpoint for {} in index {}: {}".format(
+                sourcepath, self.dbpath, e))
+
+    def clear_checkpoint(self, sourcepath, st=None):
+        """ Remove any checkpoints for a file
+
+            :param string sourcepath: path to the file
+            :param st: the result of os.stat for the file, will be fetched if
+                not supplied
+        """
+        st = st or os.stat(sourcepath)
+        try:
+            self.connection.execute(
+                "DELETE FROM checkpoints WHERE device=? AND inode=? AND size=? AND mtime_ns=?",
+                self._key(st, None)[0:4])
+            self.connection.commit()
+        except sqlite3.Error as e:
+            self._rollback()
+            logger.warning("could not clear checksum checkpoint for {} in index {}: {}".format(
+                sourcepath, self.dbpath, e))
+
+    def _rollback(self):
+        # do not keep the write lock after a failed write
+        try:
+            self.connection.rollback()
+        except sqlite3.Error:
+            pass
+
+    def flush(self):
+        """ Write the last used times of the looked up entries and commit any
+            pending modifications to disk
+        """
+        used, self._used = self._used, {}
+        try:
+            if used:
+                self.connection.executemany(
+                    "UPDATE checksums SET last_used=? WHERE device=? AND inode=? AND size=? "
+                    "AND mtime_ns=? AND algorithm=?", [(last_used,) + key for key, last_used in used.items()])
+            self.connection.commit()
+        except sqlite3.Error as e:
+            self._rollback()
+            logger.warning("could not update checksum index {}: {}".format(self.dbpath, e))
+
+    def evict(self, max_entries=None, max_age_days=None, prune_missing=False):
+        """ Remove entries from the index
+
+            :param int max_entries: keep at most this many entries, the least
+                recently used are removed first
+            :param float max_age_days: remove entries that have not been used
+                for this many days
+            :param bool prune_missing: remove entries whose path no longer
+                exists or refers to a modified or replaced file
+            :returns: the number of entries removed, which is 0 if the
+                entries could not be removed
+
+            Checkpoints are removed by age and by path in the same way, but do
+            not count towards max_entries.
+        """
+        removed = 0
+        try:
+            for table in ('checksums', 'checkpoints'):
+                if max_age_days is not None:
+                    removed += self.connection.execute(
+                        "DELETE FROM {} WHERE last_used < ?".format(table),
+                        (time.time() - float(max_age_days) * 86400,)).rowcount
+                if prune_missing:
+                    stale = []
+                    for row in self.connection.execute(
+                            "SELECT device, inode, size, mtime_ns, algorithm, path FROM {}".format(table)):
+                        try:
+                            if self._key(os.stat(row[5]), row[4]) == tuple(row[0:5]):
+                                continue
+                        except (OSError, TypeError):
+                            pass
+                        stale.append(row[0:5])
+                    for key in stale:
+                        removed += self.connection.execute(
+                            "DELETE FROM {} WHERE device=? AND inode=? AND size=? "
+                            "AND mtime_ns=? AND algorithm=?".format(table), key).rowcount
+            if max_entries is not None:
+                removed += self.connection.execute(
+                    "DELETE FROM checksums WHERE rowid NOT IN ("
+                    "SELECT rowid FROM checksums ORDER BY last_used DESC LIMIT ?)",
+                    (int(max_entries),)).rowcount
+            self.connection.commit()
+        except sqlite3.Error as e:
+            self._rollback()
+            logger.warning("could not evict entries from checksum index {}: {}".format(self.dbpath, e))
+            return 0
+        self.flush()
+        return removed
+
+    def _claim_eviction(self):
+        # only one of the concurrent runs applies the eviction policy in each interval
+        now = time.time()
+        try:
+            claimed = self.connection.execute(
+                "UPDATE settings SET value=? WHERE key='last_evicted' AND value < ?",
+                (now, now - self.EVICTION_INTERVAL)).rowcount
+            if not claimed:
+                claimed = self.connection.execute(
+                    "INSERT OR IGNORE INTO settings (key, value) VALUES ('last_evicted', ?)", (now,)).rowcount
+            self.connection.commit()
+        except sqlite3.Error as e:
+            self._rollback()
+            logger.warning("could not apply the eviction policy to checksum index {}: {}".format(self.dbpath, e))
+            return False
+        return claimed > 0
+
+    def vacuum(self):
+        """ Reclaim the disk space used by removed entries """
+        self.flush()
+        try:
+            self.connection.execute("VACUUM")
+        except sqlite3.Error as e:
+            logger.warning("could not vacuum checksum index {}: {}".format(self.dbpath, e))
+
+    def stats(self):
+        """
+            :returns: a dict with the number of entries per hash algorithm, the
+                number of checkpointed files and the size of the database file
+            :raises ChecksumIndexError: if the index could not be read
+        """
+        try:
+            entries = dict(self.connection.execute(
+                "SELECT algorithm, COUNT(*) FROM checksums GROUP BY algorithm").fetchall())
+            checkpoints = self.connection.execute(
+                "SELECT COUNT(*) FROM (SELECT DISTINCT device, inode FROM checkpoints)").fetchone()[0]
+            size = os.path.getsize(self.dbpath)
+        except (OSError, sqlite3.Error) as e:
+            raise ChecksumIndexError("could not read checksum index {}: {}".format(self.dbpath, e))
+        return {'entries': entries,
+                'checkpoints': checkpoints,
+                'size_in_bytes': size}
+
+    def close(self):
+        """ Apply the eviction policy, if any and if it has not been applied
+            within EVICTION_INTERVAL, and close the database
+        """
+        try:
+            if (self.max_entries is not None or self.max_age_days is not None) and self._claim_eviction():
+                self.evict(max_entries=self.max_entries, max_age_days=self.max_age_days)
+            self.flush()
+        finally:
+            try:
+                self.connection.close()
+            except sqlite3.Error as e:
+                logger.warning("could not close checksum index {}: {}".format(self.dbpath, e))
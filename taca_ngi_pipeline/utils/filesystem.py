@@ -1,14 +1,78 @@
 __author__ = 'Pontus'
 
-from glob import iglob
+import binascii
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import hashlib
+import mmap
+import os
+import platform
+import queue
+import re
+import shutil
+import sys
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from logging import getLogger
-from os import path, walk, sep as os_sep
+from os import curdir, link, path, fstat, scandir, stat, sep as os_sep, unlink
 from taca.utils.misc import hashfile
 from io import open
 import six
 
+from .checksum_index import ChecksumIndex, ChecksumIndexError
+
+try:
+    from os import posix_fadvise, POSIX_FADV_DONTNEED, POSIX_FADV_SEQUENTIAL
+except ImportError:
+    posix_fadvise = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
 logger = getLogger(__name__)
 
+# the maximum number of expanded files to keep queued for hashing
+WALKER_QUEUE_SIZE = 1024
+
+# fast hash algorithms for verifying copies made within our own
+# infrastructure, in order of preference. xxh3_128 and xxh64 require the
+# xxhash package and blake3 the blake3 package, which are installed with the
+# fast_hash extra. blake2b is always available but much slower
+FAST_HASH_ALGORITHMS = ('xxh3_128', 'xxh64', 'blake3', 'blake2b')
+
+# the ways to put a file in place when hard staging, in order of preference.
+# reflinks and hardlinks do not copy any data, but only work within a filesystem
+LINK_STRATEGIES = ('reflink', 'hardlink', 'copy')
+
+# a hardlink shares its inode with the source, so changing the permissions,
+# ownership or contents of either changes both. It is only used if asked for
+DEFAULT_LINK_STRATEGIES = ('reflink', 'copy')
+
+# the number of bytes to copy with each call to the kernel when copying a
+# file, and the smallest range of a file to copy in a separate thread
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+COPY_MIN_RANGE_SIZE = 1024 * 1024 * 1024
+
+# the ioctl that clones a file on Linux, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
 # Handle hashfile output in both python versions
 try:
     unicode
@@ -23,7 +87,8 @@ class PatternNotMatchedException(Exception):
     pass
 
 
-def gather_files(patterns, no_checksum=False, hash_algorithm="md5"):
+def gather_files(patterns, no_checksum=False, hash_algorithm="md5", hash_workers=1, checksum_index=None,
+                 hash_backend=None, fast_hash_algorithm=None, known_digests=None):
     """ This method will locate files matching the patterns specified in
         the config and compute the checksum and construct the staging path
         according to the config.
@@ -34,34 +99,817 @@ def gather_files(patterns, no_checksum=False, hash_algorithm="md5"):
         folder or file. File globs will be expanded and folders will be
         traversed to include everything beneath.
 
+        The hash_algorithm can also be a list of algorithms. All checksums
+        are then computed in a single read of each file, each algorithm gets
+        its own checksum file next to the source and the checksum in the
+        returned tuples is a dict keyed on algorithm.
+
+        If hash_workers is larger than 1, the checksums will be computed in a
+        pool of that many worker processes. The tuples are still yielded in
+        the order the patterns are expanded.
+
+        When checksums are computed, the patterns are expanded in a background
+        thread that stays at most WALKER_QUEUE_SIZE files ahead of the
+        hashing, so that walking the directories overlaps with hashing and
+        with the processing of the yielded tuples by the caller.
+
+        If a checksum_index is supplied, it will be consulted for checksums
+        not found in a checksum file next to the source and computed checksums
+        will be added to it. The index is closed when the generator finishes.
+
+        The files are read by the supplied HashBackend or by the default
+        backend if none is given. A physical file that is reached through
+        several paths, e.g. symlinks or hardlinks, is only hashed once.
+
+        If a fast_hash_algorithm is given, that checksum is computed in the
+        same read of each file and the checksum in the returned tuples is a
+        dict keyed on algorithm. It is only cached in the checksum_index, not
+        in checksum files next to the source.
+
+        known_digests can map source paths to a tuple with the size, the
+        modification time in ns and a dict of checksums for the file, e.g.
+        from a previous staging. These checksums are used for files that
+        have not been modified since, without looking further.
+
         :returns: A generator of tuples with source path,
             destination path and the checksum of the source file
             (or None if source is a folder)
     """
+    hash_backend = hash_backend or HashBackend()
+    if isinstance(hash_algorithm, six.string_types):
+        hash_algorithms = [hash_algorithm]
+    else:
+        hash_algorithms = list(hash_algorithm)
+    checksum_extensions = tuple(".{}".format(algorithm) for algorithm in hash_algorithms)
+    if fast_hash_algorithm is not None and fast_hash_algorithm not in hash_algorithms:
+        hash_algorithms.append(fast_hash_algorithm)
+
+    def _stat(sourcepath):
+        try:
+            return stat(sourcepath)
+        except OSError:
+            return None
+
+    def _cached_digest(sourcepath, algorithm):
+        if algorithm == fast_hash_algorithm:
+            return None
+        checksumpath = "{}.{}".format(sourcepath, algorithm)
+        try:
+            with open(checksumpath, 'r') as fh:
+                contents = unicode(next(fh))
+                return contents.split()[0]
+        except (IOError, StopIteration):
+            return None
+
+    def _known_digests(sourcepath):
+        # look for the checksums in the supplied ones, checksum files and in the index
+        digests = {}
+        st = None
+        if known_digests is not None and sourcepath in known_digests:
+            size, mtime_ns, known = known_digests[sourcepath]
+            st = _stat(sourcepath)
+            if st is not None and (st.st_size, st.st_mtime_ns) == (size, mtime_ns):
+                digests = dict((algorithm, known[algorithm]) for algorithm in hash_algorithms if algorithm in known)
+        for algorithm in hash_algorithms:
+            if algorithm in digests:
+                continue
+            digest = _cached_digest(sourcepath, algorithm)
+            if digest is None and checksum_index is not None:
+                st = st or _stat(sourcepath)
+                if st is not None:
+                    digest = checksum_index.lookup(sourcepath, algorithm, st=st)
+            if digest is not None:
+                digests[algorithm] = digest
+        return digests, st
+
+    def _cache_digests(sourcepath, digests, st=None, no_digest_cache=False):
+        for algorithm, digest in digests.items():
+            if checksum_index is not None and st is not None:
+                checksum_index.store(sourcepath, algorithm, digest, st=st)
+            if no_digest_cache or algorithm == fast_hash_algorithm:
+                continue
+            checksumpath = "{}.{}".format(sourcepath, algorithm)
+            try:
+                with open(checksumpath, 'w') as fh:
+                    fh.write(f'{digest}  {path.basename(sourcepath)}')
+            except IOError as we:
+                logger.warning("could not write checksum {} to file {}: {}".format(digest, checksumpath, we))
+
+    def _digest(digests):
+        if isinstance(hash_algorithm, six.string_types) and fast_hash_algorithm is None:
+            return digests[hash_algorithm]
+        return digests
+
+    # the checksums of each physical file seen so far, keyed on device and
+    # inode, so that a file reached through several paths is only hashed once
+    hashed = {}
+    reused = {'files': 0, 'bytes': 0}
+
+    def _reuse(st, missing):
+        # the checksums, or the pending computation of them, for a file already
+        # hashed through another path, or None if it has not been hashed
+        if st is None:
+            return None
+        known_algorithms, known = hashed.get((st.st_dev, st.st_ino), ((), None))
+        if known is None or not all(algorithm in known_algorithms for algorithm in missing):
+            return None
+        reused['files'] += 1
+        reused['bytes'] += st.st_size
+        return known
+
+    def _remember(st, algorithms, digests):
+        if st is not None:
+            hashed[(st.st_dev, st.st_ino)] = (set(algorithms), digests)
+
     def _get_digest(sourcepath, destpath, no_digest_cache=False, no_digest=False):
         digest = None
         # skip the digest if either the global or the per-file setting is to skip
         if not any([no_checksum, no_digest]):
-            checksumpath = "{}.{}".format(sourcepath, hash_algorithm)
+            digests, st = _known_digests(sourcepath)
+            missing = [algorithm for algorithm in hash_algorithms if algorithm not in digests]
+            if missing:
+                st = st or _stat(sourcepath)
+                computed = _reuse(st, missing)
+                if computed is None:
+                    computed = hash_backend.compute_digests(sourcepath, missing)
+                computed = dict((algorithm, computed[algorithm]) for algorithm in missing)
+                _cache_digests(sourcepath, computed, st=st, no_digest_cache=no_digest_cache)
+                digests.update(computed)
+                _remember(st, hash_algorithms, digests)
+            digest = _digest(digests)
+        return sourcepath, destpath, digest
+
+    def _get_digests_in_pool(matches):
+        # keep a bounded window of pending checksums and yield from the head of
+        # it, so that the order of the expanded patterns is preserved
+        window = deque()
+        pool = ProcessPoolExecutor(max_workers=hash_workers)
+
+        def _pending(item):
+            return item[4] is not None and not item[4].done()
+
+        def _result(item):
+            spath, dpath, digests, missing, computed, st, no_digest_cache = item
+            if digests is None:
+                return spath, dpath, None
+            if computed is not None:
+                computed = computed.result()
+                computed = dict((algorithm, computed[algorithm]) for algorithm in missing)
+                _cache_digests(spath, computed, st=st, no_digest_cache=no_digest_cache)
+                digests.update(computed)
+            return spath, dpath, _digest(digests)
+
+        try:
+            while True:
+                try:
+                    spath, dpath, extra = next(matches)
+                except StopIteration:
+                    break
+                except (FileNotFoundException, PatternNotMatchedException):
+                    # yield what has already been matched before propagating
+                    while window:
+                        yield _result(window.popleft())
+                    raise
+                digests = missing = computed = st = None
+                if not any([no_checksum, extra.get('no_digest', False)]):
+                    digests, st = _known_digests(spath)
+                    missing = [algorithm for algorithm in hash_algorithms if algorithm not in digests]
+                    if missing:
+                        st = st or _stat(spath)
+                        # share the pending computation between paths to the same file
+                        computed = _reuse(st, missing)
+                        if computed is None:
+                            computed = pool.submit(hash_backend.compute_digests, spath, missing)
+                            _remember(st, missing, computed)
+                window.append((spath, dpath, digests, missing, computed, st, extra.get('no_digest_cache', False)))
+                while window and (len(window) > 2 * hash_workers or not _pending(window[0])):
+                    yield _result(window.popleft())
+            while window:
+                yield _result(window.popleft())
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    matches = _expand_patterns(patterns, checksum_extensions)
+    if not no_checksum:
+        matches = _prefetched(matches, WALKER_QUEUE_SIZE)
+    try:
+        if hash_workers > 1 and not no_checksum:
+            for match in _get_digests_in_pool(matches):
+                yield match
+        else:
+            for spath, dpath, extra in matches:
+                yield _get_digest(
+                    spath,
+                    dpath,
+                    no_digest_cache=extra.get('no_digest_cache', False),
+                    no_digest=extra.get('no_digest', False))
+        if reused['files']:
+            logger.info("skipped hashing {} bytes in {} files that had already been hashed through another "
+                        "path".format(reused['bytes'], reused['files']))
+    finally:
+        matches.close()
+        if checksum_index is not None:
+            checksum_index.close()
+
+
+def _prefetched(iterable, maxsize):
+    """ Iterate over an iterable in a background thread, buffering at most
+        maxsize items, so that producing the items overlaps with consuming
+        them. An exception raised by the iterable is raised to the consumer
+        after the items produced before it.
+    """
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+    done = object()
+
+    def _put(item):
+        # give up if the consumer has gone away
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce():
+        try:
+            for item in iterable:
+                if not _put((item, None)):
+                    return
+        except BaseException as e:
+            _put((done, e))
+        else:
+            _put((done, None))
+
+    producer = threading.Thread(target=_produce, name="prefetch")
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+class HashBackend(object):
+    """ Reads files for computing their checksums. The available methods are:
+
+        'hashfile': the default, reads the file in small blocks with
+            taca.utils.misc.hashfile
+        'buffered': reads the file unbuffered in large, page-aligned chunks
+            into a preallocated buffer
+        'mmap': memory maps the file and hashes it a chunk at a time
+
+        Where the platform supports it, the kernel is told that the file will
+        be read sequentially. If drop_cache is set, the pages that have been
+        hashed are also released from the page cache, so that hashing large
+        files does not evict data that other processes depend on. Both apply
+        to all methods, except that a single checksum computed by the
+        'hashfile' method without drop_cache is left to hashfile as is,
+        without any hints.
+
+        If a checkpoint_index is given, the hash state of files at least
+        checkpoint_interval bytes large is saved to that ChecksumIndex every
+        checkpoint_interval bytes and when hashing is interrupted, e.g. by
+        a DelivererInterruptedError raised from a signal handler. Hashing the
+        same, unmodified file again resumes from the last checkpoint. This
+        requires ResumableHash to support all the algorithms, otherwise the
+        file is hashed from the start as usual.
+
+        Instances are passed to worker processes, so they should only hold
+        picklable state. An open ChecksumIndex is passed on as its path, so
+        that each worker process opens its own connection to it.
+    """
+    METHODS = ('hashfile', 'buffered', 'mmap')
+    DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+    HASHFILE_BLOCKSIZE = 65536
+    DEFAULT_CHECKPOINT_INTERVAL = 4 * 1024 * 1024 * 1024
+
+    def __init__(self, method='hashfile', chunk_size=None, drop_cache=False, checkpoint_index=None,
+                 checkpoint_interval=None):
+        """
+            :param string method: one of the METHODS
+            :param int chunk_size: the number of bytes to read at a time by the
+                'buffered' and 'mmap' methods, rounded up to a multiple of the
+                page size
+            :param bool drop_cache: release hashed pages from the page cache
+            :param checkpoint_index: the ChecksumIndex, or the path to one, to
+                save checkpoints of partially computed checksums to. An open
+                ChecksumIndex should be given when the caller stores checksums
+                in the same index, so that both share one connection
+            :param int checkpoint_interval: the number of bytes to hash between
+                checkpoints, defaults to DEFAULT_CHECKPOINT_INTERVAL
+            :raises ValueError: if the method is not known
+        """
+        if method not in self.METHODS:
+            raise ValueError("unknown hashing method '{}', should be one of {}".format(
+                method, ", ".join(self.METHODS)))
+        self.method = method
+        chunk_size = int(chunk_size or self.DEFAULT_CHUNK_SIZE)
+        self.chunk_size = -(-chunk_size // mmap.PAGESIZE) * mmap.PAGESIZE
+        self.drop_cache = drop_cache
+        self.checkpoint_index = checkpoint_index
+        self.checkpoint_interval = int(checkpoint_interval or self.DEFAULT_CHECKPOINT_INTERVAL)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if isinstance(self.checkpoint_index, ChecksumIndex):
+            state['checkpoint_index'] = self.checkpoint_index.dbpath
+        return state
+
+    def __str__(self):
+        if self.method == 'hashfile':
+            return self.method
+        return "{}:{}".format(self.method, self.chunk_size)
+
+    @staticmethod
+    def _fadvise(fd, offset, length, advice):
+        if posix_fadvise is None:
+            return
+        try:
+            posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            pass
+
+    def compute_digests(self, sourcepath, hash_algorithms):
+        """ Compute the checksums of a file for all the given algorithms in a
+            single read of the file.
+
+            :returns: a dict with the checksum for each algorithm
+        """
+        if self.checkpoint_index is not None and ResumableHash.supported(hash_algorithms):
+            st = stat(sourcepath)
+            if st.st_size >= self.checkpoint_interval:
+                return self._compute_resumable(sourcepath, hash_algorithms, st)
+        # hashfile reads the same blocks as _hash_buffered, but can not give any hints
+        if self.method == 'hashfile' and not self.drop_cache and len(hash_algorithms) == 1 and \
+                hash_algorithms[0] not in FAST_HASH_ALGORITHMS:
+            return {hash_algorithms[0]: unicode(hashfile(sourcepath, hasher=hash_algorithms[0]))}
+        hashers = [new_hasher(algorithm) for algorithm in hash_algorithms]
+        with open(sourcepath, 'rb', buffering=0) as fh:
+            self._fadvise(fh.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+            if self.method == 'mmap':
+                self._hash_mmap(fh, hashers)
+            else:
+                self._hash_buffered(fh, hashers)
+        return dict((algorithm, unicode(hasher.hexdigest())) for algorithm, hasher in zip(hash_algorithms, hashers))
+
+    def _compute_resumable(self, sourcepath, hash_algorithms, st):
+        if isinstance(self.checkpoint_index, ChecksumIndex):
+            return self._compute_with_checkpoints(self.checkpoint_index, sourcepath, hash_algorithms, st)
+        try:
+            cidx = ChecksumIndex(self.checkpoint_index)
+        except ChecksumIndexError as e:
+            logger.warning("{}, checksums will not be checkpointed".format(e))
+            self.checkpoint_index = None
+            return self.compute_digests(sourcepath, hash_algorithms)
+        with cidx:
+            return self._compute_with_checkpoints(cidx, sourcepath, hash_algorithms, st)
+
+    def _compute_with_checkpoints(self, cidx, sourcepath, hash_algorithms, st):
+        build = ResumableHash.build()
+        offset, states = cidx.load_checkpoint(sourcepath, hash_algorithms, st=st, build=build)
+        if offset:
+            logger.info("resuming checksum computation of {} from byte {}".format(sourcepath, offset))
+        hashers = [ResumableHash(algorithm, states.get(algorithm)) for algorithm in hash_algorithms]
+        saved_offset = offset
+        # the last point where all hashers have processed the same data
+        checkpoint = (offset, [hasher.state() for hasher in hashers])
+        buf = bytearray(self.chunk_size)
+        with open(sourcepath, 'rb', buffering=0) as fh:
             try:
-                with open(checksumpath, 'r') as fh:
-                    contents = unicode(next(fh))
-                    digest = contents.split()[0]
-            except (IOError, StopIteration):
-                digest = unicode(hashfile(sourcepath, hasher=hash_algorithm))
-                if not no_digest_cache:
+                fh.seek(offset)
+                self._fadvise(fh.fileno(), offset, 0, POSIX_FADV_SEQUENTIAL)
+                with memoryview(buf) as view:
+                    nread = fh.readinto(buf)
+                    while nread:
+                        with view[:nread] as chunk:
+                            offset = self._hashed(fh.fileno(), chunk, offset, hashers)
+                        checkpoint = (offset, [hasher.state() for hasher in hashers])
+                        if offset - saved_offset >= self.checkpoint_interval:
+                            cidx.save_checkpoint(
+                                sourcepath, checkpoint[0], dict(zip(hash_algorithms, checkpoint[1])),
+                                st=st, build=build)
+                            saved_offset = offset
+                        nread = fh.readinto(buf)
+            except BaseException:
+                if checkpoint[0] > saved_offset:
+                    logger.info("saving checkpoint for checksum computation of {} at byte {}".format(
+                        sourcepath, checkpoint[0]))
+                    cidx.save_checkpoint(
+                        sourcepath, checkpoint[0], dict(zip(hash_algorithms, checkpoint[1])),
+                        st=st, build=build)
+                raise
+        cidx.clear_checkpoint(sourcepath, st=st)
+        return dict((algorithm, unicode(hasher.hexdigest())) for algorithm, hasher in zip(hash_algorithms, hashers))
+
+    def _hashed(self, fd, chunk, offset, hashers):
+        for hasher in hashers:
+            hasher.update(chunk)
+        if self.drop_cache:
+            self._fadvise(fd, offset, len(chunk), POSIX_FADV_DONTNEED)
+        return offset + len(chunk)
+
+    def _hash_buffered(self, fh, hashers):
+        chunk_size = self.chunk_size if self.method == 'buffered' else self.HASHFILE_BLOCKSIZE
+        buf = bytearray(chunk_size)
+        offset = 0
+        with memoryview(buf) as view:
+            nread = fh.readinto(buf)
+            while nread:
+                with view[:nread] as chunk:
+                    offset = self._hashed(fh.fileno(), chunk, offset, hashers)
+                nread = fh.readinto(buf)
+
+    def _hash_mmap(self, fh, hashers):
+        size = fstat(fh.fileno()).st_size
+        if size == 0:
+            return
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            try:
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            except AttributeError:
+                pass
+            offset = 0
+            with memoryview(mm) as view:
+                while offset < size:
+                    with view[offset:offset + self.chunk_size] as chunk:
+                        offset = self._hashed(fh.fileno(), chunk, offset, hashers)
+        finally:
+            mm.close()
+
+
+def new_hasher(algorithm):
+    """
+        :param string algorithm: a hashlib algorithm or one of the
+            FAST_HASH_ALGORITHMS
+        :returns: a new hash object for the algorithm
+        :raises ValueError: if the algorithm is not available
+    """
+    if algorithm in ('xxh3_128', 'xxh64') and xxhash is not None:
+        return getattr(xxhash, algorithm)()
+    if algorithm == 'blake3' and blake3 is not None:
+        return blake3.blake3()
+    return hashlib.new(algorithm)
+
+
+def fast_hash_algorithm(preferred=None):
+    """ Pick a fast hash algorithm that is available
+
+        :param string preferred: the algorithm to use if it is available
+        :returns: the preferred algorithm if it is available, otherwise the
+            first available of the FAST_HASH_ALGORITHMS
+    """
+    for algorithm in ([preferred] if preferred else []) + list(FAST_HASH_ALGORITHMS):
+        try:
+            new_hasher(algorithm)
+        except ValueError:
+            continue
+        if preferred and algorithm != preferred:
+            logger.warning("hash algorithm {} is not available, using {} instead".format(preferred, algorithm))
+        if algorithm == FAST_HASH_ALGORITHMS[-1] and preferred != algorithm:
+            logger.warning("neither xxhash nor blake3 is installed, falling back to the slower {}. "
+                           "Install taca-ngi-pipeline[fast_hash] for faster checksums".format(algorithm))
+        return algorithm
+
+
+def read_digest_file(digestfile):
+    """ Read a file with a checksum and a path on each line, as written by
+        md5sum and when staging
+
+        :param string digestfile: path to the file with checksums
+        :returns: a dict with the checksum of each path
+    """
+    return dict((relpath, digest) for digest, relpath in _digest_lines(digestfile))
+
+
+def _digest_lines(digestfile):
+    with open(digestfile, 'r') as fh:
+        for line in fh:
+            line = line.strip()
+            if line:
+                digest, relpath = line.split(None, 1)
+                yield digest, relpath
+
+
+def verify_digest_file(digestfile, root_path, hash_algorithm, hash_backend=None, workers=1, relpaths=None):
+    """ Verify files against a file with a checksum and a path relative to
+        root_path on each line, as written by md5sum and when staging
+
+        :param string digestfile: path to the file with checksums
+        :param string root_path: the path the files are relative to
+        :param string hash_algorithm: the algorithm of the checksums
+        :param hash_backend: the HashBackend to read the files with
+        :param int workers: number of worker processes to read the files
+            with, defaults to 1
+        :param relpaths: if given, only the files with these paths relative
+            to root_path are verified
+        :returns: a tuple with the number of files verified and a list of
+            tuples with the relative path and reason for each file that
+            failed verification
+    """
+    hash_backend = hash_backend or HashBackend()
+    expected = list(_digest_lines(digestfile))
+    if relpaths is not None:
+        relpaths = set(relpaths)
+        expected = [(digest, relpath) for digest, relpath in expected if relpath in relpaths]
+    filepaths = [path.join(root_path, relpath) for _, relpath in expected]
+    if workers > 1 and len(expected) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            observed = list(pool.map(
+                _compute_digest, [hash_backend] * len(filepaths), filepaths, [hash_algorithm] * len(filepaths)))
+    else:
+        observed = [_compute_digest(hash_backend, filepath, hash_algorithm) for filepath in filepaths]
+    verified = 0
+    failed = []
+    for (digest, relpath), (computed, error) in zip(expected, observed):
+        if error is not None:
+            failed.append((relpath, "could not be read: {}".format(error)))
+        elif computed != digest:
+            failed.append((relpath, "{} checksum {} does not match {}".format(hash_algorithm, computed, digest)))
+        else:
+            verified += 1
+    return verified, failed
+
+
+def _compute_digest(hash_backend, filepath, hash_algorithm):
+    # returns the error rather than raising it, so that one unreadable file
+    # does not hide the result of the others when run in a pool
+    try:
+        return hash_backend.compute_digests(filepath, [hash_algorithm])[hash_algorithm], None
+    except (IOError, OSError) as e:
+        return None, e
+
+
+class ResumableHash(object):
+    """ A hash whose intermediate state can be serialized and restored, which
+        is not possible with hashlib. It uses the low-level digest functions
+        of OpenSSL's libcrypto through ctypes, with the digest context copied
+        as an opaque blob. The state is therefore only valid for the same
+        version of libcrypto on the same platform. build() describes these
+        and has to be saved with each state, so that a state written by
+        another host or library version is not resumed, see
+        ChecksumIndex.load_checkpoint. When the library is first loaded, its
+        checksums of a short test string are compared to those of hashlib.
+    """
+    # algorithm: (prefix of the libcrypto functions, digest size)
+    ALGORITHMS = {
+        'md5': ('MD5', 16),
+        'sha1': ('SHA1', 20),
+        'sha224': ('SHA224', 28),
+        'sha256': ('SHA256', 32),
+        'sha384': ('SHA384', 48),
+        'sha512': ('SHA512', 64)}
+    # larger than any of the digest contexts
+    CONTEXT_SIZE = 512
+    _libcrypto = None
+    _build = None
+
+    @classmethod
+    def _load(cls):
+        if cls._libcrypto is None:
+            cls._libcrypto = False
+            libname = ctypes.util.find_library('crypto')
+            if libname is None:
+                return None
+            try:
+                lib = ctypes.CDLL(libname)
+                for prefix, _ in cls.ALGORITHMS.values():
+                    getattr(lib, '{}_Init'.format(prefix)).argtypes = [ctypes.c_void_p]
+                    getattr(lib, '{}_Update'.format(prefix)).argtypes = [
+                        ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]
+                    getattr(lib, '{}_Final'.format(prefix)).argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+                # OpenSSL_version replaced SSLeay_version in OpenSSL 1.1.0
+                version = getattr(lib, 'OpenSSL_version', None) or getattr(lib, 'SSLeay_version')
+                version.argtypes = [ctypes.c_int]
+                version.restype = ctypes.c_char_p
+                cls._build = "{} {} {}-endian context {}".format(
+                    version(0).decode('ascii', 'replace'), platform.machine(), sys.byteorder, cls.CONTEXT_SIZE)
+                cls._libcrypto = lib
+                for algorithm in cls.ALGORITHMS:
+                    hasher = cls(algorithm)
+                    hasher.update(bytearray(b'taca'))
+                    if hasher.hexdigest() != hashlib.new(algorithm, b'taca').hexdigest():
+                        raise ValueError("{} checksum differs from hashlib".format(algorithm))
+            except (OSError, AttributeError, ValueError) as e:
+                logger.debug("resumable checksums are not available: {}".format(e))
+                cls._libcrypto = False
+        return cls._libcrypto or None
+
+    @classmethod
+    def build(cls):
+        """
+            :returns: a description of the libcrypto version, platform and
+                context size the serialized states are valid for, or None if
+                resumable checksums are not available
+        """
+        return cls._build if cls._load() is not None else None
+
+    @classmethod
+    def supported(cls, hash_algorithms):
+        """
+            :returns: True if all the algorithms can be computed resumably
+        """
+        return all(algorithm in cls.ALGORITHMS for algorithm in hash_algorithms) and cls._load() is not None
+
+    def __init__(self, algorithm, state=None):
+        """
+            :param string algorithm: the hash algorithm
+            :param bytes state: a state returned by state() to resume from
+        """
+        lib = self._load()
+        if lib is None or algorithm not in self.ALGORITHMS:
+            raise ValueError("resumable {} checksums are not supported".format(algorithm))
+        prefix, self.digest_size = self.ALGORITHMS[algorithm]
+        self._update = getattr(lib, '{}_Update'.format(prefix))
+        self._final = getattr(lib, '{}_Final'.format(prefix))
+        if state is not None:
+            self._ctx = ctypes.create_string_buffer(state, self.CONTEXT_SIZE)
+        else:
+            self._ctx = ctypes.create_string_buffer(self.CONTEXT_SIZE)
+            getattr(lib, '{}_Init'.format(prefix))(self._ctx)
+
+    def update(self, data):
+        """ Hash a writable buffer, such as a bytearray or a memoryview of one """
+        size = len(data)
+        if size:
+            self._update(self._ctx, (ctypes.c_char * size).from_buffer(data), size)
+
+    def state(self):
+        """
+            :returns: the serialized state of the hash
+        """
+        return self._ctx.raw
+
+    def hexdigest(self):
+        # finalize a copy, so that the hash can still be updated
+        ctx = ctypes.create_string_buffer(self._ctx.raw, self.CONTEXT_SIZE)
+        digest = ctypes.create_string_buffer(self.digest_size)
+        self._final(digest, ctx)
+        return binascii.hexlify(digest.raw).decode('ascii')
+
+
+def benchmark_hash_backends(paths, backends, hash_algorithms=("md5",)):
+    """ Measure the throughput of hashing backends
+
+        :param list paths: the files to hash
+        :param list backends: HashBackend instances to measure
+        :param list hash_algorithms: the algorithms to compute for each file
+        :returns: a list with a dict for each backend, with the number of
+            files and bytes hashed, the elapsed time and the throughput in MB/s
+    """
+    results = []
+    for backend in backends:
+        nbytes = 0
+        start = time.time()
+        for sourcepath in paths:
+            backend.compute_digests(sourcepath, list(hash_algorithms))
+            nbytes += path.getsize(sourcepath)
+        elapsed = time.time() - start
+        results.append({
+            'backend': backend.method,
+            'chunk_size': backend.chunk_size if backend.method != 'hashfile' else HashBackend.HASHFILE_BLOCKSIZE,
+            'files': len(paths),
+            'bytes': nbytes,
+            'seconds': elapsed,
+            'mb_per_s': (nbytes / 1e6 / elapsed) if elapsed > 0 else None})
+    return results
+
+
+class _DirectoryCache(object):
+    """ Lists the directories visited when expanding file patterns with
+        os.scandir and remembers the listings, so that directories shared by
+        several patterns are only listed once and entries found in a listing
+        do not need to be stat'ed again.
+
+        iglob and walk give the same results, in the same order, as
+        glob.iglob (non-recursive) and os.walk(followlinks=True).
+    """
+    _magic = re.compile('([*?[])')
+
+    def __init__(self):
+        self._listings = {}
+
+    def listdir(self, dirpath):
+        """
+            :returns: a dict with the name of each entry in the directory
+                mapped to a tuple of whether it is a directory (following
+                symlinks) and whether it is a symlink. An empty dict is
+                returned if the directory could not be listed
+        """
+        try:
+            return self._listings[dirpath]
+        except KeyError:
+            pass
+        entries = {}
+        try:
+            with scandir(dirpath or curdir) as it:
+                for entry in it:
                     try:
-                        with open(checksumpath, 'w') as fh:
-                            fh.write(f'{digest}  {path.basename(sourcepath)}')
-                    except IOError as we:
-                        logger.warning("could not write checksum {} to file {}: {}".format(digest, checksumpath, we))
-        return sourcepath, destpath, digest
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    try:
+                        is_symlink = entry.is_symlink()
+                    except OSError:
+                        is_symlink = False
+                    entries[entry.name] = (is_dir, is_symlink)
+        except OSError:
+            pass
+        self._listings[dirpath] = entries
+        return entries
+
+    def _entry(self, filepath):
+        # look the path up in the listing of its parent, if that has been listed
+        parent, name = path.split(filepath)
+        return self._listings.get(parent, {}).get(name)
+
+    def isdir(self, filepath):
+        entry = self._entry(filepath)
+        return path.isdir(filepath) if entry is None else entry[0]
+
+    def exists(self, filepath):
+        entry = self._entry(filepath)
+        return path.exists(filepath) if entry is None or entry[1] else True
+
+    def lexists(self, filepath):
+        return self._entry(filepath) is not None or path.lexists(filepath)
+
+    def _has_magic(self, pattern):
+        return self._magic.search(pattern) is not None
+
+    def iglob(self, pattern, dironly=False):
+        dirname, basename = path.split(pattern)
+        if not self._has_magic(pattern):
+            if basename:
+                if self.lexists(pattern):
+                    yield pattern
+            # patterns ending with a separator only match directories
+            elif self.isdir(dirname):
+                yield pattern
+            return
+        if not dirname:
+            for name in self._glob_in_dir(dirname, basename, dironly):
+                yield name
+            return
+        if dirname != pattern and self._has_magic(dirname):
+            dirs = self.iglob(dirname, dironly=True)
+        else:
+            dirs = [dirname]
+        for dirname in dirs:
+            if self._has_magic(basename):
+                names = self._glob_in_dir(dirname, basename, dironly)
+            elif basename:
+                names = [basename] if self.lexists(path.join(dirname, basename)) else []
+            else:
+                names = [basename] if self.isdir(dirname) else []
+            for name in names:
+                yield path.join(dirname, name)
+
+    def _glob_in_dir(self, dirname, pattern, dironly):
+        names = [name for name, (is_dir, _) in self.listdir(dirname).items() if is_dir or not dironly]
+        # hidden files are only matched by patterns starting with a dot
+        if not pattern.startswith('.'):
+            names = [name for name in names if not name.startswith('.')]
+        return fnmatch.filter(names, pattern)
+
+    def walk(self, top):
+        entries = self.listdir(top)
+        dirs = [name for name, (is_dir, _) in entries.items() if is_dir]
+        files = [name for name, (is_dir, _) in entries.items() if not is_dir]
+        yield top, dirs, files
+        for dirname in dirs:
+            for walked in self.walk(path.join(top, dirname)):
+                yield walked
+
+
+def _expand_patterns(patterns, checksum_extensions):
+    """ Expand the file patterns into the matching source and destination
+        paths. Folders are traversed to include everything beneath and
+        checksum files are skipped. The directory listings are shared between
+        the patterns, so each directory is only listed once.
+
+        :returns: A generator of tuples with source path, destination path and
+            the dict with extra options for the pattern
+        :raises FileNotFoundException: if a required path does not exist
+        :raises PatternNotMatchedException: if a required pattern does not
+            match any files
+    """
+    directories = _DirectoryCache()
 
     def _walk_files(currpath, destpath):
         # if current path is a folder, return all files below it
-        if path.isdir(currpath):
+        if directories.isdir(currpath):
             parent = path.dirname(currpath)
-            for parentdir, _, dirfiles in walk(currpath, followlinks=True):
+            for parentdir, _, dirfiles in directories.walk(currpath):
                 for currfile in dirfiles:
                     fullpath = path.join(parentdir, currfile)
                     # the relative path will be used in the destination path
@@ -82,18 +930,14 @@ def gather_files(patterns, no_checksum=False, hash_algorithm="md5"):
         except IndexError:
             extra = {}
         matches = 0
-        for f in iglob(sfile):
+        for f in directories.iglob(sfile):
             for spath, dpath in _walk_files(f, dfile):
                 # ignore checksum files
-                if not spath.endswith(".{}".format(hash_algorithm)):
+                if not spath.endswith(checksum_extensions):
                     matches += 1
                     # skip and warn if a path does not exist, this includes broken symlinks
-                    if path.exists(spath):
-                        yield _get_digest(
-                            spath,
-                            dpath,
-                            no_digest_cache=extra.get('no_digest_cache', False),
-                            no_digest=extra.get('no_digest', False))
+                    if directories.exists(spath):
+                        yield spath, dpath, extra
                     else:
                         # if the file pattern requires a match, throw an error. otherwise warn
                         msg = "path {} does not exist, possibly because of a broken symlink".format(spath)
@@ -140,3 +984,192 @@ def merge_dicts(mdict, sdict):
         else:
             mdict[k] = v
     return mdict
+
+
+def link_or_copy(src, dst, strategies=DEFAULT_LINK_STRATEGIES, copy_threads=1):
+    """ Put a file in place at dst by trying each of the strategies in turn
+        until one succeeds: 'reflink' clones the file, sharing its data until
+        either copy is modified, 'hardlink' links dst to the same file as src
+        and 'copy' copies the data with copy_file. Reflinks and hardlinks are
+        only tried if dst is on the same filesystem as src. Symlinks are
+        followed.
+
+        A hardlinked dst is the same file as src, so e.g. a chmod or chown of
+        dst also applies to src. Hardlinks are therefore not tried unless
+        they are among the strategies.
+
+        :param string src: the file to put in place
+        :param string dst: the path to put it at, which must not exist unless
+            it is copied
+        :param strategies: the strategies to try, in order, defaults to
+            DEFAULT_LINK_STRATEGIES
+        :param int copy_threads: number of threads to copy large files with,
+            see copy_file
+        :returns: a tuple with the strategy used and the number of bytes
+            written
+        :raises OSError: if the last strategy failed
+    """
+    src = path.realpath(src)
+    same_filesystem = stat(src).st_dev == stat(path.dirname(path.abspath(dst))).st_dev
+    error = None
+    for strategy in strategies:
+        if strategy != 'copy' and not same_filesystem:
+            continue
+        try:
+            if strategy == 'reflink':
+                _reflink(src, dst)
+                return strategy, 0
+            if strategy == 'hardlink':
+                link(src, dst)
+                return strategy, 0
+            if strategy == 'copy':
+                return strategy, copy_file(src, dst, threads=copy_threads)['bytes']
+            raise ValueError("unknown strategy: {}".format(strategy))
+        except (IOError, OSError) as e:
+            logger.debug("could not {} {} to {}: {}".format(strategy, src, dst, e))
+            error = e
+    raise error or OSError("could not put {} in place at {}".format(src, dst))
+
+
+def link_or_copy_tree(src, dst, strategies=DEFAULT_LINK_STRATEGIES, copy_threads=1):
+    """ Recreate a folder with the files put in place by link_or_copy, like
+        shutil.copytree does with symlinks followed
+
+        :param string src: the folder to recreate
+        :param string dst: the path to recreate it at, which must not exist
+        :param strategies: the strategies to try for each file, in order
+        :param int copy_threads: number of threads to copy large files with,
+            see copy_file
+        :returns: a list of tuples with the path of each file relative to
+            dst, the strategy used and the number of bytes written
+    """
+    placed = []
+
+    def _place(srcpath, dstpath):
+        strategy, written = link_or_copy(srcpath, dstpath, strategies=strategies, copy_threads=copy_threads)
+        placed.append((path.relpath(dstpath, dst), strategy, written))
+        return dstpath
+
+    shutil.copytree(src, dst, copy_function=_place)
+    return placed
+
+
+def _reflink(src, dst):
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+    with open(src, 'rb') as sh, open(dst, 'xb') as dh:
+        try:
+            fcntl.ioctl(dh.fileno(), FICLONE, sh.fileno())
+        except (IOError, OSError):
+            dh.close()
+            unlink(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def copy_file(src, dst, threads=1, chunk_size=COPY_CHUNK_SIZE, min_range_size=COPY_MIN_RANGE_SIZE):
+    """ Copy a file and its permissions and timestamps, like shutil.copy2,
+        without passing the data through user space. The data is copied with
+        os.copy_file_range, which lets the filesystem copy it on the server
+        side or clone it where supported, or with os.sendfile if that is not
+        possible. Reading and writing is the last resort. A file of at least
+        twice min_range_size is split into up to threads ranges, which are
+        copied concurrently.
+
+        :param string src: the file to copy, symlinks are followed
+        :param string dst: the path to copy it to, not a folder
+        :param int threads: the maximum number of ranges to copy concurrently
+        :param int chunk_size: the number of bytes to copy with each call
+        :param int min_range_size: the smallest number of bytes to copy in a
+            separate thread
+        :returns: a dict with the number of bytes copied, the seconds it took,
+            the throughput in bytes/s and the way the data was copied
+    """
+    start = time.time()
+    size = stat(src).st_size
+    nranges = max(1, min(threads, size // max(min_range_size, 1)))
+    # align the ranges to the chunks, the last range takes the remainder
+    range_size = -(-size // nranges // chunk_size) * chunk_size if nranges > 1 else size
+    ranges = [(offset, min(range_size, size - offset)) for offset in range(0, size, range_size or 1)]
+    fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+    if len(ranges) > 1:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+            methods = list(pool.map(lambda r: _copy_range(src, dst, r[0], r[1], chunk_size), ranges))
+    else:
+        methods = [_copy_range(src, dst, offset, length, chunk_size) for offset, length in ranges]
+    shutil.copystat(src, dst)
+    seconds = time.time() - start
+    result = {
+        'bytes': size,
+        'seconds': seconds,
+        'bytes_per_s': size / seconds if seconds > 0 else None,
+        'method': ",".join(sorted(set(methods))) or 'copy_file_range',
+        'ranges': len(ranges)}
+    logger.info("copied {} bytes from {} to {} in {:.1f} s ({:.1f} MB/s, {} in {} ranges)".format(
+        size, src, dst, seconds, (result['bytes_per_s'] or 0) / 1e6, result['method'], result['ranges']))
+    return result
+
+
+def _copy_range(src, dst, offset, length, chunk_size):
+    """ Copy length bytes at offset of src to the same offset of dst, each
+        range with its own file descriptors so that they can be copied
+        concurrently
+
+        :returns: the way the data was copied
+    """
+    infd = os.open(src, os.O_RDONLY)
+    try:
+        outfd = os.open(dst, os.O_WRONLY)
+        try:
+            for method in ('copy_file_range', 'sendfile'):
+                try:
+                    _copy_range_with(method, infd, outfd, offset, length, chunk_size)
+                    return method
+                except _CopyNotSupported as e:
+                    # nothing has been written yet, so the next method can start over
+                    logger.debug("could not {} {}: {}".format(method, src, e))
+            os.lseek(outfd, offset, os.SEEK_SET)
+            remaining = length
+            while remaining > 0:
+                data = os.pread(infd, min(chunk_size, remaining), offset + length - remaining)
+                if not data:
+                    raise IOError("{} was truncated while copying".format(src))
+                remaining -= os.write(outfd, data)
+            return 'read_write'
+        finally:
+            os.close(outfd)
+    finally:
+        os.close(infd)
+
+
+class _CopyNotSupported(Exception):
+    pass
+
+
+def _copy_range_with(method, infd, outfd, offset, length, chunk_size):
+    if method == 'copy_file_range' and not hasattr(os, 'copy_file_range') or \
+            method == 'sendfile' and not hasattr(os, 'sendfile'):
+        raise _CopyNotSupported("{} is not available".format(method))
+    os.lseek(outfd, offset, os.SEEK_SET)
+    copied = 0
+    while copied < length:
+        try:
+            if method == 'copy_file_range':
+                n = os.copy_file_range(infd, outfd, min(chunk_size, length - copied), offset + copied)
+            else:
+                n = os.sendfile(outfd, infd, offset + copied, min(chunk_size, length - copied))
+        except OSError as e:
+            # e.g. copying between filesystems on older kernels
+            if copied == 0 and e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP):
+                raise _CopyNotSupported(e)
+            raise
+        if n == 0:
+            if copied == 0:
+                # some filesystems report no data rather than an error
+                raise _CopyNotSupported("no data was copied")
+            raise IOError("the source was truncated while copying")
+        copied += n
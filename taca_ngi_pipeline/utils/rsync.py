@@ -0,0 +1,607 @@
+""" Helpers for splitting up and running rsync transfers
+"""
+import datetime
+import heapq
+import json
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from io import open
+from logging import getLogger
+from taca.utils import transfer
+
+logger = getLogger(__name__)
+
+RSYNC_LOG_SUFFIXES = ("_rsync.out", "_rsync.err")
+
+# where rsync keeps partially transferred files, relative to their destination folder
+PARTIAL_DIR = ".rsync-partial"
+
+# the commands that check files against a digest file on a remote host
+REMOTE_CHECKSUM_COMMANDS = {
+    'md5': 'md5sum',
+    'sha1': 'sha1sum',
+    'sha224': 'sha224sum',
+    'sha256': 'sha256sum',
+    'sha384': 'sha384sum',
+    'sha512': 'sha512sum',
+    'blake2b': 'b2sum'}
+
+# a line of output from rsync --info=progress2, e.g.
+#   1,238,099,968  45%   98.76MB/s    0:00:12 (xfr#3, to-chk=10/20)
+PROGRESS_LINE = re.compile(
+    r'^\s*(?P<bytes>[\d,]+)\s+(?P<percent>\d+)%\s+(?P<rate>\S+)\s+(?P<eta>\d+:\d{2}:\d{2})'
+    r'(?:\s+\(xfr#(?P<files>\d+), (?:to|ir)-chk=(?P<remaining>\d+)/(?P<total>\d+)\))?')
+
+
+def read_file_list(filelist):
+    """
+        :param string filelist: path to a file with one path per line, as
+            given to rsync --files-from
+        :returns: a list of the paths in the file
+    """
+    with open(filelist, 'r') as fh:
+        return [line.rstrip('\n') for line in fh if line.strip()]
+
+
+def write_file_list(filelist, paths):
+    """ Write paths to a file with one path per line, as read by rsync
+        --files-from
+
+        :param string filelist: path to the file to write
+        :param list paths: the paths to write
+    """
+    with open(filelist, 'w') as fh:
+        for fpath in paths:
+            fh.write(u"{}\n".format(fpath))
+
+
+def file_sizes(paths, root):
+    """
+        :param list paths: paths to files, relative to root
+        :param string root: the folder the paths are relative to
+        :returns: a list with the size of each file, following symlinks, or
+            0 if the file does not exist
+    """
+    sizes = []
+    for fpath in paths:
+        try:
+            sizes.append(os.stat(os.path.join(root, fpath)).st_size)
+        except OSError:
+            sizes.append(0)
+    return sizes
+
+
+def shard_files(paths, root, shards):
+    """ Split a list of files into shards with roughly the same number of
+        bytes, by adding the files from largest to smallest to the shard with
+        the fewest bytes so far. Symlinks are followed, since the files are
+        transferred with --copy-links.
+
+        :param list paths: paths to the files, relative to root
+        :param string root: the folder the paths are relative to
+        :param int shards: the number of shards to split the files into
+        :returns: a list of shards, each a tuple with the number of bytes and
+            a list of paths in the order they were given. Empty shards are
+            left out.
+    """
+    sizes = [(size, index, fpath) for index, (fpath, size) in enumerate(zip(paths, file_sizes(paths, root)))]
+    # a heap of (bytes, shard number, indexes of the files)
+    heap = [(0, shard, []) for shard in range(max(1, shards))]
+    for size, index, fpath in sorted(sizes, key=lambda s: (-s[0], s[1])):
+        nbytes, shard, indexes = heapq.heappop(heap)
+        indexes.append(index)
+        heapq.heappush(heap, (nbytes + size, shard, indexes))
+    return [(nbytes, [paths[index] for index in sorted(indexes)])
+            for nbytes, _, indexes in sorted(heap, key=lambda h: h[1]) if indexes]
+
+
+def merge_logs(prefixes, prefix):
+    """ Append the rsync logs written with each of a number of log prefixes
+        to the logs with a common prefix and remove them
+
+        :param list prefixes: the log prefixes to merge
+        :param string prefix: the log prefix to merge into
+    """
+    for suffix in RSYNC_LOG_SUFFIXES:
+        with open("{}{}".format(prefix, suffix), 'a') as merged:
+            for shard_prefix in prefixes:
+                shard_log = "{}{}".format(shard_prefix, suffix)
+                if not os.path.exists(shard_log):
+                    continue
+                merged.write(u"### {}\n".format(os.path.basename(shard_prefix)))
+                with open(shard_log, 'r') as fh:
+                    for line in fh:
+                        merged.write(line)
+                os.unlink(shard_log)
+
+
+class TransferProgress(object):
+    """ Collects the progress reported by the rsync processes of a delivery
+        and reports the overall progress periodically, as a log message and
+        as a JSON status file that can be monitored while the delivery is
+        running. The status file holds a record with the bytes and files
+        transferred, the current throughput in MB/s, averaged since the
+        previous record, and the estimated time left in seconds.
+    """
+
+    def __init__(self, name, statusfile=None, interval=60, total_bytes=None, total_files=None):
+        """
+            :param string name: the name of the delivery, used in the log
+            :param string statusfile: path to the JSON status file to write
+            :param float interval: minimum number of seconds between records
+            :param int total_bytes: the number of bytes to transfer, if known
+            :param int total_files: the number of files to transfer, if known
+        """
+        self.name = name
+        self.statusfile = statusfile
+        self.interval = interval
+        self.total_bytes = total_bytes
+        self.total_files = total_files
+        self.started = time.time()
+        self.streams = {}
+        self._lock = threading.Lock()
+        self._reported = (self.started, 0)
+        self._next_report = self.started + interval
+
+    def update(self, stream, bytes_done, files_done=None, percent=None, files_total=None):
+        """ Update the progress of an rsync process and report the overall
+            progress if interval seconds have passed since the last record
+
+            :param stream: identifies the rsync process
+            :param int bytes_done: bytes transferred by the process so far
+            :param int files_done: files transferred by the process so far
+            :param int percent: the percentage of its bytes the process has
+                transferred, used to estimate the total if it is not known
+            :param int files_total: the number of files the process checks
+        """
+        with self._lock:
+            self.streams[stream] = {
+                'bytes': bytes_done,
+                'files': files_done or 0,
+                'percent': percent,
+                'files_total': files_total}
+            if time.time() >= self._next_report:
+                self._report()
+
+    def finish(self, status):
+        """ Write the final record
+
+            :param string status: the outcome of the transfer, e.g. 'done' or
+                'failed'
+            :returns: the final record
+        """
+        with self._lock:
+            return self._report(status=status)
+
+    def _estimated_total(self):
+        if self.total_bytes is not None:
+            return self.total_bytes
+        total = 0
+        for progress in self.streams.values():
+            if not progress['percent']:
+                return None
+            total += progress['bytes'] * 100 // progress['percent']
+        return total
+
+    def _report(self, status='running'):
+        now = time.time()
+        bytes_done = sum(progress['bytes'] for progress in self.streams.values())
+        files_done = sum(progress['files'] for progress in self.streams.values())
+        previous_time, previous_bytes = self._reported
+        elapsed = now - previous_time
+        rate = (bytes_done - previous_bytes) / elapsed if elapsed > 0 else 0.
+        total_bytes = self._estimated_total()
+        eta = None
+        if status == 'running' and total_bytes is not None and rate > 0:
+            eta = max(0, int((total_bytes - bytes_done) / rate))
+        record = {
+            'delivery': self.name,
+            'status': status,
+            'timestamp': datetime.datetime.now().isoformat(),
+            'elapsed_seconds': int(now - self.started),
+            'bytes_done': bytes_done,
+            'bytes_total': total_bytes,
+            'files_done': files_done,
+            'files_total': self.total_files,
+            'streams': len(self.streams),
+            'current_mb_per_s': round(rate / 1e6, 2),
+            'average_mb_per_s': round(bytes_done / (now - self.started) / 1e6, 2) if now > self.started else 0.,
+            'eta_seconds': eta}
+        self._reported = (now, bytes_done)
+        self._next_report = now + self.interval
+        logger.info("transfer of {} {}: {} of {} bytes and {} files done, {} MB/s, ETA {} s".format(
+            self.name, status, bytes_done, total_bytes if total_bytes is not None else "?", files_done,
+            record['current_mb_per_s'], eta if eta is not None else "?"))
+        if self.statusfile is not None:
+            try:
+                with open("{}.tmp".format(self.statusfile), 'w') as fh:
+                    fh.write(json.dumps(record, indent=2))
+                os.rename("{}.tmp".format(self.statusfile), self.statusfile)
+            except (IOError, OSError) as e:
+                logger.warning("could not write transfer status to {}: {}".format(self.statusfile, e))
+        return record
+
+
+class ProgressRsyncAgent(transfer.RsyncAgent):
+    """ An RsyncAgent that follows the output of rsync while the transfer is
+        running. With a TransferProgress, rsync is run with --info=progress2
+        and the progress is reported to it. With a TransferJournal, each file
+        is recorded in the journal once it has been transferred. Other output
+        is written to the transfer log like with RsyncAgent.
+    """
+
+    # rsync delays the output until the file has been transferred if %b is included
+    COMPLETED_FORMAT = "completed: %b %n"
+    COMPLETED_LINE = re.compile(r'^completed: \d+ (?P<path>.+)$')
+
+    def __init__(self, src_path, progress=None, stream=0, journal=None, **kwargs):
+        """
+            :param string src_path: the file or folder that should be transferred
+            :param TransferProgress progress: where to report the progress
+            :param stream: identifies this transfer to the progress
+            :param TransferJournal journal: where to record the transferred files
+            :param kwargs: passed on to taca.utils.transfer.RsyncAgent
+        """
+        super(ProgressRsyncAgent, self).__init__(src_path, **kwargs)
+        self.progress = progress
+        self.stream = stream
+        self.journal = journal
+
+    def command(self):
+        """
+            :returns: the rsync command line as a list
+        """
+        command = [self.CMD] + self.format_options()
+        if self.progress is not None:
+            command.append('--info=progress2')
+        if self.journal is not None:
+            command.append('--out-format={}'.format(self.COMPLETED_FORMAT))
+        return command + [self.src_path, self.remote_path()]
+
+    def transfer(self, transfer_log=None):
+        """ Execute the transfer as set up by this instance and, if requested,
+            validate the transfer.
+
+            :param string transfer_log: path prefix to log files where stderr
+                and stdout streams will be directed if this option is specified
+            :returns True on success, False if the validation failed
+            :raises transfer.TransferError: if src_path or dest_path were not valid
+            :raises transfer.RsyncError: if the rsync command did not exit successfully
+        """
+        self.validate_src_path()
+        self.validate_dest_path()
+        command = self.command()
+        out = err = process = None
+        try:
+            if transfer_log is not None:
+                out = open("{}_rsync.out".format(transfer_log), 'a')
+                err = open("{}_rsync.err".format(transfer_log), 'a')
+                out.write(u"Started command {} on {}\n".format(" ".join(command), datetime.datetime.now()))
+            try:
+                process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=err)
+            except OSError as e:
+                raise transfer.RsyncError(e, self.src_path, self.dest_path)
+            for line in _lines(process.stdout):
+                if self._parse_progress(line):
+                    continue
+                self._parse_completed(line)
+                if out is not None and line.strip():
+                    out.write(u"{}\n".format(line))
+            returncode = process.wait()
+        finally:
+            if process is not None:
+                process.stdout.close()
+                # e.g. when interrupted, rsync should not be left running
+                if process.poll() is None:
+                    process.terminate()
+                    process.wait()
+            for fh in (out, err):
+                if fh is not None:
+                    fh.close()
+        if returncode != 0:
+            raise transfer.RsyncError(
+                "The command {} failed with exit status {}".format(" ".join(command), returncode),
+                self.src_path, self.dest_path)
+        return (not self.validate) or self.validate_transfer()
+
+    def _parse_progress(self, line):
+        if self.progress is None:
+            return False
+        m = PROGRESS_LINE.match(line)
+        if m is None:
+            return False
+        files_total = m.group('total')
+        self.progress.update(
+            self.stream,
+            int(m.group('bytes').replace(',', '')),
+            files_done=int(m.group('files') or 0),
+            percent=int(m.group('percent')),
+            files_total=int(files_total) if files_total is not None else None)
+        return True
+
+    def _parse_completed(self, line):
+        if self.journal is None:
+            return
+        m = self.COMPLETED_LINE.match(line)
+        # folders are listed with a trailing slash
+        if m is not None and not m.group('path').endswith('/'):
+            self.journal.record(m.group('path'))
+
+
+class TransferJournal(object):
+    """ A journal of the files that have been transferred to a destination,
+        so that an interrupted transfer can be resumed without sending those
+        files again. Each file is recorded with the size and modification
+        time of its source, so a file that has been modified since it was
+        transferred will be sent again.
+    """
+
+    def __init__(self, journalpath, root):
+        """
+            :param string journalpath: path to the journal file
+            :param string root: the folder the recorded paths are relative to
+        """
+        self.journalpath = journalpath
+        self.root = root
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+            :returns: a dict with the recorded size and modification time in
+                ns for each recorded path
+        """
+        entries = {}
+        try:
+            with open(self.journalpath, 'r') as fh:
+                for line in fh:
+                    try:
+                        entry = json.loads(line)
+                        entries[entry['path']] = (entry['size'], entry['mtime_ns'])
+                    except (ValueError, KeyError, TypeError):
+                        # the last line may be incomplete if the transfer was interrupted
+                        continue
+        except IOError:
+            pass
+        return entries
+
+    def record(self, fpath):
+        """ Record a file as transferred
+
+            :param string fpath: the path of the file, relative to root
+        """
+        try:
+            st = os.stat(os.path.join(self.root, fpath))
+        except OSError as e:
+            logger.warning("could not record {} in transfer journal {}: {}".format(fpath, self.journalpath, e))
+            return
+        line = json.dumps({'path': fpath, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns})
+        with self._lock:
+            with open(self.journalpath, 'a') as fh:
+                fh.write(u"{}\n".format(line))
+
+    def pending(self, paths, transferred=None):
+        """ Find the files that have not been transferred since they were last
+            modified
+
+            :param list paths: paths to the files, relative to root
+            :param transferred: a function that is given a path and the
+                recorded size and returns False if the file nevertheless needs
+                to be sent again, e.g. if it is missing at the destination
+            :returns: a tuple with a list of the paths to transfer and the
+                number of bytes of the files that do not need to be transferred
+        """
+        entries = self.load()
+        pending = []
+        skipped = 0
+        for fpath in paths:
+            entry = entries.get(fpath)
+            if entry is not None:
+                try:
+                    st = os.stat(os.path.join(self.root, fpath))
+                    if (st.st_size, st.st_mtime_ns) == tuple(entry) and \
+                            (transferred is None or transferred(fpath, entry[0])):
+                        skipped += st.st_size
+                        continue
+                except OSError:
+                    pass
+            pending.append(fpath)
+        return pending, skipped
+
+    def clear(self):
+        """ Remove the journal """
+        if os.path.exists(self.journalpath):
+            os.unlink(self.journalpath)
+
+
+def ssh_command(control_path, ssh='ssh'):
+    """
+        :param string control_path: the control socket of an ssh master
+            connection, see SshMaster
+        :param string ssh: the ssh command
+        :returns: an ssh command line for rsync --rsh that multiplexes its
+            session over the master connection, or opens a connection of its
+            own if the master is not running
+    """
+    return "{} -o ControlMaster=no -o ControlPath={}".format(ssh, control_path)
+
+
+class SshMaster(object):
+    """ An ssh master connection to a remote host, which the rsync transfers
+        to that host can share instead of each logging in on its own, see
+        ssh_command. The connection is started in the background when the
+        context is entered and closed when it is left. If the connection
+        could not be started, control_path is None and the transfers will
+        open their own connections.
+
+        The connection also closes itself after it has been idle for persist
+        seconds, so it is not left behind if this process is killed.
+    """
+
+    def __init__(self, remote_host, remote_user=None, persist=600, ssh='ssh'):
+        """
+            :param string remote_host: the host to connect to
+            :param string remote_user: the user to log in as, if any
+            :param int persist: seconds to keep the connection open when idle
+            :param string ssh: the ssh command
+        """
+        self.remote_host = remote_host
+        self.remote_user = remote_user
+        self.persist = persist
+        self.ssh = ssh
+        self.control_dir = None
+        self.control_path = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def destination(self):
+        """
+            :returns: the remote host, prefixed with the remote user if any
+        """
+        if self.remote_user is None:
+            return self.remote_host
+        return "{}@{}".format(self.remote_user, self.remote_host)
+
+    def start(self):
+        """ Start the master connection in the background
+
+            :returns: the path to the control socket, or None if the
+                connection could not be started
+        """
+        self.control_dir = tempfile.mkdtemp(prefix="taca_ssh_")
+        control_path = os.path.join(self.control_dir, "%C")
+        command = [
+            self.ssh, '-M', '-N', '-f',
+            '-o', 'BatchMode=yes',
+            '-o', 'ControlPath={}'.format(control_path),
+            '-o', 'ControlPersist={}'.format(self.persist),
+            self.destination()]
+        # the backgrounded ssh keeps its stderr open, so it cannot be a pipe
+        errfile = os.path.join(self.control_dir, "ssh.err")
+        try:
+            with open(os.devnull, 'r') as devnull, open(errfile, 'w') as err:
+                returncode = subprocess.call(command, stdin=devnull, stdout=err, stderr=err)
+        except OSError as e:
+            returncode, message = None, str(e)
+        else:
+            with open(errfile, 'r') as fh:
+                message = fh.read().strip()
+        if returncode != 0:
+            logger.warning("could not open a shared ssh connection to {}, rsync will connect on its own: {}".format(
+                self.destination(), message))
+            self._remove_control_dir()
+            return None
+        logger.info("opened a shared ssh connection to {}".format(self.destination()))
+        self.control_path = control_path
+        return self.control_path
+
+    def stop(self):
+        """ Close the master connection, if it is running """
+        if self.control_path is not None:
+            try:
+                with open(os.devnull, 'w') as devnull:
+                    subprocess.call(
+                        [self.ssh, '-o', 'ControlPath={}'.format(self.control_path), '-O', 'exit',
+                         self.destination()],
+                        stdin=devnull, stdout=devnull, stderr=devnull)
+            except OSError as e:
+                logger.warning("could not close the shared ssh connection to {}: {}".format(
+                    self.destination(), e))
+            else:
+                logger.info("closed the shared ssh connection to {}".format(self.destination()))
+            self.control_path = None
+        self._remove_control_dir()
+
+    def _remove_control_dir(self):
+        if self.control_dir is not None:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+            self.control_dir = None
+
+
+def verify_remote_digest_file(digestfile, remote_host, root_path, hash_algorithm, remote_user=None,
+                              control_path=None, workers=1, ssh='ssh'):
+    """ Verify files on a remote host against a local file with checksums,
+        like taca_ngi_pipeline.utils.filesystem.verify_digest_file, by
+        running e.g. md5sum --check on the remote host. The files are split
+        between workers concurrent ssh sessions, which share the connection
+        of an SshMaster if its control_path is given.
+
+        :param string digestfile: path to the local file with checksums
+        :param string remote_host: the host the files are on
+        :param string root_path: the path on the remote host the files are
+            relative to
+        :param string hash_algorithm: the algorithm of the checksums
+        :param string remote_user: the user to log in as, if any
+        :param string control_path: the control socket of an SshMaster
+        :param int workers: number of concurrent ssh sessions
+        :param string ssh: the ssh command
+        :returns: a tuple with the number of files verified and a list of
+            tuples with the relative path and reason for each file that
+            failed verification
+        :raises transfer.TransferError: if the files could not be checked
+    """
+    destination = remote_host if remote_user is None else "{}@{}".format(remote_user, remote_host)
+    if hash_algorithm not in REMOTE_CHECKSUM_COMMANDS:
+        raise transfer.TransferError(
+            "{} checksums can not be verified on a remote host".format(hash_algorithm), digestfile, destination)
+    with open(digestfile, 'r') as fh:
+        lines = [line.strip() for line in fh if line.strip()]
+    command = [ssh, '-o', 'BatchMode=yes']
+    if control_path is not None:
+        command.extend(['-o', 'ControlMaster=no', '-o', 'ControlPath={}'.format(control_path)])
+    command.extend([destination, "cd {} && {} --check --quiet -".format(
+        shlex.quote(root_path), REMOTE_CHECKSUM_COMMANDS[hash_algorithm])])
+
+    def _check(shard):
+        try:
+            process = subprocess.Popen(
+                command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                universal_newlines=True)
+        except OSError as e:
+            raise transfer.TransferError(e, digestfile, destination)
+        out, err = process.communicate(u"".join(u"{}\n".format(line) for line in shard))
+        # only the files that failed are listed, as "path: FAILED" or "path: FAILED open or read"
+        failed = []
+        for line in out.splitlines():
+            relpath, sep, reason = line.rpartition(": ")
+            if sep and reason.startswith("FAILED"):
+                failed.append((relpath, reason))
+        if process.returncode != 0 and not failed:
+            raise transfer.TransferError(
+                "The command {} failed with exit status {}: {}".format(
+                    " ".join(command), process.returncode, err.strip()), digestfile, destination)
+        return len(shard) - len(failed), failed
+
+    shards = [shard for shard in (lines[n::workers] for n in range(max(workers, 1))) if shard]
+    with ThreadPoolExecutor(max_workers=max(len(shards), 1)) as pool:
+        results = list(pool.map(_check, shards))
+    return sum(verified for verified, _ in results), [f for _, failed in results for f in failed]
+
+
+def _lines(fh):
+    """ Iterate over the lines written to a pipe as they come, where progress
+        updates are terminated by carriage returns rather than newlines
+    """
+    pending = b""
+    for chunk in iter(lambda: os.read(fh.fileno(), 65536), b""):
+        pending += chunk
+        parts = re.split(b"[\r\n]", pending)
+        pending = parts.pop()
+        for part in parts:
+            yield part.decode('utf-8', 'replace')
+    fh.close()
+    if pending:
+        yield pending.decode('utf-8', 'replace')
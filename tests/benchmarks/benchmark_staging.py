@@ -0,0 +1,246 @@
+""" Benchmarks for gathering and staging files for delivery
+
+    Generates synthetic analysis trees shaped like the deliveries described in
+    delivery_readmes/ and times filesystem.gather_files,
+    Deliverer.stage_delivery and filesystem.parse_hash_file on them. The
+    results are printed as JSON, so that they can be tracked between releases:
+
+        python tests/benchmarks/benchmark_staging.py --samples 4 --output results.json
+
+    This is not a unit test and is not collected by the test runners.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from unittest import mock
+
+import taca_ngi_pipeline
+from taca_ngi_pipeline.deliver import deliver
+from taca_ngi_pipeline.utils import filesystem as fs
+
+# the files of each delivery shape, as (path, size class, count) where the
+# path may contain <SAMPLEID> and <N>, the latter replaced by 1..count
+SHAPES = {
+    'RAW_DATA': [
+        ("02-FASTQ/FC0001/<SAMPLEID>_S1_L00<N>_R1_001.fastq.gz", 'large', 4),
+        ("02-FASTQ/FC0001/<SAMPLEID>_S1_L00<N>_R2_001.fastq.gz", 'large', 4),
+        ("00-Reports/manifestFiles/<SAMPLEID>.02-FASTQ.FC0001.P0001_101_<N>_manifest.txt", 'small', 4),
+    ],
+    'RNASeq': [
+        ("02-FASTQ/FC0001/<SAMPLEID>_S1_L00<N>_R1_001.fastq.gz", 'large', 2),
+        ("02-FASTQ/FC0001/<SAMPLEID>_S1_L00<N>_R2_001.fastq.gz", 'large', 2),
+        ("01-RNA-Results/star/<SAMPLEID>.Aligned.sortedByCoord.out.bam", 'large', 1),
+        ("01-RNA-Results/star/<SAMPLEID>.Log.final.out", 'small', 1),
+        ("01-RNA-Results/featureCounts/<SAMPLEID>.featureCounts.txt", 'medium', 1),
+        ("01-RNA-Results/MultiQC/multiqc_data/<SAMPLEID>_multiqc_<N>.txt", 'small', 40),
+        ("01-RNA-Results/rseqc/<SAMPLEID>/plot_<N>.pdf", 'small', 20),
+    ],
+    'Sarek': [
+        ("02-FASTQ/FC0001/<SAMPLEID>_S1_L00<N>_R1_001.fastq.gz", 'large', 2),
+        ("02-FASTQ/FC0001/<SAMPLEID>_S1_L00<N>_R2_001.fastq.gz", 'large', 2),
+        ("01-SarekGermline-Results/Preprocessing/<SAMPLEID>/Recalibrated/<SAMPLEID>.recal.bam", 'large', 1),
+        ("01-SarekGermline-Results/Preprocessing/<SAMPLEID>/Recalibrated/<SAMPLEID>.recal.bam.bai", 'medium', 1),
+        ("01-SarekGermline-Results/VariantCalling/<SAMPLEID>/HaplotypeCaller/<SAMPLEID>.chr<N>.g.vcf.gz", 'medium', 24),
+        ("01-SarekGermline-Results/Reports/<SAMPLEID>/multiqc_data/<SAMPLEID>_<N>.txt", 'small', 60),
+    ],
+    'MethylSeq': [
+        ("02-FASTQ/FC0001/<SAMPLEID>_S1_L00<N>_R1_001.fastq.gz", 'large', 2),
+        ("01-MethylSeq-Results/bismark_alignments/<SAMPLEID>.deduplicated.bam", 'large', 1),
+        ("01-MethylSeq-Results/bismark_methylation_calls/<SAMPLEID>.CpG_report_<N>.txt.gz", 'medium', 6),
+        ("01-MethylSeq-Results/qualimap/<SAMPLEID>/raw_data_qualimapReport/coverage_<N>.txt", 'small', 30),
+    ],
+}
+
+SIZES = {'small': 4 * 1024, 'medium': 256 * 1024, 'large': 4 * 1024 * 1024}
+
+
+def _write_file(filepath, size, block):
+    with open(filepath, 'wb') as fh:
+        for _ in range(size // len(block)):
+            fh.write(block)
+        fh.write(block[:size % len(block)])
+
+
+def create_tree(rootdir, shape, samples, scale, symlink_depth):
+    """ Create an analysis tree for a delivery shape. The real files are
+        written below rootdir/DATA and reached from rootdir/ANALYSIS through
+        chains of symlink_depth symlinks, the way the pipelines link fastq
+        files into their output folders.
+
+        :returns: a tuple with the sample ids and the total number of files
+            and bytes
+    """
+    block = os.urandom(64 * 1024)
+    sampleids = ["P0001_{:03d}".format(i + 1) for i in range(samples)]
+    nfiles = nbytes = 0
+    for sampleid in sampleids:
+        for template, sizeclass, count in SHAPES[shape]:
+            for n in range(count * (scale if sizeclass == 'small' else 1)):
+                relpath = template.replace('<SAMPLEID>', sampleid).replace('<N>', str(n + 1))
+                datapath = os.path.join(rootdir, 'DATA', sampleid, relpath)
+                os.makedirs(os.path.dirname(datapath), exist_ok=True)
+                _write_file(datapath, SIZES[sizeclass], block)
+                linkpath = datapath
+                for depth in range(symlink_depth):
+                    nextpath = os.path.join(rootdir, 'LINKS{}'.format(depth), sampleid, relpath)
+                    os.makedirs(os.path.dirname(nextpath), exist_ok=True)
+                    os.symlink(linkpath, nextpath)
+                    linkpath = nextpath
+                analysispath = os.path.join(rootdir, 'ANALYSIS', sampleid, relpath)
+                os.makedirs(os.path.dirname(analysispath), exist_ok=True)
+                os.symlink(linkpath, analysispath)
+                nfiles += 1
+                nbytes += SIZES[sizeclass]
+    return sampleids, nfiles, nbytes
+
+
+def files_to_deliver(shape):
+    """ A files_to_deliver config for a shape, with a pattern per kind of file
+        like the production configs have
+    """
+    patterns = [["<ANALYSISPATH>/<SAMPLEID>/02-FASTQ/*/<SAMPLEID>_*.fastq.gz", "<STAGINGPATH>/02-FASTQ",
+                 {'required': True}]]
+    for template, _, _ in SHAPES[shape]:
+        topdir = template.split('/')[0]
+        if topdir == '00-Reports':
+            pattern = ["<ANALYSISPATH>/<SAMPLEID>/{}".format(topdir), "<STAGINGPATH>", {'no_digest_cache': True}]
+        elif topdir.startswith('01-'):
+            pattern = ["<ANALYSISPATH>/<SAMPLEID>/{}".format(topdir), "<STAGINGPATH>"]
+        else:
+            continue
+        if pattern not in patterns:
+            patterns.append(pattern)
+    return patterns
+
+
+def _remove_digest_caches(rootdir, hash_algorithm):
+    for dirpath, _, filenames in os.walk(rootdir):
+        for filename in filenames:
+            if filename.endswith(".{}".format(hash_algorithm)):
+                os.unlink(os.path.join(dirpath, filename))
+
+
+def _timed(fn, repeat, setup=None):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return timings, result
+
+
+def _result(shape, benchmark, timings, nfiles, nbytes):
+    return {
+        'shape': shape,
+        'benchmark': benchmark,
+        'files': nfiles,
+        'bytes': nbytes,
+        'seconds': timings,
+        'min_seconds': min(timings),
+        'median_seconds': statistics.median(timings),
+        'files_per_s': nfiles / min(timings) if min(timings) > 0 else None}
+
+
+def _deliverer(rootdir, sampleid, args, shape):
+    config = {
+        'rootdir': rootdir,
+        'analysispath': '<ROOTDIR>/ANALYSIS',
+        'stagingpath': '<ROOTDIR>/STAGING/<SAMPLEID>',
+        'logpath': '<ROOTDIR>/logs',
+        'hash_algorithm': args.hash_algorithm,
+        'hash_workers': args.hash_workers,
+        'files_to_deliver': files_to_deliver(shape)}
+    # the benchmark should not depend on a tracking database
+    with mock.patch.object(deliver.db, 'dbcon'):
+        return deliver.Deliverer('P0001', sampleid, uppnexid='a2099999', **config)
+
+
+def run_shape(shape, args):
+    rootdir = tempfile.mkdtemp(prefix="taca_benchmark_{}_".format(shape), dir=args.tmpdir)
+    try:
+        sampleids, nfiles, nbytes = create_tree(rootdir, shape, args.samples, args.scale, args.symlink_depth)
+        deliverers = [_deliverer(rootdir, sampleid, args, shape) for sampleid in sampleids]
+
+        def _gather(no_checksum):
+            for d in deliverers:
+                d.no_checksum = no_checksum
+                list(d.gather_files())
+
+        def _stage():
+            for d in deliverers:
+                d.stage_delivery()
+
+        def _clean_staging():
+            shutil.rmtree(os.path.join(rootdir, 'STAGING'), ignore_errors=True)
+
+        def _clean_caches():
+            _remove_digest_caches(os.path.join(rootdir, 'DATA'), args.hash_algorithm)
+            _remove_digest_caches(os.path.join(rootdir, 'ANALYSIS'), args.hash_algorithm)
+
+        results = []
+        timings, _ = _timed(lambda: _gather(True), args.repeat)
+        results.append(_result(shape, 'gather_files_no_checksum', timings, nfiles, nbytes))
+        timings, _ = _timed(lambda: _gather(False), args.repeat, setup=_clean_caches)
+        results.append(_result(shape, 'gather_files_checksum', timings, nfiles, nbytes))
+        timings, _ = _timed(lambda: _gather(False), args.repeat)
+        results.append(_result(shape, 'gather_files_cached_checksum', timings, nfiles, nbytes))
+        for d in deliverers:
+            d.no_checksum = False
+        timings, _ = _timed(_stage, args.repeat, setup=lambda: (_clean_staging(), _clean_caches()))
+        results.append(_result(shape, 'stage_delivery', timings, nfiles, nbytes))
+        digestfiles = [d.staging_digestfile() for d in deliverers]
+        timings, _ = _timed(
+            lambda: [fs.parse_hash_file(
+                digestfile, "2020-01-01", hash_algorithm=args.hash_algorithm, root_path=os.path.dirname(digestfile))
+                for digestfile in digestfiles],
+            args.repeat)
+        results.append(_result(shape, 'parse_hash_file', timings, nfiles, nbytes))
+        return results
+    finally:
+        shutil.rmtree(rootdir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shape', action='append', choices=sorted(SHAPES),
+                        help="delivery shape to benchmark, can be given multiple times (default: all)")
+    parser.add_argument('--samples', type=int, default=2, help="number of samples per shape")
+    parser.add_argument('--scale', type=int, default=1, help="multiplier for the number of small files")
+    parser.add_argument('--symlink-depth', type=int, default=1,
+                        help="number of symlinks between the analysis tree and the data")
+    parser.add_argument('--hash-algorithm', default='md5')
+    parser.add_argument('--hash-workers', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3, help="number of times to run each benchmark")
+    parser.add_argument('--tmpdir', help="directory to create the trees in, e.g. on the filesystem to measure")
+    parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    results = []
+    for shape in args.shape or sorted(SHAPES):
+        results.extend(run_shape(shape, args))
+    report = {
+        'version': taca_ngi_pipeline.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': dict((k, v) for k, v in vars(args).items() if k != 'output'),
+        'results': results}
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(report, fh, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == '__main__':
+    main()
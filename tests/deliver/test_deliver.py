@@ -6,13 +6,16 @@ from unittest import mock
 import os
 import shutil
 import signal
+import subprocess
 import taca_ngi_pipeline.utils.filesystem
 import tempfile
+import time
 import unittest
 
 from ngi_pipeline.database import classes as db
 from taca_ngi_pipeline.deliver import deliver
 from taca_ngi_pipeline.utils import filesystem as fs
+from taca_ngi_pipeline.utils import rsync
 from taca.utils.filesystem import create_folder
 from taca.utils.misc import hashfile
 from taca.utils.transfer import SymlinkError, SymlinkAgent
@@ -417,6 +420,133 @@ class TestDeliverer(unittest.TestCase):
             [os.path.exists(e) for e in expected],
             [True for _ in range(len(expected))])
 
+    def test_stage_delivery4(self):
+        """ A digest file should be written for each hash algorithm """
+        pattern = SAMPLECFG['deliver']['files_to_deliver'][5]
+        self.deliverer.files_to_deliver = [pattern]
+        self.deliverer.extra_hash_algorithms = ['sha1', 'md5']
+        self.deliverer.stage_delivery()
+        spath = self.deliverer.expand_path(pattern[0])
+        for algorithm in ['md5', 'sha1']:
+            with open(self.deliverer.staging_digestfile(algorithm), 'r') as fh:
+                self.assertEqual(
+                    fh.read(),
+                    u"{}  level0_folder0_file0\n".format(hashfile(spath, hasher=algorithm)))
+        with open(self.deliverer.staging_filelist(), 'r') as fh:
+            self.assertListEqual(
+                fh.read().split(),
+                ["level0_folder0_file0", "NGIU-S001.md5", "NGIU-S001.sha1"])
+
+    def test_stage_delivery_fast_manifest(self):
+        """ Fast checksums should be written to a manifest in the log path
+            and be usable for verifying a copy of the staged files
+        """
+        pattern = SAMPLECFG['deliver']['files_to_deliver'][5]
+        self.deliverer.files_to_deliver = [pattern]
+        self.deliverer.fast_hash_algorithm = 'blake2b'
+        self.deliverer.stage_delivery()
+        spath = self.deliverer.expand_path(pattern[0])
+        with open(self.deliverer.staging_digestfile(), 'r') as fh:
+            self.assertEqual(fh.read(), u"{}  level0_folder0_file0\n".format(hashfile(spath, hasher='md5')))
+        with open(self.deliverer.staging_filelist(), 'r') as fh:
+            self.assertListEqual(fh.read().split(), ["level0_folder0_file0", "NGIU-S001.md5"])
+        manifest = self.deliverer.staging_fast_manifest()
+        self.assertTrue(manifest.startswith(self.deliverer.expand_path(self.deliverer.logpath)))
+        with open(manifest, 'r') as fh:
+            self.assertEqual(fh.read(), u"{}  level0_folder0_file0\n".format(hashfile(spath, hasher='blake2b')))
+        self.assertFalse(os.path.exists("{}.blake2b".format(spath)))
+        # the staging manifest is only written for incremental stagings
+        self.assertFalse(os.path.exists(self.deliverer.staging_manifest()))
+        stagingpath = self.deliverer.expand_path(self.deliverer.stagingpath)
+        # the copy is only verified when asked to
+        self.assertIsNone(self.deliverer.verify_staged_copy(stagingpath))
+        self.deliverer.verify_staged_copies = True
+        self.assertEqual(self.deliverer.verify_staged_copy(stagingpath), 1)
+        with open(spath, 'w') as fh:
+            fh.write(u"modified")
+        with self.assertRaises(deliver.DelivererError):
+            self.deliverer.verify_staged_copy(stagingpath)
+
+    def test_stage_delivery_incremental(self):
+        """ An incremental staging should only restage the modified files and
+            unstage the files that are no longer delivered
+        """
+        patterns = [SAMPLECFG['deliver']['files_to_deliver'][5],
+                    ['<ANALYSISPATH>/level0_folder0_file1', '<STAGINGPATH>']]
+        self.deliverer.files_to_deliver = patterns
+        self.deliverer.incremental_staging = True
+        with self.assertLogs(deliver.logger, level='INFO') as cm:
+            self.deliverer.stage_delivery()
+        self.assertIn("2 added, 0 changed, 0 removed and 0 unchanged", "\n".join(cm.output))
+        manifest = self.deliverer.read_staging_manifest()
+        self.assertListEqual(sorted(manifest.keys()), ["level0_folder0_file0", "level0_folder0_file1"])
+        spath = self.deliverer.expand_path(patterns[0][0])
+        self.assertEqual(manifest["level0_folder0_file0"]['digests'], {'md5': hashfile(spath, hasher='md5')})
+        stagingpath = self.deliverer.expand_path(self.deliverer.stagingpath)
+        os.utime(spath, ns=(0, 0))
+        with mock.patch.object(deliver.transfer.SymlinkAgent, 'transfer', autospec=True,
+                               side_effect=deliver.transfer.SymlinkAgent.transfer) as transfermock:
+            with self.assertLogs(deliver.logger, level='INFO') as cm:
+                self.deliverer.stage_delivery()
+        self.assertIn("0 added, 1 changed, 0 removed and 1 unchanged", "\n".join(cm.output))
+        self.assertListEqual([call[0][0].src_path for call in transfermock.call_args_list], [spath])
+        self.assertTrue(os.path.islink(os.path.join(stagingpath, "level0_folder0_file0")))
+        # a file which is no longer delivered should be unstaged
+        self.deliverer.files_to_deliver = patterns[0:1]
+        with self.assertLogs(deliver.logger, level='INFO') as cm:
+            self.deliverer.stage_delivery()
+        self.assertIn("0 added, 0 changed, 1 removed and 1 unchanged", "\n".join(cm.output))
+        self.assertFalse(os.path.lexists(os.path.join(stagingpath, "level0_folder0_file1")))
+        with open(self.deliverer.staging_filelist(), 'r') as fh:
+            self.assertListEqual(fh.read().split(), ["level0_folder0_file0", "NGIU-S001.md5"])
+
+    def test_stage_delivery_atomic(self):
+        """ An atomic staging should not touch the staging path until it is
+            done and an interrupted staging should be resumed
+        """
+        patterns = [SAMPLECFG['deliver']['files_to_deliver'][5],
+                    ['<ANALYSISPATH>/level0_folder0_file1', '<STAGINGPATH>/sub']]
+        self.deliverer.files_to_deliver = patterns
+        self.deliverer.atomic_staging = True
+        stagingpath = self.deliverer.expand_path(self.deliverer.stagingpath)
+        workdir = self.deliverer.staging_workdir()
+        self.assertEqual(os.path.dirname(workdir), os.path.dirname(stagingpath))
+        transfer = deliver.transfer.SymlinkAgent.transfer
+
+        def _interrupt(agent):
+            if agent.src_path.endswith("file1"):
+                raise deliver.DelivererInterruptedError("mocked interruption")
+            return transfer(agent)
+
+        with mock.patch.object(deliver.transfer.SymlinkAgent, 'transfer', autospec=True, side_effect=_interrupt):
+            with self.assertRaises(deliver.DelivererInterruptedError):
+                self.deliverer.stage_delivery()
+        self.assertFalse(os.path.exists(stagingpath))
+        self.assertTrue(os.path.islink(os.path.join(workdir, "level0_folder0_file0")))
+        self.assertListEqual(list(self.deliverer.read_staging_journal().keys()), ["level0_folder0_file0"])
+        # the next run should only stage the remaining file
+        with mock.patch.object(deliver.transfer.SymlinkAgent, 'transfer', autospec=True,
+                               side_effect=transfer) as transfermock:
+            self.assertTrue(self.deliverer.stage_delivery())
+        self.assertListEqual(
+            [call[0][0].dest_path for call in transfermock.call_args_list],
+            [os.path.join(workdir, "sub", "level0_folder0_file1")])
+        self.assertFalse(os.path.exists(workdir))
+        self.assertFalse(os.path.exists(self.deliverer.staging_journal()))
+        for fpath in ("level0_folder0_file0", os.path.join("sub", "level0_folder0_file1")):
+            self.assertTrue(os.path.islink(os.path.join(stagingpath, fpath)))
+            self.assertTrue(os.path.exists(os.path.join(stagingpath, fpath)))
+        with open(self.deliverer.staging_filelist(), 'r') as fh:
+            self.assertListEqual(
+                fh.read().split(), ["level0_folder0_file0", "sub/level0_folder0_file1", "NGIU-S001.md5"])
+        # publishing into an existing staging path should merge the folders
+        with open(os.path.join(stagingpath, "sub", "another_file"), 'w') as fh:
+            fh.write(u"another file")
+        self.assertTrue(self.deliverer.stage_delivery())
+        self.assertListEqual(sorted(os.listdir(os.path.join(stagingpath, "sub"))),
+                             ["another_file", "level0_folder0_file1"])
+        self.assertFalse(os.path.exists(workdir))
+
     def test_expand_path(self):
         """ Paths should expand correctly """
         cases = [
@@ -440,6 +570,27 @@ class TestDeliverer(unittest.TestCase):
         with self.assertRaises(deliver.DelivererError):
             self.deliverer.expand_path("this-path-<WONT>-be-touched")
 
+    def test_expand_path_cached(self):
+        """ Expanded paths should be cached for the attribute values they were built from """
+        self.deliverer.should = 'was-<NESTED>'
+        self.deliverer.nested = 'to'
+        path = "this-path-<SHOULD>-be-touched"
+        self.assertEqual(self.deliverer.expand_path(path), "this-path-was-to-be-touched")
+        with mock.patch.object(deliver.PathTemplate, 'expand') as expandmock:
+            self.assertEqual(self.deliverer.expand_path(path), "this-path-was-to-be-touched")
+            expandmock.assert_not_called()
+        self.deliverer.nested = 'not-to'
+        self.assertEqual(self.deliverer.expand_path(path), "this-path-was-not-to-be-touched")
+        self.deliverer.__dict__['nested'] = 'to'
+        self.assertEqual(self.deliverer.expand_path(path), "this-path-was-to-be-touched")
+        del self.deliverer.nested
+        with self.assertRaises(deliver.DelivererError):
+            self.deliverer.expand_path(path)
+        template = deliver.PathTemplate.compile("<ROOT>/a/<SAMPLE>/b")
+        self.assertIs(template, deliver.PathTemplate.compile("<ROOT>/a/<SAMPLE>/b"))
+        self.assertListEqual(template.literals, ["", "/a/", "/b"])
+        self.assertListEqual(template.attributes, ["root", "sample"])
+
     def test_acknowledge_sample_delivery(self):
         """ A delivery acknowledgement should be written if requirements are met
         """
@@ -556,6 +707,22 @@ class TestProjectDeliverer(unittest.TestCase):
             dbmock().project_get_samples.assert_called_with(PROJECTENTRY['projectid'])
         PROJECTENTRY['samples'] = [SAMPLEENTRY]
 
+    def test_deliver_samples(self):
+        """ Samples should be delivered concurrently with several workers """
+        def _deliver_sample(sample_deliverer, sampleentry=None):
+            if sample_deliverer.sampleid == 'NGIU-S003':
+                raise deliver.DelivererError("mocked failure")
+            return sample_deliverer.sampleid != 'NGIU-S002'
+
+        self.deliverer.workers = 2
+        with mock.patch.object(deliver.db, 'dbcon', autospec=db.CharonSession), \
+                mock.patch.object(deliver.SampleDeliverer, 'deliver_sample', autospec=True,
+                                  side_effect=_deliver_sample):
+            self.assertTrue(self.deliverer.deliver_samples(['NGIU-S001', 'NGIU-S004']))
+            self.assertFalse(self.deliverer.deliver_samples(['NGIU-S001', 'NGIU-S002', 'NGIU-S004']))
+            with self.assertRaises(deliver.DelivererError):
+                self.deliverer.deliver_samples(['NGIU-S001', 'NGIU-S002', 'NGIU-S003', 'NGIU-S004'])
+
     def test_create_project_report(self):
         """ creating the project report """
         with mock.patch.object(deliver,'call_external_command') as syscall:
@@ -564,6 +731,48 @@ class TestProjectDeliverer(unittest.TestCase):
                 " ".join(syscall.call_args[0][0]),
                 SAMPLECFG['deliver']['report_aggregate'])
 
+    def test_create_sample_reports(self):
+        """ Reports for all ready samples should be created at once """
+        sampleentries = [
+            {'sampleid': 'NGIU-S001', 'analysis_status': 'ANALYZED', 'status': 'STAGED'},
+            {'sampleid': 'NGIU-S002', 'analysis_status': 'TO_ANALYZE', 'status': 'STAGED'},
+            {'sampleid': 'NGIU-S003', 'analysis_status': 'ANALYZED', 'status': 'ABORTED'},
+            {'sampleid': 'NGIU-S004', 'analysis_status': 'ANALYZED', 'status': 'STAGED',
+             'delivery_status': 'DELIVERED'},
+            {'sampleid': 'NGIU-S005', 'analysis_status': 'ANALYZED', 'status': 'STAGED',
+             'delivery_status': 'FAILED'}]
+        with mock.patch.object(deliver, 'call_external_command') as syscall:
+            self.assertListEqual(
+                self.deliverer.create_sample_reports(sampleentries), ['NGIU-S001', 'NGIU-S005'])
+            self.assertEqual(syscall.call_count, 2)
+            self.assertEqual(
+                " ".join(syscall.call_args_list[0][0][0]),
+                "{} --samples NGIU-S001 NGIU-S005".format(SAMPLECFG['deliver']['report_sample']))
+            self.assertEqual(
+                " ".join(syscall.call_args_list[1][0][0][:-1]),
+                "{} --samples_extra".format(SAMPLECFG['deliver']['report_aggregate']))
+            self.assertListEqual(
+                sorted(json.loads(syscall.call_args_list[1][0][0][-1]).keys()), ['NGIU-S001', 'NGIU-S005'])
+            syscall.reset_mock()
+            self.assertListEqual(self.deliverer.create_sample_reports(sampleentries[1:4]), [])
+            syscall.assert_not_called()
+
+    def test_reason_not_to_deliver(self):
+        """ The statuses of a sample should decide whether it is delivered """
+        sampleentry = {'analysis_status': 'ANALYZED', 'status': 'STAGED', 'delivery_status': 'FAILED'}
+        self.assertIsNone(self.deliverer.reason_not_to_deliver(sampleentry))
+        for key, value, reason in [('analysis_status', 'TO_ANALYZE', 'NOT_ANALYZED'),
+                                   ('delivery_status', 'DELIVERED', 'DELIVERED'),
+                                   ('delivery_status', 'IN_PROGRESS', 'IN_PROGRESS'),
+                                   ('status', 'ABORTED', 'ABORTED'),
+                                   ('status', 'FRESH', 'FRESH')]:
+            self.assertEqual(self.deliverer.reason_not_to_deliver(dict(sampleentry, **{key: value})), reason)
+        # a forced delivery only skips aborted samples
+        self.deliverer.force = True
+        for key, value in [('analysis_status', 'TO_ANALYZE'), ('delivery_status', 'DELIVERED'), ('status', 'FRESH')]:
+            self.assertIsNone(self.deliverer.reason_not_to_deliver(dict(sampleentry, **{key: value})))
+        self.assertEqual(self.deliverer.reason_not_to_deliver(dict(sampleentry, status='ABORTED')), 'ABORTED')
+
     def test_copy_project_report(self):
         """ Copy the project report to the specified report outbox"""
         with mock.patch.object(shutil, 'copyfile') as syscall:
@@ -707,6 +916,215 @@ class TestSampleDeliverer(unittest.TestCase):
                     for d, _, files in os.walk(destination) for f in files]
         self.assertEqual(sorted(observed), sorted(expected))
 
+    def test_rsync_agent_ssh_control_path(self):
+        """ share the ssh connection of a master when delivering to a remote host
+        """
+        filelist = self.deliverer.staging_filelist()
+        self.deliverer.ssh_control_path = "/tmp/ssh/%C"
+        self.assertNotIn('--rsh', self.deliverer.rsync_agent(filelist).cmdopts)
+        self.deliverer.remote_host = "remote.host"
+        self.assertEqual(
+            self.deliverer.rsync_agent(filelist).cmdopts['--rsh'],
+            "ssh -o ControlMaster=no -o ControlPath=/tmp/ssh/%C")
+        self.deliverer.ssh_control_path = None
+        self.assertNotIn('--rsh', self.deliverer.rsync_agent(filelist).cmdopts)
+
+    def test_do_sharded_delivery(self):
+        """ transfer a sample using several rsync streams
+        """
+        digestfile = self.deliverer.staging_digestfile()
+        filelist = self.deliverer.staging_filelist()
+        basedir = os.path.dirname(digestfile)
+        create_folder(os.path.join(basedir, "folder"))
+        expected = []
+        with open(digestfile, 'w') as dh:
+            for n in range(5):
+                rpath = os.path.join("folder", "file{}".format(n))
+                with open(os.path.join(basedir, rpath), 'w') as fh:
+                    fh.write(u"x" * 100 * n)
+                dh.write(u"{}  {}\n".format(hashfile(os.path.join(basedir, rpath), hasher='md5'), rpath))
+                expected.append(rpath)
+        expected.append(os.path.basename(digestfile))
+        with open(filelist, 'w') as fh:
+            fh.write(u"\n".join(expected))
+        destination = self.deliverer.expand_path(self.deliverer.deliverypath)
+
+        def _rsync(agent, transfer_log=None):
+            # copy the listed files like rsync would
+            with open("{}_rsync.out".format(transfer_log), 'w') as log:
+                for rpath in rsync.read_file_list(agent.cmdopts['--files-from'][0]):
+                    create_folder(os.path.dirname(os.path.join(agent.dest_path, rpath)))
+                    shutil.copyfile(os.path.join(agent.src_path, rpath), os.path.join(agent.dest_path, rpath))
+                    log.write(u"{}\n".format(rpath))
+            return True
+
+        self.deliverer.rsync_streams = 3
+        with mock.patch.object(deliver.transfer.RsyncAgent, 'transfer', autospec=True,
+                               side_effect=_rsync) as transfermock, \
+                mock.patch.object(deliver.SampleDeliverer, 'transfer_log',
+                                  return_value=os.path.join(self.casedir, "logs", "transfer")):
+            self.assertTrue(self.deliverer.do_delivery())
+            self.assertEqual(transfermock.call_count, 3)
+            self.assertTrue(all(not call[0][0].validate for call in transfermock.call_args_list))
+        observed = [os.path.relpath(os.path.join(d, f), destination)
+                    for d, _, files in os.walk(destination) for f in files]
+        self.assertListEqual(sorted(observed), sorted(expected))
+        with open(os.path.join(self.casedir, "logs", "transfer_rsync.out")) as fh:
+            self.assertListEqual(sorted(line for line in fh.read().split() if line != "###" and
+                                        not line.startswith("transfer.shard")), sorted(expected))
+        self.assertListEqual(sorted(os.listdir(os.path.join(self.casedir, "logs"))),
+                             ["transfer_rsync.err", "transfer_rsync.out"])
+        # a corrupt delivery should fail validation
+        with open(os.path.join(destination, expected[1]), 'w') as fh:
+            fh.write(u"corrupt")
+        with mock.patch.object(deliver.transfer.RsyncAgent, 'transfer', autospec=True, return_value=True):
+            self.assertFalse(self.deliverer.do_delivery())
+        with mock.patch.object(deliver.transfer.RsyncAgent, 'transfer', autospec=True,
+                               side_effect=deliver.transfer.RsyncError("mocked failure")):
+            with self.assertRaises(deliver.DelivererRsyncError):
+                self.deliverer.do_delivery()
+
+    def test_do_resumable_delivery(self):
+        """ a failed delivery should be resumed where it stopped
+        """
+        digestfile = self.deliverer.staging_digestfile()
+        basedir = os.path.dirname(digestfile)
+        create_folder(basedir)
+        expected = []
+        with open(digestfile, 'w') as dh:
+            for n in range(4):
+                rpath = "file{}".format(n)
+                with open(os.path.join(basedir, rpath), 'w') as fh:
+                    fh.write(u"x" * 10)
+                dh.write(u"{}  {}\n".format(hashfile(os.path.join(basedir, rpath), hasher='md5'), rpath))
+                expected.append(rpath)
+        expected.append(os.path.basename(digestfile))
+        rsync.write_file_list(self.deliverer.staging_filelist(), expected)
+        destination = self.deliverer.expand_path(self.deliverer.deliverypath)
+        transferred = []
+        failures = [True]
+
+        def _rsync(agent, transfer_log=None):
+            # copy the listed files like rsync would, but fail after two files the first time
+            self.assertEqual(agent.cmdopts['--partial-dir'], rsync.PARTIAL_DIR)
+            for rpath in rsync.read_file_list(agent.cmdopts['--files-from'][0]):
+                if failures and len(transferred) == 2:
+                    failures.pop()
+                    raise deliver.transfer.RsyncError("mocked failure")
+                create_folder(destination)
+                shutil.copyfile(os.path.join(agent.src_path, rpath), os.path.join(destination, rpath))
+                agent.journal.record(rpath)
+                transferred.append(rpath)
+            return agent.validate_transfer()
+
+        self.deliverer.resumable_delivery = True
+        with mock.patch.object(rsync.ProgressRsyncAgent, 'transfer', autospec=True, side_effect=_rsync):
+            with self.assertRaises(deliver.DelivererRsyncError):
+                self.deliverer.do_delivery()
+            self.assertListEqual(sorted(self.transfer_journal_entries()), expected[0:2])
+            del transferred[:]
+            with self.assertLogs(deliver.logger, level='INFO') as cm:
+                self.assertTrue(self.deliverer.do_delivery())
+        self.assertListEqual(transferred, expected[2:])
+        self.assertIn("skipping 20 bytes", "\n".join(cm.output))
+        self.assertFalse(os.path.exists(self.deliverer.transfer_journal()))
+        self.assertListEqual(sorted(os.listdir(destination)), sorted(expected))
+
+    def test_verify_delivered_files(self):
+        """ the delivered files should be verified against the delivered digest file
+        """
+        destination = self.deliverer.expand_path(self.deliverer.deliverypath)
+        create_folder(destination)
+        self.assertIsNone(self.deliverer.verify_delivered_files())
+        with open(self.deliverer.delivered_digestfile(), 'w') as dh:
+            for n in range(4):
+                fpath = os.path.join(destination, "file{}".format(n))
+                with open(fpath, 'w') as fh:
+                    fh.write(u"x" * n)
+                dh.write(u"{}  file{}\n".format(hashfile(fpath, hasher='md5'), n))
+        self.deliverer.verify_workers = 2
+        self.assertEqual(self.deliverer.verify_delivered_files(), 4)
+        with open(os.path.join(destination, "file2"), 'a') as fh:
+            fh.write(u"x")
+        with self.assertRaises(deliver.DelivererError):
+            self.deliverer.verify_delivered_files()
+
+    def test_do_delivery_skip_delivered(self):
+        """ files delivered with the same checksum should not be transferred again
+        """
+        digestfile = self.deliverer.staging_digestfile()
+        basedir = os.path.dirname(digestfile)
+        destination = self.deliverer.expand_path(self.deliverer.deliverypath)
+        create_folder(basedir)
+        create_folder(destination)
+        with open(digestfile, 'w') as dh, open(self.deliverer.delivered_digestfile(), 'w') as ddh:
+            for n in range(4):
+                rpath = "file{}".format(n)
+                with open(os.path.join(basedir, rpath), 'w') as fh:
+                    fh.write(u"x" * 10)
+                digest = hashfile(os.path.join(basedir, rpath), hasher='md5')
+                dh.write(u"{}  {}\n".format(digest, rpath))
+                # file0 and file1 are delivered, file2 with another checksum and file3 not at all
+                if n < 3:
+                    shutil.copyfile(os.path.join(basedir, rpath), os.path.join(destination, rpath))
+                    ddh.write(u"{}  {}\n".format(digest if n < 2 else "0" * 32, rpath))
+        os.unlink(os.path.join(destination, "file1"))
+        shutil.copyfile(os.path.join(basedir, "file0"), os.path.join(destination, "file1"))
+        with open(os.path.join(destination, "file1"), 'a') as fh:
+            fh.write(u"x")
+        rsync.write_file_list(
+            self.deliverer.staging_filelist(),
+            ["file{}".format(n) for n in range(4)] + [os.path.basename(digestfile)])
+        transferred = []
+
+        def _rsync(agent, transfer_log=None):
+            transferred.extend(rsync.read_file_list(agent.cmdopts['--files-from'][0]))
+            return True
+
+        self.deliverer.skip_delivered = True
+        with mock.patch.object(deliver.transfer.RsyncAgent, 'transfer', autospec=True, side_effect=_rsync):
+            self.assertTrue(self.deliverer.do_delivery())
+        self.assertListEqual(transferred, ["file1", "file2", "file3", os.path.basename(digestfile)])
+        self.assertFalse(os.path.exists("{}.lst".format(self.deliverer.transfer_log())))
+
+    def test_do_delivery_skip_delivered_remote(self):
+        """ files delivered to a remote host should be compared to the recorded checksums
+        """
+        digestfile = self.deliverer.staging_digestfile()
+        basedir = os.path.dirname(digestfile)
+        create_folder(basedir)
+        with open(digestfile, 'w') as dh:
+            for n in range(3):
+                rpath = "file{}".format(n)
+                with open(os.path.join(basedir, rpath), 'w') as fh:
+                    fh.write(u"x" * 10)
+                dh.write(u"{}  {}\n".format(hashfile(os.path.join(basedir, rpath), hasher='md5'), rpath))
+        rsync.write_file_list(
+            self.deliverer.staging_filelist(),
+            ["file{}".format(n) for n in range(3)] + [os.path.basename(digestfile)])
+        transferred = []
+
+        def _rsync(agent, transfer_log=None):
+            transferred.append(rsync.read_file_list(agent.cmdopts['--files-from'][0]))
+            return True
+
+        self.deliverer.remote_host = "remote.host"
+        self.deliverer.skip_delivered = True
+        with mock.patch.object(deliver.transfer.RsyncAgent, 'transfer', autospec=True, side_effect=_rsync):
+            self.assertTrue(self.deliverer.do_delivery())
+            self.assertTrue(os.path.exists(self.deliverer.delivered_digest_record()))
+            # restage file1 with another checksum
+            with open(digestfile, 'r') as fh:
+                lines = fh.readlines()
+            with open(digestfile, 'w') as fh:
+                fh.writelines([lines[0], u"{}  file1\n".format("0" * 32), lines[2]])
+            self.assertTrue(self.deliverer.do_delivery())
+        self.assertListEqual(transferred[0], ["file0", "file1", "file2", os.path.basename(digestfile)])
+        self.assertListEqual(transferred[1], ["file1", os.path.basename(digestfile)])
+
+    def transfer_journal_entries(self):
+        return rsync.TransferJournal(self.deliverer.transfer_journal(), None).load().keys()
+
     def test_acknowledge_sample_delivery(self):
         """ A sample delivery acknowledgement should be written to disk """
         ackfile = os.path.join(
@@ -740,6 +1158,77 @@ class TestSampleDeliverer(unittest.TestCase):
             SAMPLEENTRY.get('analysis_status'))
         dbmock().sample_get.assert_called_with(self.projectid, SAMPLEENTRY.get('sampleid'))
 
+    def test_create_report_async(self):
+        """ Report patterns should be staged after the background report
+            creation has finished
+        """
+        analysispath = self.deliverer.expand_path(self.deliverer.analysispath)
+        os.makedirs(analysispath)
+        with open(os.path.join(analysispath, "sample_data"), 'w') as fh:
+            fh.write(u"data")
+        self.deliverer.files_to_deliver = [
+            ['<ANALYSISPATH>/<SAMPLEID>_ign_sample_report.html', '<STAGINGPATH>'],
+            ['<ANALYSISPATH>/sample_data', '<STAGINGPATH>', {'required': True}]]
+        self.assertTrue(self.deliverer.is_report_pattern(self.deliverer.files_to_deliver[0]))
+        self.assertFalse(self.deliverer.is_report_pattern(self.deliverer.files_to_deliver[1]))
+        self.assertFalse(self.deliverer.is_report_pattern(
+            ['<ANALYSISPATH>/<SAMPLEID>_ign_sample_report.html', '<STAGINGPATH>', {'report': False}]))
+        # other reports are not created by the report commands
+        self.assertFalse(self.deliverer.is_report_pattern(['<ANALYSISPATH>/multiqc_report.html', '<STAGINGPATH>']))
+        self.assertTrue(self.deliverer.is_report_pattern(
+            ['<ANALYSISPATH>/multiqc_report.html', '<STAGINGPATH>', {'report': True}]))
+
+        def _create_report(deliverer):
+            time.sleep(0.5)
+            with open(os.path.join(analysispath, "NGIU-S001_ign_sample_report.html"), 'w') as fh:
+                fh.write(u"report")
+
+        with mock.patch.object(deliver.SampleDeliverer, 'create_report', autospec=True, side_effect=_create_report):
+            self.deliverer.create_report_async()
+            self.assertTrue(self.deliverer.stage_delivery())
+        self.assertIsNone(self.deliverer.wait_for_report())
+        with open(self.deliverer.staging_filelist(), 'r') as fh:
+            self.assertListEqual(fh.read().split(), ["sample_data", "NGIU-S001_ign_sample_report.html", "NGIU-S001.md5"])
+
+        with mock.patch.object(deliver.SampleDeliverer, 'create_report', autospec=True,
+                               side_effect=Exception("mocked failure")):
+            self.deliverer.create_report_async()
+            self.assertFalse(self.deliverer.wait_for_report())
+
+    def test_wait_for_report_terminate(self):
+        """ Terminating the report creation should also terminate the report commands """
+        pidfile = os.path.join(self.casedir, "report_command.pid")
+
+        def _create_report(deliverer):
+            command = subprocess.Popen(["sleep", "60"])
+            with open(pidfile, 'w') as fh:
+                fh.write(u"{}".format(command.pid))
+            command.wait()
+
+        with mock.patch.object(deliver.SampleDeliverer, 'create_report', autospec=True, side_effect=_create_report):
+            self.deliverer.create_report_async()
+            while not os.path.exists(pidfile) or not os.path.getsize(pidfile):
+                time.sleep(0.05)
+            self.assertFalse(self.deliverer.wait_for_report(terminate=True))
+        with open(pidfile, 'r') as fh:
+            pid = int(fh.read())
+
+        def _running():
+            # the terminated command is left to init, which may not reap it
+            try:
+                with open("/proc/{}/stat".format(pid), 'r') as fh:
+                    return fh.read().rsplit(')', 1)[1].split()[0] != 'Z'
+            except IOError:
+                return False
+
+        for _ in range(100):
+            if not _running():
+                break
+            time.sleep(0.05)
+        else:
+            os.kill(pid, signal.SIGKILL)
+            self.fail("the report command was not terminated")
+
     def test_create_sample_report(self):
         """ creating the sample report """
         with mock.patch.object(deliver, 'call_external_command') as syscall:
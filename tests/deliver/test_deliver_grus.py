@@ -42,6 +42,13 @@ SAMPLECFG = {
         }
     }
 
+def _hard_stage_sample(projectid, sampleid):
+    # replaces deliver_grus._hard_stage_sample in the worker processes
+    if sampleid == 'S2':
+        raise ValueError("mocked failure")
+    return True
+
+
 class TestMisc(unittest.TestCase):
 
     @patch('taca_ngi_pipeline.deliver.deliver_grus.input')
@@ -170,6 +177,31 @@ class TestGrusProjectDeliverer(unittest.TestCase):
         delivered = self.deliverer.deliver_project()
         self.assertTrue(delivered)
 
+    @patch('taca_ngi_pipeline.deliver.deliver_grus._hard_stage_sample', _hard_stage_sample)
+    @patch('taca_ngi_pipeline.deliver.deliver_grus.GrusSampleDeliverer')
+    def test_hard_stage_in_pool(self, mock_sample_deliverer):
+        soft_stagepath = os.path.join(self.tmp_dir, 'SOFT_POOL')
+        hard_stagepath = os.path.join(self.tmp_dir, 'HARD_POOL')
+        os.makedirs(os.path.join(soft_stagepath, 'misc_folder'))
+        os.makedirs(hard_stagepath)
+        open(os.path.join(soft_stagepath, 'misc_folder', 'misc_file.txt'), 'w').close()
+        open(os.path.join(soft_stagepath, 'misc_file.txt'), 'w').close()
+        misc = ['misc_folder', 'misc_file.txt']
+        self.deliverer.workers = 2
+        try:
+            self.assertTupleEqual(
+                self.deliverer.hard_stage(['S1', 'S3'], misc, soft_stagepath, hard_stagepath),
+                (['S1', 'S3'], misc))
+            self.assertTrue(os.path.exists(os.path.join(hard_stagepath, 'misc_folder', 'misc_file.txt')))
+            self.assertTrue(os.path.exists(os.path.join(hard_stagepath, 'misc_file.txt')))
+            with self.assertRaises(ValueError):
+                self.deliverer.hard_stage(['S1', 'S2', 'S3'], [], soft_stagepath, hard_stagepath)
+        finally:
+            self.deliverer.workers = 1
+        # the failed sample should be set back to STAGED
+        mock_sample_deliverer.assert_called_once_with(self.pid, 'S2')
+        mock_sample_deliverer().update_delivery_status.assert_called_once_with(status='STAGED')
+
     @patch('taca_ngi_pipeline.deliver.deliver_grus.proceed_or_not')
     @patch('taca_ngi_pipeline.deliver.deliver_grus.shutil')
     @patch('taca_ngi_pipeline.deliver.deliver_grus.GrusProjectDeliverer._create_delivery_project')
@@ -334,3 +366,17 @@ class TestGrusSampleDeliverer(unittest.TestCase):
         self.deliverer.do_delivery()
         mock_copy.assert_called_once_with(os.path.join(self.tmp_dir, 'STAGING', 'P12345_1001.txt'),
                                           os.path.join(self.tmp_dir, 'STAGING_HARD'))
+        with open(self.deliverer.hard_staging_report(), 'r') as fh:
+            report = json.load(fh)
+        self.assertListEqual(report['files'], [{'path': 'P12345_1001.txt', 'strategy': 'copy', 'bytes_written': 0}])
+
+    @patch('taca_ngi_pipeline.deliver.deliver_grus.GrusSampleDeliverer.verify_staged_copy')
+    @patch('taca_ngi_pipeline.deliver.deliver_grus.fs.link_or_copy_tree')
+    @patch('taca_ngi_pipeline.deliver.deliver_grus.glob.glob')
+    def test_do_delivery_verifies_copied_files(self, mock_glob, mock_link, mock_verify):
+        """ Only the files that were copied rather than linked should be verified """
+        mock_glob.return_value = []
+        mock_link.return_value = [('reflinked.bam', 'reflink', 0), ('copied.bam', 'copy', 10)]
+        self.deliverer.do_delivery()
+        mock_verify.assert_called_once_with(
+            os.path.join(self.tmp_dir, 'STAGING_HARD'), relpaths=[os.path.join(self.sid, 'copied.bam')])
@@ -0,0 +1,133 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from taca_ngi_pipeline.utils.checksum_index import ChecksumIndex
+
+
+class TestChecksumIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.dbpath = os.path.join(self.tmp_dir, 'index', 'checksums.sqlite')
+        self.datafile = os.path.join(self.tmp_dir, 'datafile')
+        with open(self.datafile, 'w') as fh:
+            fh.write('some data')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_store_and_lookup(self):
+        with ChecksumIndex(self.dbpath) as cidx:
+            self.assertIsNone(cidx.lookup(self.datafile, 'md5'))
+            cidx.store(self.datafile, 'md5', 'a-digest')
+        with ChecksumIndex(self.dbpath) as cidx:
+            self.assertEqual(cidx.lookup(self.datafile, 'md5'), 'a-digest')
+            self.assertIsNone(cidx.lookup(self.datafile, 'sha1'))
+            self.assertEqual(cidx.stats()['entries'], {'md5': 1})
+
+    def test_concurrent_indexes(self):
+        """ an open index should not hold the write lock between calls """
+        with ChecksumIndex(self.dbpath, timeout=0.1) as first, ChecksumIndex(self.dbpath, timeout=0.1) as second:
+            first.store(self.datafile, 'md5', 'a-digest')
+            self.assertEqual(first.lookup(self.datafile, 'md5'), 'a-digest')
+            with self.assertNoLogs('taca_ngi_pipeline.utils.checksum_index', level='WARNING'):
+                second.store(self.datafile, 'sha1', 'another-digest')
+                second.save_checkpoint(self.datafile, 4, {'md5': b'md5-state'})
+                second.clear_checkpoint(self.datafile)
+            self.assertEqual(first.lookup(self.datafile, 'sha1'), 'another-digest')
+            # the last used times are written when flushing
+            before = first.connection.execute("SELECT MAX(last_used) FROM checksums").fetchone()[0]
+            time.sleep(0.01)
+            first.flush()
+            self.assertGreater(
+                first.connection.execute("SELECT MAX(last_used) FROM checksums").fetchone()[0], before)
+
+    def test_locked_index(self):
+        """ a locked index should not make any call fail """
+        with ChecksumIndex(self.dbpath) as cidx:
+            cidx.store(self.datafile, 'md5', 'a-digest')
+        lock = sqlite3.connect(self.dbpath, isolation_level=None)
+        try:
+            lock.execute("BEGIN IMMEDIATE")
+            cidx = ChecksumIndex(self.dbpath, max_entries=1, timeout=0.1)
+            with self.assertLogs('taca_ngi_pipeline.utils.checksum_index', level='WARNING'):
+                cidx.store(self.datafile, 'sha1', 'another-digest')
+                self.assertEqual(cidx.evict(max_entries=0), 0)
+                cidx.vacuum()
+                cidx.close()
+            lock.execute("ROLLBACK")
+        finally:
+            lock.close()
+        with ChecksumIndex(self.dbpath) as cidx:
+            self.assertEqual(cidx.lookup(self.datafile, 'md5'), 'a-digest')
+
+    def test_modified_file_is_not_found(self):
+        with ChecksumIndex(self.dbpath) as cidx:
+            cidx.store(self.datafile, 'md5', 'a-digest')
+            st = os.stat(self.datafile)
+            os.utime(self.datafile, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+            self.assertIsNone(cidx.lookup(self.datafile, 'md5'))
+
+    def test_evict(self):
+        with ChecksumIndex(self.dbpath) as cidx:
+            cidx.store(self.datafile, 'md5', 'a-digest')
+            cidx.store(self.datafile, 'sha1', 'another-digest')
+            self.assertEqual(cidx.evict(max_entries=1), 1)
+            self.assertEqual(cidx.evict(max_age_days=1), 0)
+            os.unlink(self.datafile)
+            self.assertEqual(cidx.evict(prune_missing=True), 1)
+            self.assertEqual(cidx.stats()['entries'], {})
+
+    def test_eviction_policy_applied_on_close(self):
+        with ChecksumIndex(self.dbpath, max_age_days=0) as cidx:
+            cidx.store(self.datafile, 'md5', 'a-digest')
+            time.sleep(0.01)
+        with ChecksumIndex(self.dbpath) as cidx:
+            self.assertIsNone(cidx.lookup(self.datafile, 'md5'))
+            cidx.store(self.datafile, 'md5', 'a-digest')
+        # the policy is not applied again within the eviction interval
+        with ChecksumIndex(self.dbpath, max_age_days=0) as cidx:
+            time.sleep(0.01)
+        with ChecksumIndex(self.dbpath) as cidx:
+            self.assertEqual(cidx.lookup(self.datafile, 'md5'), 'a-digest')
+
+    def test_checkpoints(self):
+        with ChecksumIndex(self.dbpath) as cidx:
+            self.assertEqual(cidx.load_checkpoint(self.datafile, ['md5', 'sha1']), (0, {}))
+            cidx.save_checkpoint(self.datafile, 4, {'md5': b'md5-state', 'sha1': b'sha1-state'})
+            self.assertEqual(cidx.load_checkpoint(self.datafile, ['md5']), (4, {'md5': b'md5-state'}))
+            # a checkpoint is only used if it covers all the algorithms
+            self.assertEqual(cidx.load_checkpoint(self.datafile, ['md5', 'sha256']), (0, {}))
+            self.assertEqual(cidx.stats()['checkpoints'], 1)
+            cidx.clear_checkpoint(self.datafile)
+            self.assertEqual(cidx.load_checkpoint(self.datafile, ['md5']), (0, {}))
+
+    def test_checkpoints_of_another_build(self):
+        with ChecksumIndex(self.dbpath) as cidx:
+            cidx.save_checkpoint(self.datafile, 4, {'md5': b'md5-state'}, build='OpenSSL 3.0.2 x86_64')
+            self.assertEqual(
+                cidx.load_checkpoint(self.datafile, ['md5'], build='OpenSSL 3.0.2 x86_64'), (4, {'md5': b'md5-state'}))
+            self.assertEqual(cidx.load_checkpoint(self.datafile, ['md5'], build='OpenSSL 3.1.0 x86_64'), (0, {}))
+            self.assertEqual(cidx.load_checkpoint(self.datafile, ['md5']), (0, {}))
+
+    def test_checkpoints_without_build_are_dropped(self):
+        os.makedirs(os.path.dirname(self.dbpath))
+        connection = sqlite3.connect(self.dbpath)
+        connection.execute(
+            "CREATE TABLE checkpoints (device INTEGER NOT NULL, inode INTEGER NOT NULL, size INTEGER NOT NULL, "
+            "mtime_ns INTEGER NOT NULL, algorithm TEXT NOT NULL, offset INTEGER NOT NULL, state BLOB NOT NULL, "
+            "path TEXT, last_used REAL NOT NULL, PRIMARY KEY (device, inode, size, mtime_ns, algorithm))")
+        st = os.stat(self.datafile)
+        connection.execute(
+            "INSERT INTO checkpoints VALUES (?, ?, ?, ?, 'md5', 4, ?, ?, ?)",
+            (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, b'md5-state', self.datafile, time.time()))
+        connection.commit()
+        connection.close()
+        with ChecksumIndex(self.dbpath) as cidx:
+            self.assertEqual(cidx.stats()['checkpoints'], 0)
+            cidx.save_checkpoint(self.datafile, 4, {'md5': b'md5-state'}, build='a build')
+            self.assertEqual(cidx.load_checkpoint(self.datafile, ['md5'], build='a build'), (4, {'md5': b'md5-state'}))
@@ -1,6 +1,16 @@
+import errno
+import glob
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+import threading
 import unittest
+from unittest import mock
 
 import taca_ngi_pipeline.utils.filesystem as filesystem
+from taca_ngi_pipeline.utils.checksum_index import ChecksumIndex
 
 
 class TestFilesystem(unittest.TestCase):
@@ -16,6 +26,330 @@ class TestFilesystem(unittest.TestCase):
             self.assertEqual(dest, expected_dest_path)
             self.assertEqual(dig, expected_digest)
 
+    def test_gather_files_hash_workers(self):
+        files_to_deliver = [['tests/data/deliver_testset*', 'tests/data/stage'],
+                            ['tests/data/P12345_*.xml', 'tests/data/stage', {'no_digest_cache': True}]]
+        expected = list(filesystem.gather_files(files_to_deliver))
+        found = list(filesystem.gather_files(files_to_deliver, hash_workers=2))
+        self.assertListEqual(found, expected)
+        self.assertEqual(found[0][2], '640ec90a89e9d8aaca6d5364e4139375')
+
+    def test_gather_files_multiple_algorithms(self):
+        files_to_deliver = [['tests/data/P12345_*.xml', 'tests/data/stage', {'no_digest_cache': True}]]
+        md5 = list(filesystem.gather_files(files_to_deliver, hash_algorithm='md5'))
+        sha1 = list(filesystem.gather_files(files_to_deliver, hash_algorithm='sha1'))
+        for hash_workers in [1, 2]:
+            found = list(filesystem.gather_files(
+                files_to_deliver, hash_algorithm=['md5', 'sha1'], hash_workers=hash_workers))
+            self.assertListEqual(
+                found,
+                [(src, dst, {'md5': md5dig, 'sha1': sha1dig})
+                 for (src, dst, md5dig), (_, _, sha1dig) in zip(md5, sha1)])
+
+    def test_hash_backends(self):
+        expected = {'md5': '640ec90a89e9d8aaca6d5364e4139375'}
+        for method in filesystem.HashBackend.METHODS:
+            for drop_cache in [False, True]:
+                backend = filesystem.HashBackend(method, chunk_size=1000, drop_cache=drop_cache)
+                self.assertEqual(backend.chunk_size % 4096, 0)
+                self.assertDictEqual(
+                    backend.compute_digests('tests/data/deliver_testset.tar', ['md5']), expected)
+        with self.assertRaises(ValueError):
+            filesystem.HashBackend('no-such-method')
+
+    @unittest.skipIf(filesystem.posix_fadvise is None, "posix_fadvise is not available")
+    def test_hashfile_backend_drops_cache(self):
+        backend = filesystem.HashBackend('hashfile', drop_cache=True)
+        with mock.patch.object(filesystem, 'posix_fadvise') as fadvise:
+            backend.compute_digests('tests/data/deliver_testset.tar', ['md5'])
+        advice = [call[0][3] for call in fadvise.call_args_list]
+        self.assertIn(filesystem.POSIX_FADV_SEQUENTIAL, advice)
+        self.assertIn(filesystem.POSIX_FADV_DONTNEED, advice)
+
+    @unittest.skipUnless(filesystem.ResumableHash.supported(['md5', 'sha1']), "libcrypto is not available")
+    def test_resumable_hashing(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            dbpath = os.path.join(tmp_dir, 'checksums.sqlite')
+            datafile = 'tests/data/deliver_testset.tar'
+            backend = filesystem.HashBackend(
+                'buffered', chunk_size=4096, checkpoint_index=dbpath, checkpoint_interval=8192)
+            expected = filesystem.HashBackend('buffered').compute_digests(datafile, ['md5', 'sha1'])
+            # interrupt the hashing part way through the file
+            hashed = filesystem.HashBackend._hashed
+            calls = []
+
+            def _interrupted(*args):
+                calls.append(args)
+                if len(calls) == 5:
+                    raise KeyboardInterrupt()
+                return hashed(backend, *args)
+
+            with mock.patch.object(backend, '_hashed', side_effect=_interrupted):
+                with self.assertRaises(KeyboardInterrupt):
+                    backend.compute_digests(datafile, ['md5', 'sha1'])
+            with ChecksumIndex(dbpath) as cidx:
+                build = filesystem.ResumableHash.build()
+                self.assertEqual(cidx.load_checkpoint(datafile, ['md5', 'sha1'], build=build)[0], 4 * 4096)
+                # a checkpoint from another libcrypto build is not resumed
+                self.assertEqual(cidx.load_checkpoint(datafile, ['md5', 'sha1'], build='another build'), (0, {}))
+            # hashing again resumes from the checkpoint
+            calls = []
+
+            def _resumed(*args):
+                calls.append(args)
+                return hashed(backend, *args)
+
+            with mock.patch.object(backend, '_hashed', side_effect=_resumed):
+                self.assertDictEqual(backend.compute_digests(datafile, ['md5', 'sha1']), expected)
+            self.assertEqual(calls[0][2], 4 * 4096)
+            with ChecksumIndex(dbpath) as cidx:
+                self.assertEqual(cidx.load_checkpoint(datafile, ['md5', 'sha1'], build=build), (0, {}))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @unittest.skipUnless(filesystem.ResumableHash.supported(['md5']), "libcrypto is not available")
+    def test_gather_files_checksum_index_and_checkpoints(self):
+        # storing checksums and checkpointing in the same index must not lock each other out
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            dbpath = os.path.join(tmp_dir, 'checksums.sqlite')
+            datafiles = []
+            for i in range(3):
+                datafile = os.path.join(tmp_dir, 'data{}.bin'.format(i))
+                with open(datafile, 'wb') as fh:
+                    fh.write(os.urandom(64 * 1024))
+                datafiles.append(datafile)
+            files_to_deliver = [[os.path.join(tmp_dir, 'data*.bin'), os.path.join(tmp_dir, 'stage')]]
+            cidx = ChecksumIndex(dbpath, timeout=0.1)
+            backend = filesystem.HashBackend(
+                'buffered', chunk_size=4096, checkpoint_index=cidx, checkpoint_interval=8192)
+            with mock.patch.object(filesystem.logger, 'warning') as warning, \
+                    mock.patch('taca_ngi_pipeline.utils.checksum_index.logger.warning') as index_warning:
+                found = list(filesystem.gather_files(
+                    files_to_deliver, checksum_index=cidx, hash_backend=backend))
+            warning.assert_not_called()
+            index_warning.assert_not_called()
+            self.assertEqual(len(found), len(datafiles))
+            for src, _, digest in found:
+                with open(src, 'rb') as fh:
+                    self.assertEqual(digest, hashlib.md5(fh.read()).hexdigest())
+            with ChecksumIndex(dbpath) as cidx:
+                for datafile in datafiles:
+                    self.assertIsNotNone(cidx.lookup(datafile, 'md5'))
+                    self.assertEqual(cidx.load_checkpoint(datafile, ['md5']), (0, {}))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_hash_backend_pickles_checkpoint_index_as_path(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            dbpath = os.path.join(tmp_dir, 'checksums.sqlite')
+            with ChecksumIndex(dbpath) as cidx:
+                backend = filesystem.HashBackend('buffered', checkpoint_index=cidx)
+                self.assertEqual(pickle.loads(pickle.dumps(backend)).checkpoint_index, dbpath)
+                self.assertIs(backend.checkpoint_index, cidx)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_gather_files_hashes_linked_files_once(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            datafile = os.path.join(tmp_dir, 'sample.bam')
+            shutil.copy('tests/data/deliver_testset.tar', datafile)
+            os.link(datafile, os.path.join(tmp_dir, 'sample.bam.hardlink'))
+            os.symlink(datafile, os.path.join(tmp_dir, 'sample.bam.symlink'))
+            files_to_deliver = [[os.path.join(tmp_dir, 'sample.bam*'), 'stage', {'no_digest_cache': True}],
+                                [datafile, 'stage/again', {'no_digest_cache': True}]]
+            for hash_workers in [1, 2]:
+                with self.assertLogs(filesystem.logger, level='INFO') as logs:
+                    found = list(filesystem.gather_files(files_to_deliver, hash_workers=hash_workers))
+                self.assertIn("skipped hashing {} bytes in 3 files".format(3 * 52639), logs.output[-1])
+                self.assertEqual(len(found), 4)
+                self.assertSetEqual(set(digest for _, _, digest in found), {'640ec90a89e9d8aaca6d5364e4139375'})
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_fast_hash_algorithm(self):
+        self.assertIn(filesystem.fast_hash_algorithm(), filesystem.FAST_HASH_ALGORITHMS)
+        self.assertEqual(filesystem.fast_hash_algorithm('blake2b'), 'blake2b')
+        with mock.patch.object(filesystem, 'xxhash', None):
+            self.assertNotEqual(filesystem.fast_hash_algorithm('xxh64'), 'xxh64')
+        # falling back to blake2b should suggest installing the faster algorithms
+        with mock.patch.object(filesystem, 'xxhash', None), mock.patch.object(filesystem, 'blake3', None), \
+                mock.patch.object(filesystem.logger, 'warning') as warning:
+            self.assertEqual(filesystem.fast_hash_algorithm(), 'blake2b')
+            self.assertIn('fast_hash', warning.call_args[0][0])
+        digests = filesystem.HashBackend().compute_digests('tests/data/deliver_testset.tar', ['blake2b'])
+        with open('tests/data/deliver_testset.tar', 'rb') as fh:
+            self.assertEqual(digests['blake2b'], hashlib.blake2b(fh.read()).hexdigest())
+
+    def test_verify_digest_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            shutil.copy('tests/data/deliver_testset.tar', tmp_dir)
+            digestfile = os.path.join(tmp_dir, 'digests.md5')
+            with open(digestfile, 'w') as fh:
+                fh.write("640ec90a89e9d8aaca6d5364e4139375  deliver_testset.tar\n")
+                fh.write("640ec90a89e9d8aaca6d5364e4139375  missing.tar\n")
+                fh.write("00000000000000000000000000000000  deliver_testset.tar\n")
+            verified, failed = filesystem.verify_digest_file(digestfile, tmp_dir, 'md5')
+            self.assertEqual(verified, 1)
+            self.assertListEqual([relpath for relpath, _ in failed], ['missing.tar', 'deliver_testset.tar'])
+            self.assertTupleEqual(
+                filesystem.verify_digest_file(digestfile, tmp_dir, 'md5', workers=2), (verified, failed))
+            self.assertTupleEqual(
+                filesystem.verify_digest_file(digestfile, tmp_dir, 'md5', relpaths=['missing.tar']),
+                (0, [failed[0]]))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_link_or_copy_tree(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            src = os.path.join(tmp_dir, 'src')
+            os.makedirs(os.path.join(src, 'folder'))
+            shutil.copy('tests/data/deliver_testset.tar', os.path.join(src, 'folder'))
+            os.symlink(os.path.abspath('tests/data/deliver_testset.tar'), os.path.join(src, 'link.tar'))
+            placed = filesystem.link_or_copy_tree(src, os.path.join(tmp_dir, 'linked'))
+            self.assertListEqual(sorted(relpath for relpath, _, _ in placed), ['folder/deliver_testset.tar', 'link.tar'])
+            for relpath, strategy, written in placed:
+                self.assertIn(strategy, filesystem.LINK_STRATEGIES)
+                self.assertEqual(written, 0 if strategy != 'copy' else os.path.getsize(src + '/folder/deliver_testset.tar'))
+                self.assertFalse(os.path.islink(os.path.join(tmp_dir, 'linked', relpath)))
+            placed = filesystem.link_or_copy_tree(src, os.path.join(tmp_dir, 'copied'), strategies=['copy'])
+            self.assertListEqual(
+                sorted(placed),
+                [(relpath, 'copy', os.path.getsize('tests/data/deliver_testset.tar'))
+                 for relpath in ['folder/deliver_testset.tar', 'link.tar']])
+            with mock.patch.object(filesystem, 'link', side_effect=OSError("not supported")):
+                with mock.patch.object(filesystem, '_reflink', side_effect=OSError("not supported")):
+                    self.assertEqual(
+                        filesystem.link_or_copy(
+                            os.path.join(src, 'link.tar'), os.path.join(tmp_dir, 'fallback.tar'))[0], 'copy')
+            # files are only hardlinked when asked for
+            with mock.patch.object(filesystem, '_reflink', side_effect=OSError("not supported")):
+                self.assertEqual(
+                    filesystem.link_or_copy(
+                        os.path.join(src, 'link.tar'), os.path.join(tmp_dir, 'copied.tar'))[0], 'copy')
+                self.assertEqual(
+                    filesystem.link_or_copy(
+                        os.path.join(src, 'folder', 'deliver_testset.tar'), os.path.join(tmp_dir, 'hardlinked.tar'),
+                        strategies=filesystem.LINK_STRATEGIES)[0], 'hardlink')
+            with self.assertRaises(OSError):
+                filesystem.link_or_copy(
+                    os.path.join(src, 'link.tar'), os.path.join(tmp_dir, 'fallback.tar'), strategies=['hardlink'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_copy_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            src = os.path.join(tmp_dir, 'src')
+            with open(src, 'wb') as fh:
+                fh.write(os.urandom(10000))
+            with open(src, 'rb') as fh:
+                data = fh.read()
+            os.chmod(src, 0o640)
+            dst = os.path.join(tmp_dir, 'dst')
+            # split into ranges of 4 chunks of 1000 bytes
+            result = filesystem.copy_file(src, dst, threads=3, chunk_size=1000, min_range_size=3000)
+            self.assertEqual(result['bytes'], 10000)
+            self.assertEqual(result['ranges'], 3)
+            with open(dst, 'rb') as fh:
+                self.assertEqual(fh.read(), data)
+            self.assertEqual(os.stat(dst).st_mode, os.stat(src).st_mode)
+            self.assertEqual(os.stat(dst).st_mtime, os.stat(src).st_mtime)
+            # fall back when the kernel can not copy between the files
+            with mock.patch.object(filesystem.os, 'copy_file_range', create=True,
+                                   side_effect=OSError(errno.EXDEV, "cross-device")):
+                self.assertEqual(filesystem.copy_file(src, dst, chunk_size=1000)['method'], 'sendfile')
+                with mock.patch.object(filesystem.os, 'sendfile', side_effect=OSError(errno.EINVAL, "invalid")):
+                    self.assertEqual(filesystem.copy_file(src, dst, chunk_size=1000)['method'], 'read_write')
+            with open(dst, 'rb') as fh:
+                self.assertEqual(fh.read(), data)
+            open(src, 'w').close()
+            self.assertEqual(filesystem.copy_file(src, dst)['bytes'], 0)
+            self.assertEqual(os.path.getsize(dst), 0)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_gather_files_checksum_index(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            dbpath = os.path.join(tmp_dir, 'checksums.sqlite')
+            files_to_deliver = [['tests/data/P12345_*.xml', 'tests/data/stage', {'no_digest_cache': True}]]
+            expected = list(filesystem.gather_files(files_to_deliver, checksum_index=ChecksumIndex(dbpath)))
+            # the checksums should now be picked up from the index without hashing the files
+            with mock.patch.object(filesystem, 'hashfile', side_effect=AssertionError("file was rehashed")):
+                found = list(filesystem.gather_files(files_to_deliver, checksum_index=ChecksumIndex(dbpath)))
+                self.assertListEqual(found, expected)
+                found = list(filesystem.gather_files(
+                    files_to_deliver, hash_workers=2, checksum_index=ChecksumIndex(dbpath)))
+                self.assertListEqual(found, expected)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_directory_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            for subdir in ['a/b/c', 'a/.hidden', 'd/e']:
+                os.makedirs(os.path.join(tmp_dir, subdir))
+            for filename in ['a/x.txt', 'a/.y.txt', 'a/b/z.txt', 'a/b/c/w.log', 'a/.hidden/v.txt', 'd/e/u.txt']:
+                open(os.path.join(tmp_dir, filename), 'w').close()
+            os.symlink(os.path.join(tmp_dir, 'd'), os.path.join(tmp_dir, 'a', 'b', 'link'))
+            os.symlink(os.path.join(tmp_dir, 'missing'), os.path.join(tmp_dir, 'a', 'broken'))
+            patterns = ['*', 'a/*', 'a/.*', 'a/*/', '*/*/*.txt', 'a/b', 'a/b/', 'a/broken', 'a/nothing', '*/b/*/*']
+            directories = filesystem._DirectoryCache()
+            for pattern in patterns:
+                pattern = os.path.join(tmp_dir, pattern)
+                self.assertListEqual(list(directories.iglob(pattern)), list(glob.iglob(pattern)))
+            for top in [tmp_dir, os.path.join(tmp_dir, 'a', 'b')]:
+                self.assertListEqual(list(directories.walk(top)), list(os.walk(top, followlinks=True)))
+            self.assertTrue(directories.lexists(os.path.join(tmp_dir, 'a', 'broken')))
+            self.assertFalse(directories.exists(os.path.join(tmp_dir, 'a', 'broken')))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_gather_files_lists_directories_once(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(tmp_dir, 'analysis', 'reports'))
+            for filename in ['sample.bam', 'reports/sample.html', 'reports/multiqc.html']:
+                open(os.path.join(tmp_dir, 'analysis', filename), 'w').close()
+            files_to_deliver = [[os.path.join(tmp_dir, 'analysis', '*.bam'), 'stage'],
+                                [os.path.join(tmp_dir, 'analysis', 'reports', 'sample*'), 'stage/reports'],
+                                [os.path.join(tmp_dir, 'analysis'), 'stage']]
+            with mock.patch.object(filesystem, 'scandir', side_effect=os.scandir) as scandir:
+                found = list(filesystem.gather_files(files_to_deliver, no_checksum=True))
+            listed = [call[0][0] for call in scandir.call_args_list]
+            self.assertEqual(len(listed), len(set(listed)))
+            self.assertIn((os.path.join(tmp_dir, 'analysis', 'reports', 'sample.html'),
+                           'stage/reports/sample.html', None), found)
+            self.assertIn((os.path.join(tmp_dir, 'analysis', 'reports', 'multiqc.html'),
+                           'stage/analysis/reports/multiqc.html', None), found)
+            self.assertEqual(len(found), 5)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_prefetched(self):
+        def _items():
+            for i in range(10):
+                yield i
+            raise filesystem.PatternNotMatchedException("no more items")
+
+        found = []
+        with self.assertRaises(filesystem.PatternNotMatchedException):
+            for item in filesystem._prefetched(_items(), 2):
+                found.append(item)
+        self.assertListEqual(found, list(range(10)))
+        # the producer is stopped if the consumer goes away
+        prefetched = filesystem._prefetched(iter(range(100)), 2)
+        self.assertEqual(next(prefetched), 0)
+        prefetched.close()
+        self.assertListEqual(
+            [thread.name for thread in threading.enumerate() if thread.name == "prefetch"], [])
+
     def test_parse_hash_file(self):
         hashfile = 'tests/data/deliver_testset.tar.md5'
         got_dict = filesystem.parse_hash_file(hashfile, '2020-12-07', root_path='tests/data')
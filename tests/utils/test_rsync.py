@@ -0,0 +1,216 @@
+import json
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+from taca.utils.transfer import RsyncError
+from taca_ngi_pipeline.utils import rsync
+
+# prints output like rsync --verbose --info=progress2 would
+FAKE_RSYNC = """#!/bin/sh
+printf 'sending incremental file list\\n'
+printf 'file1\\n       1,000  10%%    1.00MB/s    0:00:09 (xfr#1, to-chk=1/2)\\r'
+printf '       5,000  50%%    1.00MB/s    0:00:05\\r      10,000 100%%    1.00MB/s    0:00:00 (xfr#2, to-chk=0/2)\\n'
+printf 'sent 10,100 bytes\\n'
+echo "an error" >&2
+exit $1
+"""
+
+
+class TestRsync(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _create_file(self, fpath, size):
+        with open(os.path.join(self.tmp_dir, fpath), 'wb') as fh:
+            fh.write(b'x' * size)
+
+    def test_file_list(self):
+        filelist = os.path.join(self.tmp_dir, 'files.lst')
+        rsync.write_file_list(filelist, ['a', 'b/c'])
+        self.assertListEqual(rsync.read_file_list(filelist), ['a', 'b/c'])
+
+    def test_shard_files(self):
+        sizes = {'a': 100, 'b': 60, 'c': 50, 'd': 40, 'e': 10}
+        for fpath, size in sizes.items():
+            self._create_file(fpath, size)
+        paths = sorted(sizes.keys()) + ['missing']
+        shards = rsync.shard_files(paths, self.tmp_dir, 2)
+        self.assertListEqual(shards, [(140, ['a', 'd']), (120, ['b', 'c', 'e', 'missing'])])
+        # all files should be transferred exactly once
+        self.assertListEqual(sorted(p for _, shard in shards for p in shard), paths)
+        # empty shards are left out
+        self.assertEqual(len(rsync.shard_files(['a', 'b'], self.tmp_dir, 4)), 2)
+        self.assertListEqual(rsync.shard_files(paths, self.tmp_dir, 1), [(260, paths)])
+
+    def test_merge_logs(self):
+        prefix = os.path.join(self.tmp_dir, 'transfer')
+        prefixes = ["{}.shard{}".format(prefix, n) for n in range(2)]
+        for n, shard_prefix in enumerate(prefixes):
+            with open("{}_rsync.out".format(shard_prefix), 'w') as fh:
+                fh.write("shard {}\n".format(n))
+        rsync.merge_logs(prefixes, prefix)
+        with open("{}_rsync.out".format(prefix)) as fh:
+            self.assertEqual(
+                fh.read(), "### transfer.shard0\nshard 0\n### transfer.shard1\nshard 1\n")
+        self.assertTrue(os.path.exists("{}_rsync.err".format(prefix)))
+        self.assertListEqual(sorted(os.listdir(self.tmp_dir)), ['transfer_rsync.err', 'transfer_rsync.out'])
+
+    def _fake_rsync(self, returncode):
+        script = os.path.join(self.tmp_dir, 'rsync')
+        with open(script, 'w') as fh:
+            fh.write(FAKE_RSYNC)
+        os.chmod(script, stat.S_IRWXU)
+        return [script, str(returncode)]
+
+    def test_progress_rsync_agent(self):
+        statusfile = os.path.join(self.tmp_dir, 'transfer.progress.json')
+        progress = rsync.TransferProgress('a-delivery', statusfile=statusfile, interval=0, total_bytes=20000)
+        agent = rsync.ProgressRsyncAgent(
+            self.tmp_dir, progress, stream='a-stream', dest_path=self.tmp_dir, validate=False, opts={})
+        prefix = os.path.join(self.tmp_dir, 'transfer')
+        agent.command = lambda: self._fake_rsync(0)
+        self.assertTrue(agent.transfer(transfer_log=prefix))
+        self.assertDictEqual(progress.streams, {'a-stream': {
+            'bytes': 10000, 'files': 2, 'percent': 100, 'files_total': 2}})
+        with open(statusfile) as fh:
+            record = json.load(fh)
+        self.assertEqual(record['delivery'], 'a-delivery')
+        self.assertEqual(record['bytes_done'], 10000)
+        self.assertEqual(record['bytes_total'], 20000)
+        self.assertEqual(record['files_done'], 2)
+        self.assertEqual(progress.finish('done')['status'], 'done')
+        with open("{}_rsync.out".format(prefix)) as fh:
+            self.assertListEqual(
+                fh.read().splitlines()[1:], ['sending incremental file list', 'file1', 'sent 10,100 bytes'])
+        with open("{}_rsync.err".format(prefix)) as fh:
+            self.assertEqual(fh.read(), "an error\n")
+        agent.command = lambda: self._fake_rsync(23)
+        with self.assertRaises(RsyncError):
+            agent.transfer()
+
+    def test_transfer_progress(self):
+        progress = rsync.TransferProgress('a-delivery', interval=3600)
+        progress.update(0, 250, files_done=1, percent=25)
+        progress.update(1, 500, files_done=2, percent=50)
+        record = progress.finish('done')
+        self.assertEqual(record['bytes_done'], 750)
+        self.assertEqual(record['files_done'], 3)
+        self.assertEqual(record['bytes_total'], 2000)
+        self.assertEqual(record['streams'], 2)
+
+    def test_transfer_journal(self):
+        for fpath in ('a', 'b', 'c'):
+            self._create_file(fpath, 10)
+        journal = rsync.TransferJournal(os.path.join(self.tmp_dir, 'journal'), self.tmp_dir)
+        self.assertDictEqual(journal.load(), {})
+        journal.record('a')
+        journal.record('b')
+        journal.record('missing')
+        self.assertListEqual(sorted(journal.load().keys()), ['a', 'b'])
+        self.assertTupleEqual(journal.pending(['a', 'b', 'c']), (['c'], 20))
+        # a file that has been modified since it was transferred should be sent again
+        self._create_file('b', 20)
+        self.assertTupleEqual(journal.pending(['a', 'b', 'c']), (['b', 'c'], 10))
+        self.assertTupleEqual(
+            journal.pending(['a', 'b', 'c'], transferred=lambda fpath, size: fpath != 'a'), (['a', 'b', 'c'], 0))
+        with open(journal.journalpath, 'a') as fh:
+            fh.write('{"path": "c", "si')
+        self.assertListEqual(sorted(journal.load().keys()), ['a', 'b'])
+        journal.clear()
+        self.assertFalse(os.path.exists(journal.journalpath))
+
+    def test_rsync_agent_journal(self):
+        self._create_file('file1', 10)
+        journal = rsync.TransferJournal(os.path.join(self.tmp_dir, 'journal'), self.tmp_dir)
+        agent = rsync.ProgressRsyncAgent(
+            self.tmp_dir, journal=journal, dest_path=self.tmp_dir, validate=False, opts={})
+        self.assertIn('--out-format={}'.format(agent.COMPLETED_FORMAT), agent.command())
+        self.assertNotIn('--info=progress2', agent.command())
+        script = os.path.join(self.tmp_dir, 'rsync')
+        with open(script, 'w') as fh:
+            fh.write("#!/bin/sh\necho 'completed: 0 folder/'\necho 'completed: 10 file1'\n")
+        os.chmod(script, stat.S_IRWXU)
+        agent.command = lambda: [script]
+        self.assertTrue(agent.transfer())
+        self.assertListEqual(list(journal.load().keys()), ['file1'])
+
+    def test_rsync_agent_interrupted(self):
+        """ rsync should be terminated if its output can not be processed """
+        journal = rsync.TransferJournal(os.path.join(self.tmp_dir, 'journal'), self.tmp_dir)
+        agent = rsync.ProgressRsyncAgent(
+            self.tmp_dir, journal=journal, dest_path=self.tmp_dir, validate=False, opts={})
+        pidfile = os.path.join(self.tmp_dir, 'rsync.pid')
+        script = os.path.join(self.tmp_dir, 'rsync')
+        with open(script, 'w') as fh:
+            fh.write("#!/bin/sh\necho $$ > {}\necho 'completed: 10 file1'\nexec sleep 60\n".format(pidfile))
+        os.chmod(script, stat.S_IRWXU)
+        agent.command = lambda: [script]
+        journal.record = mock.Mock(side_effect=OSError("disk full"))
+        with self.assertRaises(OSError):
+            agent.transfer()
+        with open(pidfile, 'r') as fh:
+            pid = int(fh.read())
+        # the terminated rsync has been waited for, so it is gone
+        with self.assertRaises(OSError):
+            os.kill(pid, 0)
+
+    def test_ssh_master(self):
+        calls = os.path.join(self.tmp_dir, 'calls')
+        script = os.path.join(self.tmp_dir, 'ssh')
+        with open(script, 'w') as fh:
+            fh.write("#!/bin/sh\necho \"$@\" >> {}\n".format(calls))
+        os.chmod(script, stat.S_IRWXU)
+        with rsync.SshMaster('remote.host', remote_user='user', persist=60, ssh=script) as master:
+            self.assertTrue(os.path.isdir(master.control_dir))
+            control_path = master.control_path
+            self.assertEqual(
+                rsync.ssh_command(control_path),
+                "ssh -o ControlMaster=no -o ControlPath={}".format(control_path))
+        self.assertIsNone(master.control_path)
+        self.assertFalse(os.path.exists(os.path.dirname(control_path)))
+        with open(calls, 'r') as fh:
+            self.assertListEqual(fh.read().splitlines(), [
+                "-M -N -f -o BatchMode=yes -o ControlPath={} -o ControlPersist=60 user@remote.host".format(
+                    control_path),
+                "-o ControlPath={} -O exit user@remote.host".format(control_path)])
+
+    def test_ssh_master_failed(self):
+        script = os.path.join(self.tmp_dir, 'ssh')
+        with open(script, 'w') as fh:
+            fh.write("#!/bin/sh\necho 'Permission denied' >&2\nexit 255\n")
+        os.chmod(script, stat.S_IRWXU)
+        with rsync.SshMaster('remote.host', ssh=script) as master:
+            self.assertIsNone(master.control_path)
+            self.assertIsNone(master.control_dir)
+
+    def test_verify_remote_digest_file(self):
+        # runs the remote command locally
+        script = os.path.join(self.tmp_dir, 'ssh')
+        with open(script, 'w') as fh:
+            fh.write("#!/bin/sh\neval \"command=\\${$#}\"\nexec sh -c \"$command\"\n")
+        os.chmod(script, stat.S_IRWXU)
+        root = os.path.join(self.tmp_dir, 'delivered dir')
+        os.mkdir(root)
+        digestfile = os.path.join(self.tmp_dir, 'digests.md5')
+        with open(digestfile, 'w') as fh:
+            for n in range(5):
+                with open(os.path.join(root, 'file{}'.format(n)), 'w') as dh:
+                    dh.write(u"")
+                fh.write(u"{}  file{}\n".format(
+                    "d41d8cd98f00b204e9800998ecf8427e" if n != 3 else "0" * 32, n))
+            fh.write(u"d41d8cd98f00b204e9800998ecf8427e  missing\n")
+        verified, failed = rsync.verify_remote_digest_file(
+            digestfile, 'remote.host', root, 'md5', control_path='/tmp/%C', workers=3, ssh=script)
+        self.assertEqual(verified, 4)
+        self.assertListEqual(sorted(relpath for relpath, _ in failed), ['file3', 'missing'])
+        with self.assertRaises(rsync.transfer.TransferError):
+            rsync.verify_remote_digest_file(
+                digestfile, 'remote.host', os.path.join(self.tmp_dir, 'missing'), 'md5', ssh=script)